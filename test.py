@@ -1,8 +1,12 @@
-import os, subprocess, time, urllib3, shutil, sys
+import os, subprocess, time, urllib3, shutil, sys, http.client, ssl, base64
+import socket, concurrent.futures, signal, hashlib, zlib, urllib.parse
+import io, tarfile, zipfile
 from pathlib import Path
 
 import pytest, requests
 
+from uploadserver import multipart, KEEP_ALIVE_TIMEOUT
+
 
 assert 'VERBOSE' in os.environ, '$VERBOSE envionment variable not set'
 VERBOSE = os.environ['VERBOSE']
@@ -83,6 +87,68 @@ def test_upload_put():
     
     with open('put-file') as f: assert f.read() == 'file-content'
 
+def test_upload_raw_put():
+    spawn_server()
+    
+    res = put('/upload/raw-put-file', data=b'raw-content')
+    assert res.status_code == 201
+    assert res.headers['Location'] == '/raw-put-file'
+    
+    with open('raw-put-file') as f: assert f.read() == 'raw-content'
+    
+    res = put('/upload/raw-put-file', data=b'raw-content-2')
+    assert res.status_code == 201
+    assert res.headers['Location'] == '/raw-put-file%20%281%29'
+    
+    with open('raw-put-file (1)') as f: assert f.read() == 'raw-content-2'
+
+# Large enough for the body to go well past what the server buffers while
+# reading the headers
+def test_upload_raw_put_large():
+    spawn_server()
+    
+    file_content = os.urandom(5*1024*1024 + 123)
+    
+    res = put('/upload/raw-put-large', data=file_content)
+    assert res.status_code == 201
+    
+    with open('raw-put-large', 'rb') as f: assert f.read() == file_content
+
+def test_upload_raw_put_subpath():
+    spawn_server()
+    
+    res = put('/upload/raw-put-dir/sub%20dir/file', data=b'raw-content')
+    assert res.status_code == 201
+    
+    with open('raw-put-dir/sub dir/file') as f: assert f.read() == 'raw-content'
+
+def test_upload_raw_put_traversal():
+    spawn_server(directory='directory-option-test')
+    
+    res = put('/upload/%2E%2E/raw-put-traversal', data=b'raw-content')
+    assert res.status_code == 400
+    
+    assert not Path('raw-put-traversal').exists()
+
+def test_upload_raw_put_chunked():
+    spawn_server()
+    
+    res = put('/upload/raw-put-chunked', data=iter([b'raw-', b'content']))
+    assert res.status_code == 201
+    
+    with open('raw-put-chunked') as f: assert f.read() == 'raw-content'
+
+def test_upload_raw_put_no_length():
+    spawn_server()
+    
+    conn = connect()
+    conn.putrequest('PUT', '/upload/raw-put-no-length')
+    conn.endheaders()
+    assert conn.getresponse().status == 411
+    conn.close()
+    
+    assert not Path('raw-put-no-length').exists()
+
 def test_basic_auth_get():
     spawn_server(basic_auth='foo:bar')
     
@@ -155,6 +221,17 @@ def test_basic_auth_post_no_credentials(condition):
     
     assert not Path('unauth-file').exists()
 
+@pytest.mark.parametrize('condition', ['basic_auth', 'basic_auth_upload'])
+def test_basic_auth_raw_put_no_credentials(condition):
+    spawn_server(**{ condition: 'foo:bar' })
+    
+    assert put('/upload/unauth-file', data=b'file-content').status_code == 401
+    assert put('/upload/unauth-file', data=b'file-content',
+        auth=('foo', 'bar')).status_code == 201
+    
+    with open('unauth-file') as f: assert f.read() == 'file-content'
+    os.remove('unauth-file')
+
 @pytest.mark.parametrize('condition', ['basic_auth', 'basic_auth_upload'])
 def test_basic_auth_post_bad_user(condition):
     spawn_server(**{ condition: 'foo:bar' })
@@ -253,6 +330,209 @@ def test_upload_same_name_replace():
     with open(file_name) as f: assert f.read() == 'file-content-replaced'
     assert os.path.isfile(file_renamed) == False
 
+# Verify uploads of the same name at once all get names of their own
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_upload_same_name_concurrent(engine):
+    file_name = f'{engine}-concurrent'
+    
+    spawn_server(engine=engine)
+    
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: put(f'/upload/{file_name}',
+            data=f'content-{i}'.encode()), range(16)))
+    assert [res.status_code for res in results] == [201]*16
+    
+    names = { urllib.parse.unquote(res.headers['Location'][1:])
+        for res in results }
+    assert names == { file_name } | { f'{file_name} ({i})'
+        for i in range(1, 16) }
+    
+    contents = set()
+    for name in names:
+        with open(name) as f: contents.add(f.read())
+    assert contents == { f'content-{i}' for i in range(16) }
+
+# Verify retries with an Idempotency-Key get the original result, and aren't
+# stored again
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_idempotency_key(engine):
+    spawn_server(engine=engine)
+    
+    for _ in range(2):
+        res = put(f'/upload/{engine}-idempotent', data=b'content',
+            headers={ 'Idempotency-Key': f'{engine}-key-1' })
+        assert res.status_code == 201
+        assert res.headers['Location'] == f'/{engine}-idempotent'
+    assert res.headers['Idempotent-Replayed'] == 'true'
+    assert not os.path.exists(f'{engine}-idempotent (1)')
+    
+    # Retries that would send the body again get the result first
+    headers = { 'Idempotency-Key': f'{engine}-key-1' }
+    assert expect_100('PUT', f'/upload/{engine}-idempotent', headers,
+        length=7).startswith(b'201')
+    assert expect_100('PUT', f'/upload/{engine}-idempotent-2', headers,
+        length=7).startswith(b'422')
+    
+    for _ in range(2):
+        res = post('/upload', files={
+            'files': (f'{engine}-idempotent-post', 'content'),
+        }, headers={ 'Upload-Id': f'{engine}-key-2',
+            'Accept': 'application/json' })
+        assert res.status_code == 200
+        assert res.json()['files'][0]['path'] == f'/{engine}-idempotent-post'
+    assert not os.path.exists(f'{engine}-idempotent-post (1)')
+    
+    # A retry of an upload still in progress waits for it
+    first = connect()
+    first.putrequest('PUT', f'/upload/{engine}-idempotent-slow')
+    first.putheader('Content-Length', '8')
+    first.putheader('Idempotency-Key', f'{engine}-key-3')
+    first.endheaders()
+    first.send(b'slow')
+    time.sleep(0.5)
+    
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        retry = executor.submit(put, f'/upload/{engine}-idempotent-slow',
+            data=b'slowslow',
+            headers={ 'Idempotency-Key': f'{engine}-key-3' })
+        
+        time.sleep(0.5)
+        assert not retry.done()
+        
+        first.send(b'slow')
+        assert first.getresponse().status == 201
+        first.close()
+        
+        res = retry.result(timeout=5)
+        assert res.status_code == 201
+        assert res.headers['Idempotent-Replayed'] == 'true'
+    
+    with open(f'{engine}-idempotent-slow') as f: assert f.read() == 'slowslow'
+    assert not os.path.exists(f'{engine}-idempotent-slow (1)')
+
+# Verify --dedup stores each content once, with uploads linked to it
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_dedup(engine):
+    content = f'{engine}-same'
+    names = [f'{engine}-dedup-a', f'{engine}-dedup-a (1)', f'{engine}-dedup-b']
+    
+    spawn_server(engine=engine, dedup=True)
+    
+    for name in names[:2]:
+        res = put(f'/upload/{engine}-dedup-a', data=content.encode())
+        assert res.status_code == 201
+    res = post('/upload', files={ 'files': (names[2], content) })
+    assert res.status_code == 204
+    res = put(f'/upload/{engine}-dedup-c', data=b'different')
+    assert res.status_code == 201
+    
+    for name in names:
+        with open(name) as f: assert f.read() == content
+    assert len({ os.stat(name).st_ino for name in names }) == 1
+    assert os.stat(names[0]).st_nlink == 4
+    assert os.stat(f'{engine}-dedup-c').st_ino != os.stat(names[0]).st_ino
+    
+    # The object store can't be uploaded to
+    poisoned = hashlib.sha256(f'{engine}-poisoned'.encode()).hexdigest()
+    for state_directory in ('.uploadserver', '.UploadServer'):
+        res = put(f'/upload/{state_directory}/objects/{poisoned[:2]}/'
+            f'{poisoned}', data=b'evil')
+        assert res.status_code == 400
+    res = put(f'/upload/{engine}-dedup-poisoned',
+        data=f'{engine}-poisoned'.encode())
+    assert res.status_code == 201
+    with open(f'{engine}-dedup-poisoned') as f:
+        assert f.read() == f'{engine}-poisoned'
+    
+    # Content is kept while any upload links to it, and removed at startup
+    # once none do
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    object_path = Path('.uploadserver', 'objects', digest[:2], digest)
+    for name in names:
+        os.remove(name)
+        server_holder[0].terminate()
+        server_holder[0].wait(timeout=10)
+        spawn_server(engine=engine, dedup=True)
+        assert object_path.exists() == (name != names[-1])
+
+def make_archive(archive_format: str, files: dict) -> bytes:
+    buffer = io.BytesIO()
+    if archive_format == 'zip':
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+    else:
+        with tarfile.open(fileobj=buffer, mode='w:gz'
+        if archive_format == 'tar.gz' else 'w') as archive:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+    
+    return buffer.getvalue()
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('archive_format', ['tar', 'tar.gz', 'zip'])
+def test_upload_archive(engine, archive_format):
+    directory = f'{engine}-{archive_format}-archive'
+    archive = make_archive(archive_format, {
+        f'{directory}/a.txt': b'content-a',
+        f'{directory}/sub/b.txt': b'content-b',
+        f'../{directory}-escaped.txt': b'content-escaped',
+    })
+    
+    spawn_server(engine=engine)
+    
+    res = post(f'/upload?extract={archive_format}', data=archive)
+    assert res.status_code == 204
+    with open(f'{directory}/a.txt') as f: assert f.read() == 'content-a'
+    with open(f'{directory}/sub/b.txt') as f: assert f.read() == 'content-b'
+    assert not os.path.exists(f'../{directory}-escaped.txt')
+    assert not os.path.exists(f'{directory}-escaped.txt')
+    
+    # Same conflict policy as other uploads
+    res = post(f'/upload?extract={archive_format}', data=archive,
+        headers={ 'Accept': 'application/json' })
+    assert res.status_code == 200
+    assert res.json()['message'] == \
+        'Some filename(s) changed due to name conflict'
+    with open(f'{directory}/a (1).txt') as f: assert f.read() == 'content-a'
+    
+    res = post(f'/upload?extract={archive_format}', data=b'x'*1024)
+    assert res.status_code == 400
+    res = post('/upload?extract=rar', data=archive)
+    assert res.status_code == 400
+
+# Slow archive uploads on the asyncio engine must not hold up other requests,
+# and beyond a limit are turned away
+def test_upload_archive_stalled():
+    from uploadserver import asyncserver
+    spawn_server(engine='asyncio', worker_threads=2)
+    
+    stalled = []
+    try:
+        for i in range(asyncserver.MAX_ARCHIVE_EXTRACTIONS):
+            conn = connect()
+            conn.putrequest('POST', '/upload?extract=tar')
+            conn.putheader('Content-Length', '10240')
+            conn.endheaders()
+            conn.send(b'\0'*512)
+            stalled.append(conn)
+        time.sleep(0.5)
+        
+        assert get('/', timeout=5).status_code == 200
+        res = post('/upload?extract=tar', data=make_archive('tar', {
+            'stalled-archive-extra': b'content' }), timeout=5)
+        assert res.status_code == 503
+    finally:
+        for conn in stalled:
+            conn.close()
+    
+    time.sleep(0.5)
+    res = post('/upload?extract=tar', data=make_archive('tar', {
+        'stalled-archive-extra': b'content' }), timeout=5)
+    assert res.status_code == 204
+
 def test_upload_bad_path():
     spawn_server()
     
@@ -291,6 +571,902 @@ def test_multiple_upload():
     with open('file-1') as f: assert f.read() == 'file-content-1'
     with open('file-2') as f: assert f.read() == 'file-content-2'
 
+# Each file is committed when its part ends, so a body that is cut off part way
+# still keeps the files that arrived complete
+def test_upload_commits_each_part():
+    spawn_server()
+    
+    res = post('/upload', headers={
+        'Content-Type': 'multipart/form-data; boundary=xyz',
+    }, data=(b'--xyz\r\n'
+        b'Content-Disposition: form-data; name="files"; filename="part-1"\r\n'
+        b'\r\npart-1-content\r\n--xyz\r\n'
+        b'Content-Disposition: form-data; name="files"; filename="part-2"\r\n'
+        b'\r\npart-2-cont'))
+    assert res.status_code == 400
+    
+    with open('part-1') as f: assert f.read() == 'part-1-content'
+    assert not Path('part-2').exists()
+    assert next(Path('.').glob('tmp*'), None) is None
+
+# Files being uploaded must not show up in the upload directory, nor be left
+# behind when the client goes away
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_upload_file_hidden(engine):
+    spawn_server(engine=engine)
+    
+    conn = connect()
+    conn.putrequest('PUT', f'/upload/{engine}-hidden')
+    conn.putheader('Content-Length', '100')
+    conn.endheaders()
+    conn.send(b'x'*10)
+    time.sleep(0.2)
+    
+    before = set(os.listdir('.'))
+    assert next(Path('.').glob('tmp*'), None) is None
+    assert f'{engine}-hidden' not in get('/').text
+    
+    # Without O_TMPFILE, files being uploaded are in the staging directory,
+    # which is never served
+    for path in Path('.uploadserver', 'staging').glob('*'):
+        assert get(f'/{path.as_posix()}').status_code == 404
+    assert get('/.uploadserver/staging/').status_code == 404
+    conn.close()
+    time.sleep(0.2)
+    
+    assert set(os.listdir('.')) == before
+    assert not os.path.exists(f'{engine}-hidden')
+    assert not any(Path('.uploadserver', 'staging').glob('*'))
+    assert next(Path('.').glob('tmp*'), None) is None
+
+def test_keep_alive():
+    with open('keep-alive-file', 'wb') as f: f.write(b'keep-alive-content')
+    
+    spawn_server(protocol='HTTP/1.1', basic_auth_upload='foo:bar')
+    
+    conn = connect()
+    conn.request('GET', '/')
+    res = conn.getresponse()
+    assert res.status == 200
+    assert b'<!-- Injected by uploadserver -->' in res.read()
+    sock = conn.sock
+    
+    conn.request('HEAD', '/')
+    res = conn.getresponse()
+    assert res.status == 200
+    res.read()
+    
+    conn.request('GET', '/keep-alive-file')
+    res = conn.getresponse()
+    assert res.status == 200
+    assert res.read() == b'keep-alive-content'
+    
+    conn.request('PUT', '/upload/keep-alive-upload', body=b'content')
+    res = conn.getresponse()
+    assert res.status == 401
+    res.read()
+    
+    auth = 'Basic ' + base64.b64encode(b'foo:bar').decode()
+    conn.request('PUT', '/upload/keep-alive-upload', body=b'content',
+        headers={ 'Authorization': auth })
+    res = conn.getresponse()
+    assert res.status == 201
+    res.read()
+    
+    conn.request('GET', '/upload', headers={ 'Authorization': auth })
+    res = conn.getresponse()
+    assert res.status == 200
+    res.read()
+    
+    conn.request('PUT', '/upload/keep-alive-chunked',
+        body=iter([b'chunked-', b'content']), encode_chunked=True,
+        headers={ 'Authorization': auth })
+    res = conn.getresponse()
+    assert res.status == 201
+    res.read()
+    
+    assert conn.sock is sock
+    conn.close()
+    
+    with open('keep-alive-upload') as f: assert f.read() == 'content'
+    with open('keep-alive-chunked') as f: assert f.read() == 'chunked-content'
+
+# A body the server has no use for must not be taken for the next request
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_keep_alive_unread_body(engine):
+    with open('unread-body-file', 'wb') as f: f.write(b'unread-body-content')
+    
+    spawn_server(protocol='HTTP/1.1', engine=engine)
+    
+    def pipeline(*requests: bytes) -> list:
+        conn = connect()
+        conn.connect()
+        conn.sock.settimeout(5)
+        conn.sock.sendall(b''.join(requests))
+        
+        data = b''
+        while chunk := conn.sock.recv(65536):
+            data += chunk
+        conn.close()
+        
+        return [response[:3] for response in data.split(b'HTTP/1.1 ')[1:]]
+    
+    statuses = pipeline(
+        b'GET /unread-body-file HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello',
+        b'GET /unread-body-file HTTP/1.1\r\nConnection: close\r\n\r\n')
+    assert statuses == ([b'200', b'200'] if engine == 'threading'
+        else [b'200'])
+    
+    statuses = pipeline(
+        b'GET /unread-body-file HTTP/1.1\r\nTransfer-Encoding: chunked\r\n'
+        b'\r\n5\r\nhello\r\n0\r\n\r\n',
+        b'GET /unread-body-file HTTP/1.1\r\nConnection: close\r\n\r\n')
+    assert statuses == [b'200']
+
+@pytest.mark.parametrize('protocol', ['HTTP/1.0', 'HTTP/1.1'])
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_expect_100_continue_rejection(protocol, engine):
+    spawn_server(protocol=protocol, engine=engine, basic_auth_upload='foo:bar')
+    auth = { 'Authorization': 'Basic ' + base64.b64encode(b'foo:bar').decode() }
+    
+    assert expect_100('PUT', '/upload/expect-file').startswith(b'401')
+    assert expect_100('PUT', '/upload/../expect-file', auth) \
+        .startswith(b'400')
+    assert expect_100('PUT', '/upload/expect-file', auth, length=10**18) \
+        .startswith(b'507')
+    assert expect_100('POST', '/upload', auth).startswith(b'400')
+    assert expect_100('POST', '/upload', { 'Content-Type':
+        'multipart/form-data; boundary=xyz', **auth }, length=10**18) \
+        .startswith(b'507')
+    assert expect_100('POST', '/elsewhere', auth).startswith(b'404')
+
+def test_expect_100_continue():
+    spawn_server(protocol='HTTP/1.1')
+    
+    conn = connect()
+    conn.putrequest('PUT', '/upload/expect-continue-file')
+    conn.putheader('Content-Length', '16')
+    conn.putheader('Expect', '100-continue')
+    conn.endheaders()
+    
+    status_line = conn.sock.makefile('rb').readline()
+    assert status_line == b'HTTP/1.1 100 Continue\r\n'
+    
+    conn.send(b'expect-continued')
+    res = conn.getresponse()
+    assert res.status == 201
+    conn.close()
+    
+    with open('expect-continue-file') as f:
+        assert f.read() == 'expect-continued'
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_max_request_size(engine):
+    spawn_server(engine=engine, max_request_size='1K')
+    
+    res = put(f'/upload/{engine}-request-size-ok', data=b'x'*1024)
+    assert res.status_code == 201
+    
+    res = put(f'/upload/{engine}-request-size-big', data=b'x'*1025)
+    assert res.status_code == 413
+    
+    # Without a Content-Length, the body is cut off once it crosses the limit
+    res = put(f'/upload/{engine}-request-size-chunked',
+        data=iter([b'x'*1000, b'x'*1000]))
+    assert res.status_code == 413
+    
+    res = post('/upload', files={
+        'files': (f'{engine}-request-size-multipart', b'x'*1024),
+    })
+    assert res.status_code == 413
+    
+    assert os.path.exists(f'{engine}-request-size-ok')
+    assert not os.path.exists(f'{engine}-request-size-big')
+    assert not os.path.exists(f'{engine}-request-size-chunked')
+    assert not os.path.exists(f'{engine}-request-size-multipart')
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_max_file_size(engine):
+    spawn_server(engine=engine, max_file_size='100')
+    
+    res = put(f'/upload/{engine}-file-size-big', data=b'x'*101)
+    assert res.status_code == 413
+    
+    res = post('/upload', files=[
+        ('files', (f'{engine}-file-size-small', b'x'*100)),
+        ('files', (f'{engine}-file-size-multipart', b'x'*101)),
+    ])
+    assert res.status_code == 413
+    
+    assert not os.path.exists(f'{engine}-file-size-big')
+    with open(f'{engine}-file-size-small', 'rb') as f:
+        assert f.read() == b'x'*100
+    assert not os.path.exists(f'{engine}-file-size-multipart')
+
+# Parts that give a length are preallocated, which must not leave them any
+# longer than what was actually sent
+def test_upload_part_length():
+    spawn_server(max_file_size='1M')
+    
+    res = post('/upload', files=[
+        ('files', ('part-length', 'content', 'text/plain',
+            { 'Content-Length': '10' })),
+    ])
+    assert res.status_code == 204
+    with open('part-length', 'rb') as f: assert f.read() == b'content'
+    
+    # A part can't be longer than the body it's in
+    res = post('/upload', files=[
+        ('files', ('part-length-long', 'content', 'text/plain',
+            { 'Content-Length': '100000' })),
+    ])
+    assert res.status_code == 400
+    assert not os.path.exists('part-length-long')
+    
+    # Chunked bodies could be any length, so the part's length isn't checked
+    res = post('/upload', data=iter([b'--xyz\r\nContent-Disposition: '
+        b'form-data; name="files"; filename="part-length-chunked"\r\n'
+        b'Content-Length: 100000\r\n\r\ncontent\r\n--xyz--\r\n']),
+        headers={ 'Content-Type': 'multipart/form-data; boundary=xyz' })
+    assert res.status_code == 204
+    with open('part-length-chunked', 'rb') as f: assert f.read() == b'content'
+    
+    res = post('/upload', files=[
+        ('files', ('part-length-big', 'content', 'text/plain',
+            { 'Content-Length': str(2*1024*1024) })),
+    ])
+    assert res.status_code == 413
+    assert not os.path.exists('part-length-big')
+
+def test_max_files_per_request():
+    spawn_server(max_files_per_request=2)
+    
+    res = post('/upload', files=[
+        ('files', ('files-per-request-1', 'content-1')),
+        ('files', ('files-per-request-2', 'content-2')),
+        ('files', ('files-per-request-3', 'content-3')),
+    ])
+    assert res.status_code == 413
+    
+    assert os.path.exists('files-per-request-1')
+    assert os.path.exists('files-per-request-2')
+    assert not os.path.exists('files-per-request-3')
+
+# An upload that doesn't fit in the budget waits for the one in its way
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_max_inflight_bytes(engine):
+    spawn_server(engine=engine, max_inflight_bytes='1M')
+    
+    first = connect()
+    first.putrequest('PUT', f'/upload/{engine}-inflight-1')
+    first.putheader('Content-Length', str(800*1024))
+    first.endheaders()
+    first.send(b'x'*1024)
+    
+    # Let the server start receiving the first upload
+    time.sleep(0.5)
+    
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        second = executor.submit(put, f'/upload/{engine}-inflight-2',
+            data=b'y'*(800*1024))
+        
+        time.sleep(0.5)
+        assert not second.done()
+        
+        first.send(b'x'*(799*1024))
+        assert first.getresponse().status == 201
+        first.close()
+        
+        assert second.result(timeout=5).status_code == 201
+    
+    with open(f'{engine}-inflight-2', 'rb') as f:
+        assert f.read() == b'y'*(800*1024)
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_upload_hash(engine):
+    spawn_server(engine=engine, hash='sha256', hash_sidecar=True)
+    
+    file_content = os.urandom(3*1024*1024 + 5)
+    digest = hashlib.sha256(file_content)
+    
+    res = put(f'/upload/{engine}-hash-put', data=file_content)
+    assert res.status_code == 201
+    assert res.headers['Upload-Digest'] == \
+        f'sha256={digest.hexdigest()}; path="/{engine}-hash-put"'
+    
+    with open(f'{engine}-hash-put.sha256') as f:
+        assert f.read() == f'{digest.hexdigest()}  {engine}-hash-put\n'
+    
+    repr_digest = f'sha-256=:{base64.b64encode(digest.digest()).decode()}:'
+    res = get(f'/{engine}-hash-put')
+    assert res.content == file_content
+    assert res.headers['Repr-Digest'] == repr_digest
+    res = get(f'/{engine}-hash-put', headers={ 'Range': 'bytes=0-9' })
+    assert res.status_code == 206
+    assert res.headers['Repr-Digest'] == repr_digest
+    
+    res = post('/upload', headers={ 'Accept': 'application/json' }, files=[
+        ('files', (f'{engine}-hash-1', 'hash-content-1')),
+        ('files', (f'{engine}-hash-2', 'hash-content-2')),
+    ])
+    assert res.status_code == 200
+    assert res.json()['files'] == [{
+        'path': f'/{engine}-hash-{i}',
+        'size': 14,
+        'sha256': hashlib.sha256(f'hash-content-{i}'.encode()).hexdigest(),
+    } for i in (1, 2)]
+    
+    # A file replaced without a digest must not keep the old one
+    with open(f'{engine}-hash-1', 'w') as f: f.write('changed')
+    os.utime(f'{engine}-hash-1', (time.time() + 10, time.time() + 10))
+    assert 'Repr-Digest' not in get(f'/{engine}-hash-1').headers
+    
+    # Files that only look like sidecars by name are left alone
+    res = put(f'/upload/{engine}-hash-report.sha256', data=b'user-content')
+    assert res.status_code == 201
+    res = put(f'/upload/{engine}-hash-report', data=b'report-content')
+    assert res.status_code == 201
+    with open(f'{engine}-hash-report.sha256') as f:
+        assert f.read() == 'user-content'
+    
+    # Sidecars from earlier files of the same name are replaced
+    os.remove(f'{engine}-hash-put')
+    res = put(f'/upload/{engine}-hash-put', data=b'new-content')
+    assert res.status_code == 201
+    with open(f'{engine}-hash-put.sha256') as f:
+        assert f.read() == \
+            f'{hashlib.sha256(b"new-content").hexdigest()}  {engine}-hash-put\n'
+
+def test_upload_hash_crc32():
+    spawn_server(hash='crc32')
+    
+    res = put('/upload/crc32-put', data=b'crc32-content')
+    assert res.status_code == 201
+    assert res.headers['Upload-Digest'] == \
+        f'crc32={zlib.crc32(b"crc32-content"):08x}; path="/crc32-put"'
+    
+    assert not os.path.exists('crc32-put.crc32')
+    assert 'Repr-Digest' not in get('/crc32-put').headers
+
+def content_digest(data: bytes) -> str:
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+    return f'sha-256=:{digest}:'
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_upload_digest_verification(engine):
+    spawn_server(engine=engine)
+    
+    file_content = os.urandom(2*1024*1024 + 3)
+    
+    res = put(f'/upload/{engine}-digest-good', data=file_content,
+        headers={ 'Content-Digest': content_digest(file_content) })
+    assert res.status_code == 201
+    with open(f'{engine}-digest-good', 'rb') as f:
+        assert f.read() == file_content
+    
+    res = put(f'/upload/{engine}-digest-bad', data=file_content,
+        headers={ 'Content-Digest': content_digest(b'something else') })
+    assert res.status_code == 422
+    assert not os.path.exists(f'{engine}-digest-bad')
+    
+    md5 = base64.b64encode(hashlib.md5(b'md5-content').digest()).decode()
+    res = put(f'/upload/{engine}-digest-md5', data=b'md5-content',
+        headers={ 'Content-MD5': md5 })
+    assert res.status_code == 201
+    res = put(f'/upload/{engine}-digest-md5-bad', data=b'md5-contenT',
+        headers={ 'Content-MD5': md5 })
+    assert res.status_code == 422
+    assert not os.path.exists(f'{engine}-digest-md5-bad')
+    
+    res = put(f'/upload/{engine}-digest-malformed', data=b'content',
+        headers={ 'Content-Digest': 'sha-256=:not base64:' })
+    assert res.status_code == 400
+    assert not os.path.exists(f'{engine}-digest-malformed')
+    
+    # Per-part digests, in part headers or a digest field before the file
+    res = post('/upload', files=[
+        ('files', (f'{engine}-digest-part', 'part-content', 'text/plain',
+            { 'Content-Digest': content_digest(b'part-content') })),
+        ('digest', (None, hashlib.sha256(b'field-content').hexdigest())),
+        ('files', (f'{engine}-digest-field', 'field-content')),
+    ])
+    assert res.status_code == 204
+    with open(f'{engine}-digest-part') as f: assert f.read() == 'part-content'
+    with open(f'{engine}-digest-field') as f: assert f.read() == 'field-content'
+    
+    res = post('/upload', files=[
+        ('digest', (None, 'sha-256=' + hashlib.sha256(b'x').hexdigest())),
+        ('files', (f'{engine}-digest-field-bad', 'field-content')),
+    ])
+    assert res.status_code == 422
+    assert not os.path.exists(f'{engine}-digest-field-bad')
+    
+    # A digest of the whole body holds back every file until it is verified
+    body, content_type = urllib3.encode_multipart_formdata([
+        ('files', (f'{engine}-digest-body-1', b'body-content-1')),
+        ('files', (f'{engine}-digest-body-2', b'body-content-2')),
+    ])
+    res = post('/upload', data=body, headers={ 'Content-Type': content_type,
+        'Content-Digest': content_digest(body + b'!') })
+    assert res.status_code == 422
+    assert not os.path.exists(f'{engine}-digest-body-1')
+    assert not os.path.exists(f'{engine}-digest-body-2')
+    
+    res = post('/upload', data=body, headers={ 'Content-Type': content_type,
+        'Content-Digest': content_digest(body) })
+    assert res.status_code == 204
+    with open(f'{engine}-digest-body-2') as f:
+        assert f.read() == 'body-content-2'
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_upload_session(engine):
+    spawn_server(engine=engine, hash='sha256')
+    
+    file_content = os.urandom(3*1024*1024 + 7)
+    split = 1024*1024 + 1
+    
+    res = post(f'/upload/session?path={engine}-session/resumed',
+        headers={ 'Upload-Length': str(len(file_content)) })
+    assert res.status_code == 201
+    assert res.headers['Upload-Offset'] == '0'
+    session = res.headers['Location']
+    
+    res = patch(session, data=file_content[:split],
+        headers={ 'Upload-Offset': '0' })
+    assert res.status_code == 204
+    assert res.headers['Upload-Offset'] == str(split)
+    
+    res = patch(session, data=b'x', headers={ 'Upload-Offset': '0' })
+    assert res.status_code == 409
+    
+    # Sessions outlive the server
+    server_holder[0].terminate()
+    server_holder[0].wait(timeout=10)
+    spawn_server(engine=engine, hash='sha256')
+    
+    res = head(session)
+    assert res.status_code == 204
+    assert res.headers['Upload-Offset'] == str(split)
+    assert res.headers['Upload-Length'] == str(len(file_content))
+    
+    # Session IDs and data are never served
+    session_id = session.rsplit('/', 1)[1]
+    assert Path('.uploadserver', f'{session_id}.part').exists()
+    for path in ('/.uploadserver', '/.uploadserver/',
+    f'/.uploadserver/{session_id}.part', f'/.uploadserver/{session_id}.json'):
+        assert get(path, allow_redirects=False).status_code == 404
+    res = get('/')
+    assert int(res.headers['Content-Length']) == len(res.content)
+    assert '.uploadserver' not in res.text
+    
+    res = patch(session, data=file_content[split:], headers={
+        'Upload-Offset': str(split),
+        'Content-Digest': content_digest(b'something else'),
+    })
+    assert res.status_code == 422
+    assert head(session).headers['Upload-Offset'] == str(split)
+    
+    res = patch(session, data=file_content[split:], headers={
+        'Upload-Offset': str(split),
+        'Content-Digest': content_digest(file_content[split:]),
+    })
+    assert res.status_code == 201
+    assert res.headers['Location'] == f'/{engine}-session/resumed'
+    assert res.headers['Upload-Digest'] == (f'sha256='
+        f'{hashlib.sha256(file_content).hexdigest()}; '
+        f'path="/{engine}-session/resumed"')
+    with open(f'{engine}-session/resumed', 'rb') as f:
+        assert f.read() == file_content
+    
+    assert head(session).status_code == 404
+    assert patch(session, data=b'x',
+        headers={ 'Upload-Offset': '0' }).status_code == 404
+    
+    # Finished sessions are committed like any other upload
+    res = post(f'/upload/session?path={engine}-session/resumed',
+        headers={ 'Upload-Length': '7' })
+    res = patch(res.headers['Location'], data=b'content',
+        headers={ 'Upload-Offset': '0' })
+    assert res.status_code == 201
+    with open(f'{engine}-session/resumed (1)') as f:
+        assert f.read() == 'content'
+    
+    res = post(f'/upload/session?path={engine}-session/too-long',
+        headers={ 'Upload-Length': '3' })
+    session = res.headers['Location']
+    res = patch(session, data=b'four', headers={ 'Upload-Offset': '0' })
+    assert res.status_code == 413
+    assert delete(session).status_code == 204
+    assert head(session).status_code == 404
+    assert not os.path.exists(f'{engine}-session/too-long')
+    
+    assert post('/upload/session?path=../escape',
+        headers={ 'Upload-Length': '3' }).status_code == 400
+    assert post(f'/upload/session?path={engine}-session/no-length'
+        ).status_code == 400
+
+# Session requests have no use for a body, which must not end up taken for the
+# next request
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_upload_session_keep_alive(engine):
+    spawn_server(protocol='HTTP/1.1', engine=engine)
+    
+    conn = connect()
+    conn.request('POST', f'/upload/session?path={engine}-session-keep-alive',
+        body=b'hello', headers={ 'Upload-Length': '3' })
+    res = conn.getresponse()
+    assert res.status == 201
+    res.read()
+    session = res.headers['Location']
+    sock = conn.sock
+    
+    for method in ('HEAD', 'DELETE'):
+        conn.request(method, session, body=b'hello')
+        res = conn.getresponse()
+        assert res.status == 204
+        res.read()
+    
+    conn.request('GET', '/')
+    res = conn.getresponse()
+    assert res.status == 200
+    res.read()
+    
+    assert conn.sock is sock
+    conn.close()
+
+def test_upload_session_expiry():
+    spawn_server(session_lifetime=0.5)
+    
+    res = post('/upload/session?path=session-expired',
+        headers={ 'Upload-Length': '10' })
+    session = res.headers['Location']
+    assert head(session).status_code == 204
+    
+    time.sleep(1)
+    assert head(session).status_code == 404
+    res = patch(session, data=b'x', headers={ 'Upload-Offset': '0' })
+    assert res.status_code == 404
+    assert not any(path.name.startswith(session.split('/')[-1])
+        for path in Path('.uploadserver').iterdir())
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_ranged_upload(engine):
+    spawn_server(engine=engine, hash='sha256')
+    
+    file_content = os.urandom(4*1024*1024 + 11)
+    range_size = 512*1024
+    ranges = [(first, min(first + range_size, len(file_content)) - 1)
+        for first in range(0, len(file_content), range_size)]
+    # Out of order, as parallel ranges may well arrive
+    ranges = ranges[1::2] + ranges[::2]
+    
+    def put_range(upload_range: tuple) -> requests.Response:
+        first, last = upload_range
+        return put(f'/upload/{engine}-ranged',
+            data=file_content[first:last + 1], headers={
+                'Content-Range': f'bytes {first}-{last}/{len(file_content)}',
+                'Upload-Key': 'key-1',
+            })
+    
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(put_range, ranges))
+    
+    assert sorted(res.status_code for res in results) == \
+        [201] + [202]*(len(ranges) - 1)
+    res = next(res for res in results if res.status_code == 201)
+    assert res.headers['Location'] == f'/{engine}-ranged'
+    assert res.headers['Upload-Digest'] == (f'sha256='
+        f'{hashlib.sha256(file_content).hexdigest()}; path="/{engine}-ranged"')
+    with open(f'{engine}-ranged', 'rb') as f:
+        assert f.read() == file_content
+    
+    # Other uploads to the same path, with another key, are kept apart
+    res = put(f'/upload/{engine}-ranged-keys', data=b'abc',
+        headers={ 'Content-Range': 'bytes 0-2/6', 'Upload-Key': 'key-1' })
+    assert res.status_code == 202
+    res = put(f'/upload/{engine}-ranged-keys', data=b'XYZ',
+        headers={ 'Content-Range': 'bytes 3-5/6', 'Upload-Key': 'key-2' })
+    assert res.status_code == 202
+    res = put(f'/upload/{engine}-ranged-keys', data=b'def',
+        headers={ 'Content-Range': 'bytes 3-5/6', 'Upload-Key': 'key-1' })
+    assert res.status_code == 201
+    with open(f'{engine}-ranged-keys') as f: assert f.read() == 'abcdef'
+    
+    bad_key = { 'Upload-Key': 'key-bad' }
+    assert put(f'/upload/{engine}-ranged-bad', data=b'abc', headers={
+        'Content-Range': 'bytes 0-3/6', **bad_key }).status_code == 400
+    assert put(f'/upload/{engine}-ranged-bad', data=b'abc', headers={
+        'Content-Range': 'bytes 4-6/6', **bad_key }).status_code == 400
+    assert put(f'/upload/{engine}-ranged-bad', data=b'abc', headers={
+        'Content-Range': 'bytes */6', **bad_key }).status_code == 400
+    
+    # Ranges without a key can't be told apart from other uploads' ranges
+    res = put(f'/upload/{engine}-ranged-bad', data=b'abc',
+        headers={ 'Content-Range': 'bytes 0-2/6' })
+    assert res.status_code == 400
+    assert expect_100('PUT', f'/upload/{engine}-ranged-bad',
+        { 'Content-Range': 'bytes 0-9/20' }).startswith(b'400')
+    assert not os.path.exists(f'{engine}-ranged-bad')
+
+def get_server_timing(res: requests.Response) -> dict:
+    return { metric.split(';')[0]: float(metric.split('dur=')[1])
+        for metric in res.headers['Server-Timing'].split(', ') }
+
+@pytest.mark.parametrize('durability', ['none', 'file'])
+def test_durability(durability):
+    spawn_server(durability=durability)
+    
+    res = put(f'/upload/durability-{durability}', data='content')
+    assert res.status_code == 201
+    with open(f'durability-{durability}') as f: assert f.read() == 'content'
+    
+    timing = get_server_timing(res)
+    assert 'commit' in timing
+    assert ('fsync' in timing) == (durability == 'file')
+    
+    res = post('/upload', files=[
+        ('files', (f'durability-{durability}-1', 'content-1')),
+        ('files', (f'durability-{durability}-2', 'content-2')),
+    ])
+    assert res.status_code == 204
+    assert ('fsync' in get_server_timing(res)) == (durability == 'file')
+
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+def test_durability_group(engine):
+    spawn_server(engine=engine, durability='group', group_commit_window=0.2)
+    
+    # Uploads within the window share one batch, so none waits for another
+    # batch after its own
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: put(f'/upload/{engine}-group-{i}',
+            data=f'group-content-{i}'), range(8)))
+    
+    for i, res in enumerate(results):
+        assert res.status_code == 201
+        with open(f'{engine}-group-{i}') as f:
+            assert f.read() == f'group-content-{i}'
+        
+        timing = get_server_timing(res)
+        assert timing['group-wait'] <= 400
+        assert 'fsync' in timing
+    
+    assert max(get_server_timing(res)['group-wait'] for res in results) >= 150
+
+# A client that connects but never sends anything (or never starts the TLS
+# handshake) must not hold up anyone else
+def test_stalled_connection():
+    spawn_server()
+    
+    stalled = socket.create_connection(('127.0.0.1', 8000))
+    try:
+        assert get('/', timeout=5).status_code == 200
+    finally:
+        stalled.close()
+
+def test_worker_threads():
+    spawn_server(worker_threads=2)
+    
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: put(f'/upload/worker-{i}',
+            data=f'worker-content-{i}'), range(16)))
+    
+    assert all(res.status_code == 201 for res in results)
+    for i in range(16):
+        with open(f'worker-{i}') as f: assert f.read() == f'worker-content-{i}'
+
+def test_max_connections():
+    spawn_server(worker_threads=1, max_connections=1)
+    
+    # Let the server finish with the connection spawn_server() checked it with
+    time.sleep(0.2)
+    
+    stalled = socket.create_connection(('127.0.0.1', 8000))
+    try:
+        # Give the server time to accept the stalled connection
+        time.sleep(0.2)
+        
+        if PROTOCOL == 'HTTP':
+            res = get('/', timeout=5)
+            assert res.status_code == 503
+            assert res.headers['Retry-After'] == '1'
+        else:
+            with pytest.raises(requests.ConnectionError): get('/', timeout=5)
+    finally:
+        stalled.close()
+    
+    time.sleep(0.2)
+    assert get('/', timeout=5).status_code == 200
+
+# With a worker pool, connections are capped at worker threads plus backlog
+def test_max_connections_default():
+    spawn_server(worker_threads=1, backlog=1)
+    
+    time.sleep(0.2)
+    
+    stalled = [socket.create_connection(('127.0.0.1', 8000)) for _ in range(2)]
+    try:
+        time.sleep(0.2)
+        
+        if PROTOCOL == 'HTTP':
+            res = get('/', timeout=5)
+            assert res.status_code == 503
+        else:
+            with pytest.raises(requests.ConnectionError): get('/', timeout=5)
+    finally:
+        for connection in stalled:
+            connection.close()
+    
+    time.sleep(0.2)
+    assert get('/', timeout=5).status_code == 200
+
+# Connections that never send a request mustn't hold on to a worker thread
+def test_idle_connection_timeout():
+    spawn_server(worker_threads=1, protocol='HTTP/1.1')
+    
+    time.sleep(0.2)
+    
+    idle = socket.create_connection(('127.0.0.1', 8000))
+    try:
+        idle.settimeout(KEEP_ALIVE_TIMEOUT + 5)
+        assert idle.recv(1) == b''
+    finally:
+        idle.close()
+    
+    assert get('/', timeout=5).status_code == 200
+
+def get_worker_processes() -> list:
+    res = subprocess.run(['pgrep', '-P', str(server_holder[0].pid)],
+        capture_output=True, text=True)
+    return [int(pid) for pid in res.stdout.split()]
+
+if hasattr(os, 'fork'):
+    def test_processes():
+        spawn_server(processes=3)
+        
+        workers = get_worker_processes()
+        assert len(workers) == 3
+        
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda i: put(f'/upload/process-{i}',
+                data=f'process-content-{i}'), range(16)))
+        assert all(res.status_code == 201 for res in results)
+        
+        # A worker that dies is replaced, and the others keep serving meanwhile
+        os.kill(workers[0], signal.SIGKILL)
+        for i in range(16):
+            res = get(f'/process-{i}')
+            assert res.status_code == 200
+            assert res.text == f'process-content-{i}'
+        
+        for _ in range(50):
+            if len(get_worker_processes()) == 3: break
+            time.sleep(0.1)
+        assert len(get_worker_processes()) == 3
+        assert workers[0] not in get_worker_processes()
+        
+        # Stopping the supervisor stops every worker
+        server_holder[0].terminate()
+        server_holder[0].wait(timeout=10)
+        for pid in workers[1:]:
+            with pytest.raises(ProcessLookupError): os.kill(pid, 0)
+
+def test_asyncio_engine():
+    with open('asyncio-file', 'wb') as f: f.write(b'0123456789')
+    
+    spawn_server(engine='asyncio', protocol='HTTP/1.1',
+        basic_auth_upload='foo:bar')
+    auth = 'Basic ' + base64.b64encode(b'foo:bar').decode()
+    
+    conn = connect()
+    conn.request('GET', '/')
+    res = conn.getresponse()
+    assert res.status == 200
+    assert b'<!-- Injected by uploadserver -->' in res.read()
+    sock = conn.sock
+    
+    conn.request('GET', '/asyncio-file', headers={ 'Range': 'bytes=2-5' })
+    res = conn.getresponse()
+    assert res.status == 206
+    assert res.read() == b'2345'
+    
+    conn.request('GET', '/upload')
+    res = conn.getresponse()
+    assert res.status == 401
+    res.read()
+    
+    conn.request('GET', '/upload', headers={ 'Authorization': auth })
+    res = conn.getresponse()
+    assert res.status == 200
+    res.read()
+    
+    file_content = os.urandom(5*1024*1024 + 123)
+    conn.request('PUT', '/upload/asyncio-put', body=file_content,
+        headers={ 'Authorization': auth })
+    res = conn.getresponse()
+    assert res.status == 201
+    res.read()
+    
+    conn.request('PUT', '/upload/asyncio-dir/asyncio-chunked',
+        body=iter([b'chunked-', b'content']), encode_chunked=True,
+        headers={ 'Authorization': auth })
+    res = conn.getresponse()
+    assert res.status == 201
+    res.read()
+    
+    assert conn.sock is sock
+    conn.close()
+    
+    res = post('/upload', auth=('foo', 'bar'), files=[
+        ('files', ('asyncio-1', 'asyncio-content-1')),
+        ('files', ('asyncio-2', 'asyncio-content-2')),
+    ])
+    assert res.status_code == 204
+    
+    with open('asyncio-put', 'rb') as f: assert f.read() == file_content
+    with open('asyncio-dir/asyncio-chunked') as f:
+        assert f.read() == 'chunked-content'
+    with open('asyncio-1') as f: assert f.read() == 'asyncio-content-1'
+    with open('asyncio-2') as f: assert f.read() == 'asyncio-content-2'
+
+# Idle connections cost the asyncio engine no threads, and don't get in the way
+def test_asyncio_engine_idle_connections():
+    spawn_server(engine='asyncio')
+    
+    idle = [socket.create_connection(('127.0.0.1', 8000)) for _ in range(200)]
+    try:
+        res = put('/upload/asyncio-idle', data='asyncio-idle-content',
+            timeout=5)
+        assert res.status_code == 201
+        assert get('/asyncio-idle', timeout=5).text == 'asyncio-idle-content'
+    finally:
+        for sock in idle: sock.close()
+
+# Binary content with many line breaks and near-miss boundaries must come
+# through byte for byte
+def test_binary_upload():
+    spawn_server()
+    
+    file_content = bytes(range(256)) * 64 + b'\r\n--\r\n\r\r\n-' * 1000
+    
+    res = post('/upload', files={
+        'files': ('binary-file', file_content),
+    })
+    assert res.status_code == 204
+    
+    with open('binary-file', 'rb') as f: assert f.read() == file_content
+
+# The multipart parser must give the same result no matter how the body is split
+# into chunks
+def test_multipart_parser_chunking():
+    body = (b'preamble\r\n--xyz\r\n'
+        b'Content-Disposition: form-data; name="files"; filename="a.txt"\r\n'
+        b'Content-Type: text/plain\r\n\r\n'
+        b'line 1\r\n--xy\r\n\r\r\n-xyz\r\n--x'
+        b'\r\n--xyz\r\n'
+        b'Content-Disposition: form-data; name="other"\r\n\r\n'
+        b'value\r\n--xyz--\r\nepilogue')
+    
+    for chunk_size in range(1, len(body) + 1):
+        parser = multipart.MultipartParser(b'xyz')
+        events = []
+        for i in range(0, len(body), chunk_size):
+            events += parser.feed(body[i:i + chunk_size])
+        parser.close()
+        
+        starts = [e for e in events if isinstance(e, multipart.PartStart)]
+        assert [(e.name, e.filename) for e in starts] == \
+            [('files', 'a.txt'), ('other', None)]
+        
+        data = b''.join(e.data if isinstance(e, multipart.PartData) else b'|'
+            for e in events if not isinstance(e, multipart.PartStart))
+        assert data == b'line 1\r\n--xy\r\n\r\r\n-xyz\r\n--x|value|'
+
+def test_multipart_parser_truncated():
+    parser = multipart.MultipartParser(b'xyz')
+    parser.feed(b'--xyz\r\nContent-Disposition: form-data; name="files"\r\n')
+    
+    with pytest.raises(multipart.MultipartError): parser.close()
+
 # Uploads large enough to need a temp file have slightly different handling that
 # needs to be tested
 def test_large_upload():
@@ -363,6 +1539,136 @@ def test_with_theme_light():
     
     with open('theme-light-file') as f: assert f.read() == 'content-for-light'
 
+def test_download():
+    file_content = os.urandom(3*1024*1024 + 45)
+    with open('download-file', 'wb') as f: f.write(file_content)
+    
+    spawn_server()
+    
+    res = get('/download-file')
+    assert res.status_code == 200
+    assert res.content == file_content
+
+def test_download_cgi():
+    with open('download-file-cgi', 'wb') as f: f.write(b'cgi-content')
+    
+    spawn_server(cgi=True)
+    
+    res = get('/download-file-cgi')
+    assert res.status_code == 200
+    assert res.content == b'cgi-content'
+
+def test_download_range():
+    with open('range-file', 'wb') as f: f.write(b'0123456789')
+    
+    spawn_server()
+    
+    res = get('/range-file')
+    assert res.headers['Accept-Ranges'] == 'bytes'
+    
+    res = get('/range-file', headers={ 'Range': 'bytes=2-5' })
+    assert res.status_code == 206
+    assert res.headers['Content-Range'] == 'bytes 2-5/10'
+    assert res.content == b'2345'
+    
+    res = get('/range-file', headers={ 'Range': 'bytes=-3' })
+    assert res.status_code == 206
+    assert res.content == b'789'
+    
+    res = get('/range-file', headers={ 'Range': 'bytes=7-' })
+    assert res.status_code == 206
+    assert res.content == b'789'
+    
+    res = get('/range-file', headers={ 'Range': 'bytes=20-' })
+    assert res.status_code == 416
+    assert res.headers['Content-Range'] == 'bytes */10'
+    
+    res = get('/range-file', headers={ 'Range': 'bytes=oops' })
+    assert res.status_code == 200
+    assert res.content == b'0123456789'
+    
+    with open('empty-range-file', 'wb'): pass
+    res = get('/empty-range-file', headers={ 'Range': 'bytes=-5' })
+    assert res.status_code == 416
+    assert res.headers['Content-Range'] == 'bytes */0'
+
+def test_download_multiple_ranges():
+    with open('multirange-file', 'wb') as f: f.write(b'0123456789')
+    
+    spawn_server()
+    
+    res = get('/multirange-file', headers={ 'Range': 'bytes=0-1,5-6,6-7' })
+    assert res.status_code == 206
+    assert int(res.headers['Content-Length']) == len(res.content)
+    
+    content_type, boundary = res.headers['Content-Type'].split('; boundary=')
+    assert content_type == 'multipart/byteranges'
+    parts = res.content.split(b'--' + boundary.encode())
+    assert len(parts) == 4
+    assert parts[1].endswith(b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n')
+    assert parts[2].endswith(b'Content-Range: bytes 5-7/10\r\n\r\n567\r\n')
+    assert parts[3] == b'--\r\n'
+
+def test_download_if_range():
+    with open('if-range-file', 'wb') as f: f.write(b'0123456789')
+    
+    spawn_server()
+    
+    last_modified = get('/if-range-file').headers['Last-Modified']
+    
+    res = get('/if-range-file', headers={
+        'Range': 'bytes=5-',
+        'If-Range': last_modified,
+    })
+    assert res.status_code == 206
+    assert res.content == b'56789'
+    
+    res = get('/if-range-file', headers={
+        'Range': 'bytes=5-',
+        'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT',
+    })
+    assert res.status_code == 200
+    assert res.content == b'0123456789'
+
+@pytest.mark.parametrize('protocol', ['HTTP/1.0', 'HTTP/1.1'])
+@pytest.mark.parametrize('engine', ['threading', 'asyncio'])
+@pytest.mark.parametrize('archive_format', ['tar', 'tar.gz', 'zip'])
+def test_download_archive(archive_format, engine, protocol):
+    directory = f'{engine}-{protocol[-3:]}-{archive_format}-download'
+    files = {
+        'a.txt': b'content-a',
+        'sub/b.bin': os.urandom(3*1024*1024 + 45),
+        'sub/empty': b'',
+    }
+    for name, content in files.items():
+        Path(directory, name).parent.mkdir(parents=True, exist_ok=True)
+        with open(Path(directory, name), 'wb') as f: f.write(content)
+    os.mkdir(Path(directory, 'empty-dir'))
+    
+    spawn_server(engine=engine, protocol=protocol)
+    
+    res = get(f'/{directory}/?archive={archive_format}')
+    assert res.status_code == 200
+    assert res.headers['Content-Disposition'] == \
+        f"attachment; filename*=UTF-8''{directory}.{archive_format}"
+    assert ('Transfer-Encoding' in res.headers) == (protocol == 'HTTP/1.1')
+    
+    if archive_format == 'zip':
+        with zipfile.ZipFile(io.BytesIO(res.content)) as archive:
+            assert archive.testzip() is None
+            received = { name: archive.read(name)
+                for name in archive.namelist() }
+    else:
+        with tarfile.open(fileobj=io.BytesIO(res.content)) as archive:
+            received = { member.name + ('/' if member.isdir() else ''):
+                archive.extractfile(member).read() if member.isfile() else
+                b'' for member in archive }
+    
+    assert received == { **files, 'sub/': b'', 'empty-dir/': b'' }
+    
+    res = get(f'/{directory}/?archive=rar')
+    assert res.status_code == 400
+
 def test_directory_listing_injections():
     spawn_server()
     
@@ -542,6 +1848,22 @@ def spawn_server(
     allow_replace: bool = False,
     directory: str = None,
     theme: str = None,
+    protocol: str = None,
+    worker_threads: int = None,
+    backlog: int = None,
+    max_connections: int = None,
+    processes: int = None,
+    engine: str = None,
+    max_request_size: str = None,
+    max_file_size: str = None,
+    max_files_per_request: int = None,
+    max_inflight_bytes: str = None,
+    hash: str = None,
+    hash_sidecar: bool = False,
+    session_lifetime: float = None,
+    dedup: bool = False,
+    durability: str = None,
+    group_commit_window: float = None,
     server_certificate: str = ('../server.pem' if PROTOCOL == 'HTTPS'
         else None),
     client_certificate: str = None,
@@ -554,6 +1876,24 @@ def spawn_server(
     if allow_replace: args += ['--allow-replace']
     if directory: args += ['-d', directory]
     if theme: args += ['--theme', theme]
+    if protocol: args += ['--protocol', protocol]
+    if worker_threads: args += ['--worker-threads', str(worker_threads)]
+    if backlog: args += ['--backlog', str(backlog)]
+    if max_connections: args += ['--max-connections', str(max_connections)]
+    if processes: args += ['--processes', str(processes)]
+    if engine: args += ['--engine', engine]
+    if max_request_size: args += ['--max-request-size', max_request_size]
+    if max_file_size: args += ['--max-file-size', max_file_size]
+    if max_files_per_request: args += ['--max-files-per-request',
+        str(max_files_per_request)]
+    if max_inflight_bytes: args += ['--max-inflight-bytes', max_inflight_bytes]
+    if hash: args += ['--hash', hash]
+    if hash_sidecar: args += ['--hash-sidecar']
+    if session_lifetime: args += ['--session-lifetime', str(session_lifetime)]
+    if dedup: args += ['--dedup']
+    if durability: args += ['--durability', durability]
+    if group_commit_window: args += ['--group-commit-window',
+        str(group_commit_window)]
     if server_certificate: args += ['-c', server_certificate]
     if client_certificate: args += ['--client-certificate',
         client_certificate[1]]
@@ -577,6 +1917,34 @@ def spawn_server(
         raise Exception(f'Port {port or 8000} not responding. Did the server '
             'fail to start?')
 
+# Uses http.client directly, since requests hides which connection each request
+# went over
+def connect(port: int = 8000) -> http.client.HTTPConnection:
+    if PROTOCOL == 'HTTPS':
+        return http.client.HTTPSConnection('127.0.0.1', port,
+            context=ssl._create_unverified_context())
+    else:
+        return http.client.HTTPConnection('127.0.0.1', port)
+
+def expect_100(method: str, path: str, headers: dict = {}, length: int = 10,
+) -> bytes:
+    """
+    Send only the headers of a request with Expect: 100-continue, and return
+    the first response line without its HTTP version
+    """
+    conn = connect()
+    conn.putrequest(method, path)
+    for keyword, value in headers.items():
+        conn.putheader(keyword, value)
+    conn.putheader('Content-Length', str(length))
+    conn.putheader('Expect', '100-continue')
+    conn.endheaders()
+    
+    conn.sock.settimeout(5)
+    status_line = conn.sock.makefile('rb').readline()
+    conn.close()
+    return status_line.split(b' ', 1)[1]
+
 def get(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
     return requests.get(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
         verify=False, *args, **kwargs)
@@ -588,3 +1956,15 @@ def post(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
 def put(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
     return requests.put(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
         verify=False, *args, **kwargs)
+
+def patch(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
+    return requests.patch(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
+        verify=False, *args, **kwargs)
+
+def head(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
+    return requests.head(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
+        verify=False, *args, **kwargs)
+
+def delete(path: str, port: int = 8000, *args, **kwargs) -> requests.Response:
+    return requests.delete(f'{PROTOCOL.lower()}://127.0.0.1:{port}{path}',
+        verify=False, *args, **kwargs)
@@ -1,17 +1,13 @@
 import http.server, http, pathlib, sys, argparse, ssl, os, builtins, tempfile
-import ipaddress, hmac
-import base64, binascii, functools, contextlib
+import ipaddress, hmac, threading, queue, signal, time, traceback
+import base64, binascii, functools, contextlib, urllib.parse, shutil
+import hashlib, zlib, json, errno, stat, io, tarfile, zipfile, select
 
 # Does not seem to do be used, but leaving this import out causes uploadserver
 # to not receive IPv4 requests when started with default options under Windows
 import socket
 
-# The cgi module was deprecated in Python 3.13, so I saved a copy in this
-# project
-if sys.version_info.major == 3 and sys.version_info.minor < 13:
-    import cgi
-else:
-    import uploadserver.cgi
+from uploadserver import multipart, zerocopy, sessions, idempotency, archives
 
 COLOR_SCHEME = {
     'light': 'light',
@@ -39,133 +35,2215 @@ def get_upload_page(theme: str) -> bytes:
 <p id="status"></p>
 </body>
 <script>
+// Files at least this big are sent in ranges, several at a time, as one TCP
+// connection is often far slower than the link
+const RANGED_UPLOAD_SIZE = 64*1024*1024
+const RANGE_SIZE = 16*1024*1024
+const PARALLEL_RANGES = 4
+
+const showProgress = (loaded, total) => {
+  document.getElementById('status').textContent = (loaded === total ?
+    'Saving…' :
+    `${Math.floor(100*loaded/total)}% ` +
+    `[${Math.floor(loaded/1024)} / ${Math.floor(total/1024)}KiB]`
+  )
+}
+
+const send = (method, url, body, headers, onprogress) => new Promise(
+resolve => {
+  const request = new XMLHttpRequest()
+  request.open(method, url)
+  request.timeout = 3600000
+  for (const [name, value] of Object.entries(headers)) {
+    request.setRequestHeader(name, value)
+  }
+  request.upload.onprogress = onprogress
+  request.onloadend = () => resolve(request)
+  request.send(body)
+})
+
+const isSuccess = request => [201, 204].includes(request.status)
+
+// Resolves with the request that completed the file, or the first that failed.
+// Rejects if every range was accepted but none completed the file
+const sendRanges = async file => {
+  // Unguessable, since it is all that keeps others' ranges out of the file
+  const key = Array.from(crypto.getRandomValues(new Uint8Array(16)),
+    v => v.toString(16).padStart(2, '0')).join('')
+  const loaded = new Map()
+  let next = 0
+  let result = null
+  
+  const sendNextRanges = async () => {
+    while (next < file.size) {
+      const first = next
+      const last = Math.min(first + RANGE_SIZE, file.size) - 1
+      next = last + 1
+      
+      const request = await send('PUT',
+        '/upload/' + encodeURIComponent(file.name),
+        file.slice(first, last + 1), {
+          'Content-Range': `bytes ${first}-${last}/${file.size}`,
+          'Upload-Key': key,
+        }, e => {
+          loaded.set(first, e.loaded)
+          showProgress([...loaded.values()].reduce((a, b) => a + b),
+            file.size)
+        })
+      
+      if (request.status !== 202) {
+        result = request
+        if (!isSuccess(request)) next = file.size
+      }
+    }
+  }
+  
+  await Promise.all(Array.from({ length: PARALLEL_RANGES }, sendNextRanges))
+  if (!result) throw new Error(`Upload of ${file.name} was not completed`)
+  return result
+}
+
 document.getElementsByTagName('form')[0].addEventListener('submit', async e => {
   e.preventDefault()
   
   const uploadFormData = new FormData(e.target)
-  const filenames = uploadFormData.getAll('files').map(v => v.name).join(', ')
-  const uploadRequest = new XMLHttpRequest()
-  uploadRequest.open(e.target.method, e.target.action)
-  uploadRequest.timeout = 3600000
+  const files = uploadFormData.getAll('files')
+  const rangedFiles = files.filter(v => v.size >= RANGED_UPLOAD_SIZE)
+  const formFiles = files.filter(v => v.size < RANGED_UPLOAD_SIZE)
+  let uploadRequest = null
   
-  uploadRequest.onreadystatechange = () => {
-    if (uploadRequest.readyState === XMLHttpRequest.DONE) {
-      let message = `${uploadRequest.status}: ${uploadRequest.statusText}`
-      if (uploadRequest.status === 0) message = 'Connection failed'
-      if (uploadRequest.status === 204) {
-        message = `Success: ${uploadRequest.statusText}`
-      }
-      document.getElementById('status').textContent = message
+  for (const file of rangedFiles) {
+    document.getElementById('task').textContent = `Uploading ${file.name}:`
+    document.getElementById('status').textContent = '0%'
+    try {
+      uploadRequest = await sendRanges(file)
+    } catch (error) {
+      document.getElementById('status').textContent = error.message
+      return
     }
+    if (!isSuccess(uploadRequest)) break
   }
   
-  uploadRequest.upload.onprogress = e => {
-    document.getElementById('status').textContent = (e.loaded === e.total ?
-      'Saving…' :
-      `${Math.floor(100*e.loaded/e.total)}% ` +
-      `[${Math.floor(e.loaded/1024)} / ${Math.floor(e.total/1024)}KiB]`
-    )
+  if (!uploadRequest || (isSuccess(uploadRequest) && formFiles.length)) {
+    if (rangedFiles.length) {
+      uploadFormData.delete('files')
+      formFiles.forEach(v => uploadFormData.append('files', v))
+    }
+    
+    const filenames = formFiles.map(v => v.name).join(', ')
+    document.getElementById('task').textContent = `Uploading ${filenames}:`
+    document.getElementById('status').textContent = '0%'
+    uploadRequest = await send(e.target.method, e.target.action,
+      uploadFormData, {}, e => showProgress(e.loaded, e.total))
   }
   
-  uploadRequest.send(uploadFormData)
-  
-  document.getElementById('task').textContent = `Uploading ${filenames}:`
-  document.getElementById('status').textContent = '0%'
+  let message = `${uploadRequest.status}: ${uploadRequest.statusText}`
+  if (uploadRequest.status === 0) message = 'Connection failed'
+  if (isSuccess(uploadRequest)) {
+    message = `Success: ${uploadRequest.statusText}`
+  }
+  document.getElementById('status').textContent = message
 })
 </script>
 </html>''', 'utf-8')
 
-def get_directory_head_injection(theme: str) -> bytes:
-    return bytes('''<!-- Injected by uploadserver -->
-<meta name="viewport" content="width=device-width" />
-<meta name="color-scheme" content="''' + COLOR_SCHEME.get(theme) + '''">
-<!-- End injection by uploadserver -->
-''', 'utf-8')
+def get_directory_head_injection(theme: str) -> bytes:
+    return bytes('''<!-- Injected by uploadserver -->
+<meta name="viewport" content="width=device-width" />
+<meta name="color-scheme" content="''' + COLOR_SCHEME.get(theme) + '''">
+<!-- End injection by uploadserver -->
+''', 'utf-8')
+
+DIRECTORY_BODY_INJECTION = b'''<!-- Injected by uploadserver -->
+<a href="/upload">File upload</a>
+(provided by uploadserver, all files go to server root)
+<hr>
+<!-- End injection by uploadserver -->
+'''
+
+def send_upload_page(handler: http.server.BaseHTTPRequestHandler):
+    handler.send_response(http.HTTPStatus.OK)
+    handler.send_header('Content-Type', 'text/html; charset=utf-8')
+    handler.send_header('Content-Length', len(get_upload_page(args.theme)))
+    handler.end_headers()
+    handler.wfile.write(get_upload_page(args.theme))
+
+# Size of reads from the request body. Large reads keep the per-chunk overhead
+# of the multipart parser negligible
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Hidden directory in the upload directory for state kept between requests
+STATE_DIRECTORY = '.uploadserver'
+
+# Where files being uploaded are kept, in STATE_DIRECTORY, on systems without
+# O_TMPFILE
+STAGING_DIRECTORY = 'staging'
+
+# Files in STAGING_DIRECTORY not written to for this many seconds are taken to
+# be left over from a crash, and removed at startup
+STAGING_FILE_LIFETIME = 86400
+
+# Errors from O_TMPFILE meaning the filesystem doesn't support it
+_TMPFILE_UNSUPPORTED = (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL)
+
+def make_upload_file() -> object:
+    """
+    Create the temp file an upload is received into. On Linux it is an
+    anonymous O_TMPFILE file in the upload directory, which has no name until
+    commit_upload() links it into place, and disappears by itself if the
+    upload fails or the server dies. Elsewhere it is a named file in a
+    hidden staging directory.
+    """
+    # Anonymous files can only be linked through /proc
+    if hasattr(os, 'O_TMPFILE') and os.path.isdir('/proc/self/fd'):
+        try:
+            fd = os.open(args.directory, os.O_TMPFILE | os.O_RDWR, 0o600)
+        except OSError as e:
+            if e.errno not in _TMPFILE_UNSUPPORTED:
+                raise
+        else:
+            return open(fd, 'wb+')
+    
+    staging_directory = pathlib.Path(args.directory, STATE_DIRECTORY,
+        STAGING_DIRECTORY)
+    staging_directory.mkdir(parents=True, exist_ok=True)
+    return tempfile.NamedTemporaryFile(mode='wb+', dir=staging_directory,
+        delete=False)
+
+def is_anonymous(file: object) -> bool:
+    # Files opened from a file descriptor are named by it
+    return isinstance(file.name, int)
+
+def discard_upload_file(file: object):
+    file.close()
+    if not is_anonymous(file):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file.name)
+
+def link_upload_file(file: object, destination: pathlib.Path):
+    """
+    Give a finished temp file the name destination and close it, or raise
+    FileExistsError if something already has that name. The name is claimed
+    in the same step as it is given, so two uploads can't both get it.
+    """
+    if is_anonymous(file):
+        # linkat() with AT_SYMLINK_FOLLOW, which os.link() only uses when
+        # given a directory file descriptor
+        file.flush()
+        fd_directory = os.open('/proc/self/fd', os.O_RDONLY)
+        try:
+            os.link(str(file.fileno()), destination, src_dir_fd=fd_directory)
+        finally:
+            os.close(fd_directory)
+        file.close()
+        return
+    
+    file.close()
+    try:
+        os.link(file.name, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        # Filesystems without hard links. The name is claimed by an empty
+        # file, which is then replaced
+        os.close(os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        os.replace(file.name, destination)
+    else:
+        os.remove(file.name)
+
+# link arguments below are functions that give an upload the name they are
+# passed, and raise FileExistsError if something already has it, such as
+# functools.partial(link_upload_file, file)
+
+def replace_with_link(link: object, destination: pathlib.Path):
+    """
+    Give an upload the name destination, replacing any file that had the name
+    in one step.
+    """
+    # Links can only be made to free names, so the upload is given a name in
+    # the staging directory first
+    staging_directory = pathlib.Path(args.directory, STATE_DIRECTORY,
+        STAGING_DIRECTORY)
+    staging_directory.mkdir(parents=True, exist_ok=True)
+    staging_path = staging_directory / os.urandom(16).hex()
+    link(staging_path)
+    try:
+        os.replace(staging_path, destination)
+    finally:
+        # Still there if the replace failed, or did nothing because
+        # destination was already a link to the same file
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(staging_path)
+
+# Most paths whose next conflict suffix is remembered. The index starts over
+# when it fills up
+MAX_SUFFIX_INDEX = 4096
+
+# Next 'name (n).ext' suffix to try for each path that has had a conflict
+_next_suffixes = {}
+_next_suffixes_lock = threading.Lock()
+
+def link_renamed(link: object, destination: pathlib.Path) -> pathlib.Path:
+    """
+    Give an upload the name destination, or if that is taken, the first free
+    one of 'name (1).ext', 'name (2).ext', ... Returns the name given.
+    Suffixes carry on from the last one this process gave out for
+    destination, so a conflict usually costs one try no matter how many
+    copies there are already.
+    """
+    with contextlib.suppress(FileExistsError):
+        link(destination)
+        return destination
+    
+    (base, ext) = os.path.splitext(destination)
+    with _next_suffixes_lock:
+        start = _next_suffixes.get(str(destination), 1)
+    
+    for i in range(start, sys.maxsize):
+        renamed_path = pathlib.Path(f'{base} ({i}){ext}')
+        try:
+            link(renamed_path)
+        except FileExistsError:
+            continue
+        
+        with _next_suffixes_lock:
+            if len(_next_suffixes) >= MAX_SUFFIX_INDEX:
+                _next_suffixes.clear()
+            _next_suffixes[str(destination)] = max(i + 1,
+                _next_suffixes.get(str(destination), 1))
+        return renamed_path
+    
+    raise FileExistsError(f'File {destination} already exists.')
+
+# Where --dedup keeps one file for each distinct content, in STATE_DIRECTORY
+OBJECTS_DIRECTORY = 'objects'
+
+# True return type is hash object | None, but Python 3.9 doesn't support |
+def new_content_hasher() -> object:
+    # What --dedup files uploads under
+    return hashlib.sha256() if args.dedup else None
+
+def get_objects_directory() -> pathlib.Path:
+    return pathlib.Path(args.directory, STATE_DIRECTORY, OBJECTS_DIRECTORY)
+
+# True argument type of content_hasher is hash object | None, but Python 3.9
+# doesn't support |
+def store_upload_object(file: object, content_hasher: object,
+) -> pathlib.Path:
+    """
+    For --dedup. File a finished temp file in the object store under the
+    SHA-256 of its content from content_hasher (or read back from the file if
+    that is None), unless there is a file with the same content there
+    already, and close it. Returns the path of the stored file, which
+    uploads are then hard links to.
+    """
+    if not content_hasher:
+        content_hasher = hashlib.sha256()
+        file.seek(0)
+        while chunk := file.read(UPLOAD_CHUNK_SIZE):
+            content_hasher.update(chunk)
+    
+    hexdigest = content_hasher.hexdigest()
+    object_path = get_objects_directory() / hexdigest[:2] / hexdigest
+    object_path.parent.mkdir(parents=True, exist_ok=True)
+    
+    # Every copy is the same file, so one edited in place would change them
+    # all
+    if os.chmod in os.supports_fd:
+        os.chmod(file.fileno(), stat.S_IRUSR)
+    
+    try:
+        link_upload_file(file, object_path)
+    except FileExistsError:
+        discard_upload_file(file)
+    
+    return object_path
+
+def collect_upload_objects():
+    """
+    Remove stored --dedup files that no upload links to any more. Only run at
+    startup, so none is removed between being found and linked to.
+    """
+    try:
+        paths = list(get_objects_directory().glob('*/*'))
+    except FileNotFoundError:
+        return
+    
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_nlink <= 1:
+                os.remove(path)
+
+def check_hard_links():
+    """
+    --dedup makes every upload a hard link to a stored file, so exit if they
+    can't be made in the state directory (e.g. on FAT or some network file
+    systems) rather than fail every upload.
+    """
+    state_directory = pathlib.Path(args.directory, STATE_DIRECTORY)
+    try:
+        state_directory.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=state_directory) as file:
+            link_path = state_directory / os.urandom(16).hex()
+            os.link(file.name, link_path)
+            os.remove(link_path)
+    except OSError as e:
+        print(f'--dedup needs hard links, which can\'t be made in '
+            f'"{state_directory}" ({e.strerror}), exiting')
+        sys.exit(6)
+
+def collect_staging_files():
+    staging_directory = pathlib.Path(args.directory, STATE_DIRECTORY,
+        STAGING_DIRECTORY)
+    try:
+        paths = list(staging_directory.iterdir())
+    except FileNotFoundError:
+        return
+    
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            if os.path.getmtime(path) + STAGING_FILE_LIFETIME <= time.time():
+                os.remove(path)
+
+# Errors meaning the disk (or the user's quota) is full
+NO_SPACE_ERRNOS = (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC))
+
+NO_SPACE_RESULT = (http.HTTPStatus.INSUFFICIENT_STORAGE,
+    'Not enough free disk space', {})
+
+# Errors from os.posix_fallocate() meaning the filesystem can't do it
+_FALLOCATE_UNSUPPORTED = (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS)
+
+def preallocate(file: object, length: int):
+    """
+    Reserve disk space for the first length bytes of file before they are
+    written, so a large upload is laid out in one piece instead of growing a
+    chunk at a time, and a full disk is found out before the body is read.
+    The file is at least length bytes long afterwards. Raises UploadRejected
+    if there isn't the space.
+    """
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(file.fileno(), 0, length)
+                return
+            except OSError as e:
+                if e.errno not in _FALLOCATE_UNSUPPORTED:
+                    raise
+        
+        # Only reserves the size, without the blocks
+        if os.fstat(file.fileno()).st_size < length:
+            os.ftruncate(file.fileno(), length)
+    except OSError as e:
+        if e.errno in NO_SPACE_ERRNOS:
+            raise UploadRejected(*NO_SPACE_RESULT[:2])
+        raise
+
+# Longest chunk-size or trailer line accepted in a chunked request body
+MAX_CHUNK_LINE = 4096
+
+# Largest unread request body that is read and thrown away after an early
+# rejection, so the connection can be kept alive. Bigger ones close it instead
+MAX_DISCARD_SIZE = 1 << 16
+
+def is_chunked(handler: http.server.BaseHTTPRequestHandler) -> bool:
+    return 'chunked' in handler.headers.get('Transfer-Encoding', '').lower()
+
+def iter_request_body(handler: http.server.BaseHTTPRequestHandler):
+    """
+    Yield the request body in chunks of up to UPLOAD_CHUNK_SIZE bytes. Bodies
+    are framed by Content-Length or chunked transfer encoding; a request with
+    neither has no body. A Content-Length body that ends early simply yields
+    fewer bytes.
+    """
+    handler.body_read = True
+    
+    if is_chunked(handler):
+        yield from iter_chunked_body(handler.rfile)
+        return
+    
+    remaining = int(handler.headers.get('Content-Length', 0))
+    while remaining > 0:
+        chunk = handler.rfile.read1(min(remaining, UPLOAD_CHUNK_SIZE))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+def iter_chunked_body(rfile: object):
+    # A broken chunked body leaves no way to find the next request on the
+    # connection, so errors are raised as ConnectionError to drop it
+    while True:
+        line = rfile.readline(MAX_CHUNK_LINE)
+        size = line.split(b';', 1)[0].strip()
+        if not line.endswith(b'\n') or not size or \
+        size.strip(b'0123456789abcdefABCDEF'):
+            raise ConnectionError('Malformed chunked request body')
+        
+        size = int(size, 16)
+        if size == 0:
+            break
+        
+        while size > 0:
+            chunk = rfile.read1(min(size, UPLOAD_CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError('Chunked request body ended early')
+            size -= len(chunk)
+            yield chunk
+        
+        if rfile.readline(MAX_CHUNK_LINE) not in (b'\r\n', b'\n'):
+            raise ConnectionError('Malformed chunked request body')
+    
+    # Trailer fields are ignored
+    while (line := rfile.readline(MAX_CHUNK_LINE)) not in (b'\r\n', b'\n'):
+        if not line.endswith(b'\n'):
+            raise ConnectionError('Malformed chunked request body')
+
+def discard_request_body(handler: http.server.BaseHTTPRequestHandler) -> bool:
+    """
+    Call before rejecting a request without reading its body. Small bodies are
+    read and discarded so the connection can stay open for the next request.
+    Returns False if the body is too big or not framed by Content-Length, in
+    which case the caller must close the connection.
+    """
+    if is_chunked(handler):
+        return False
+    
+    try:
+        length = int(handler.headers.get('Content-Length', 0))
+    except ValueError:
+        return False
+    
+    if length > MAX_DISCARD_SIZE:
+        return False
+    
+    for _ in iter_request_body(handler):
+        pass
+    
+    return True
+
+class UploadRejected(Exception):
+    """
+    Raised part way through receiving an upload that has to be cut off, such as
+    one that has grown past a size limit. result is the response to send, for
+    send_upload_result().
+    """
+    def __init__(self, status: http.HTTPStatus, message: str):
+        super().__init__(message)
+        self.result = (status, message)
+
+# Seconds an upload waits for room under --max-inflight-bytes before it is
+# refused with 503 Service Unavailable
+INFLIGHT_WAIT_TIMEOUT = 30
+
+INFLIGHT_BUSY_RESULT = (http.HTTPStatus.SERVICE_UNAVAILABLE,
+    'Too many uploads in progress, try again later')
+
+class InflightBudget:
+    """
+    Server-wide count of upload bytes being received, bounded by
+    --max-inflight-bytes. A single reservation bigger than the whole budget is
+    let through when nothing else is in flight, so it can't wait forever.
+    """
+    def __init__(self):
+        self.used = 0
+        self.condition = threading.Condition()
+    
+    def try_reserve(self, size: int) -> bool:
+        with self.condition:
+            if args.max_inflight_bytes and self.used and \
+            self.used + size > args.max_inflight_bytes:
+                return False
+            
+            self.used += size
+            return True
+    
+    def reserve(self, size: int, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.try_reserve(size),
+                timeout)
+    
+    def release(self, size: int):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+inflight_budget = InflightBudget()
+
+class UploadBody:
+    """
+    Size accounting for the body of one upload. count() is called with the
+    size of each chunk as it arrives, and raises UploadRejected once the body
+    grows past limit bytes (0 for no limit). Bodies of known length reserve all
+    of it from the InflightBudget up front with reserve(). Chunked ones reserve
+    as they arrive instead, and are cut off if there is no room. close()
+    returns the reservation. check is a DigestCheck for the digests the client
+    sent of the body, if any.
+    """
+    # True type of length is int | None, and of check is DigestCheck | None,
+    # but Python 3.9 doesn't support |
+    def __init__(self, length: int, limit: int, check: object = None):
+        self.length = length
+        self.limit = limit
+        self.check = check
+        self.received = 0
+        self.reserved = 0
+    
+    def reserve(self, timeout: float) -> bool:
+        if not self.length:
+            return True
+        
+        if not inflight_budget.reserve(self.length, timeout):
+            return False
+        
+        self.reserved = self.length
+        return True
+    
+    def count(self, size: int):
+        self.received += size
+        if self.limit and self.received > self.limit:
+            raise UploadRejected(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'Upload too large')
+        
+        if self.received > self.reserved:
+            # Reserve a chunk's worth at a time, to take the lock less often
+            size = max(self.received - self.reserved, UPLOAD_CHUNK_SIZE)
+            if not inflight_budget.try_reserve(size):
+                raise UploadRejected(*INFLIGHT_BUSY_RESULT)
+            self.reserved += size
+    
+    def close(self):
+        inflight_budget.release(self.reserved)
+        self.reserved = 0
+
+class CRC32:
+    """zlib.crc32() with the interface of a hashlib hash object."""
+    name = 'crc32'
+    
+    def __init__(self):
+        self.value = 0
+    
+    def update(self, data: bytes):
+        self.value = zlib.crc32(data, self.value)
+    
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, 'big')
+    
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'blake2b': hashlib.blake2b,
+    'crc32': CRC32,
+}
+
+# Names of the algorithms that have one in the HTTP Digest Algorithm Values
+# registry (RFC 9530), and so can be sent in Repr-Digest
+REPR_DIGEST_ALGORITHMS = {
+    'sha256': 'sha-256',
+    'sha512': 'sha-512',
+}
+
+# True return type is hash object | None, but Python 3.9 doesn't support |
+def new_hasher() -> object:
+    return HASH_ALGORITHMS[args.hash]() if args.hash else None
+
+# Algorithms clients may send digests of uploads with, by their names in the
+# HTTP Digest Algorithm Values registry (RFC 9530)
+DIGEST_ALGORITHMS = {
+    'sha-256': hashlib.sha256,
+    'sha-512': hashlib.sha512,
+    'md5': hashlib.md5,
+}
+
+# Longest value accepted for the digest form field
+MAX_DIGEST_FIELD_SIZE = 1024
+
+# True argument types are str | None, but Python 3.9 doesn't support |
+def parse_expected_digests(content_digest: str, content_md5: str,
+allow_hex: bool = False) -> dict:
+    """
+    Collect the digests a client sent for a body or part, from Content-Digest
+    (e.g. 'sha-256=:<base64>:') and Content-MD5 headers, into a dict of
+    {algorithm: digest}. Unsupported algorithms are ignored. With allow_hex,
+    Content-Digest values may also be hex, as tools like sha256sum print them,
+    and a bare hex digest is taken as whichever algorithm has its length.
+    Raises ValueError if a header is malformed.
+    """
+    expected = {}
+    
+    for member in (content_digest or '').split(','):
+        if not member.strip():
+            continue
+        
+        if allow_hex and '=' not in member:
+            digest = bytes.fromhex(member.strip())
+            member = next((f'{algorithm}={member}'
+                for algorithm, constructor in DIGEST_ALGORITHMS.items()
+                if constructor().digest_size == len(digest)), member)
+        
+        key, sep, value = member.split(';', 1)[0].partition('=')
+        key = key.strip().lower()
+        value = value.strip()
+        if not sep:
+            raise ValueError('Malformed Content-Digest')
+        if key not in DIGEST_ALGORITHMS:
+            continue
+        
+        if len(value) >= 2 and value[0] == value[-1] == ':':
+            expected[key] = base64.b64decode(value[1:-1], validate=True)
+        elif allow_hex:
+            expected[key] = bytes.fromhex(value)
+        else:
+            raise ValueError('Malformed Content-Digest')
+    
+    if content_md5:
+        expected['md5'] = base64.b64decode(content_md5.strip(), validate=True)
+    
+    return expected
+
+class DigestCheck:
+    """
+    Hashes data as it is written, with the interface of a hashlib hash object,
+    and then checks it against the digests the client sent.
+    """
+    def __init__(self, expected: dict):
+        self.expected = expected
+        self.hashers = { algorithm: DIGEST_ALGORITHMS[algorithm]()
+            for algorithm in expected }
+    
+    def update(self, data: bytes):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+    
+    def verify(self) -> bool:
+        return all(self.hashers[algorithm].digest() == digest
+            for algorithm, digest in self.expected.items())
+
+# True return type is DigestCheck | None, but Python 3.9 doesn't support |
+def new_digest_check(content_digest: str, content_md5: str,
+allow_hex: bool = False) -> object:
+    """
+    DigestCheck for the given headers, or None if they hold no digests. Raises
+    ValueError if a header is malformed.
+    """
+    expected = parse_expected_digests(content_digest, content_md5, allow_hex)
+    return DigestCheck(expected) if expected else None
+
+def write_upload_chunk(file: object, hashers: list, data: bytes):
+    # Digests are computed as the data goes by, so nothing is read back
+    for hasher in hashers:
+        hasher.update(data)
+    
+    try:
+        file.write(data)
+    except OSError as e:
+        if e.errno in NO_SPACE_ERRNOS:
+            raise UploadRejected(*NO_SPACE_RESULT[:2])
+        raise
+
+def get_sidecar_path(path: str) -> str:
+    return f'{path}.{args.hash}'
+
+def write_sidecar(handler: http.server.BaseHTTPRequestHandler,
+destination: pathlib.Path, hexdigest: str):
+    """
+    Write the sidecar for destination, unless its name is taken by a file
+    that isn't a sidecar for it, e.g. one that was uploaded.
+    """
+    # Same format as sha256sum and friends, so `sha256sum -c` can check it
+    content = f'{hexdigest}  {destination.name}\n'
+    sidecar_path = get_sidecar_path(destination)
+    try:
+        with open(sidecar_path, 'x') as f:
+            f.write(content)
+        return
+    except FileExistsError:
+        pass
+    
+    if not is_sidecar(sidecar_path, destination, len(hexdigest)):
+        handler.log_message('Not writing sidecar: %s already exists',
+            sidecar_path)
+        return
+    
+    # A sidecar for an earlier file of the same name, which must not be left
+    # to describe this one
+    with open(sidecar_path, 'w') as f:
+        f.write(content)
+
+def is_sidecar(path: str, destination: pathlib.Path, digest_length: int,
+) -> bool:
+    try:
+        with open(path) as f:
+            hexdigest, sep, name = f.read(digest_length + len(
+                destination.name) + 4).partition('  ')
+    except (OSError, ValueError):
+        return False
+    
+    return bool(sep) and name == f'{destination.name}\n' and \
+        len(hexdigest) == digest_length and \
+        all(c in '0123456789abcdef' for c in hexdigest)
+
+# True return type is str | None, but Python 3.9 doesn't support |
+def get_repr_digest(path: str) -> str:
+    """
+    Repr-Digest header for a file with a sidecar from --hash-sidecar, or None.
+    Sidecars older than their file are ignored, since the file has been
+    replaced without one.
+    """
+    if args.hash not in REPR_DIGEST_ALGORITHMS:
+        return None
+    
+    sidecar_path = get_sidecar_path(path)
+    try:
+        if os.path.getmtime(sidecar_path) < os.path.getmtime(path):
+            return None
+        with open(sidecar_path) as f:
+            digest = bytes.fromhex(f.read().split(' ', 1)[0])
+    except (OSError, ValueError):
+        return None
+    
+    return (f'{REPR_DIGEST_ALGORITHMS[args.hash]}='
+        f':{base64.b64encode(digest).decode()}:')
+
+# True argument type of hasher is hash object | None, but Python 3.9 doesn't
+# support |
+def describe_upload(destination: pathlib.Path, size: int, hasher: object,
+) -> dict:
+    """Summary of a committed file, for the upload response."""
+    description = {
+        'path': '/' + urllib.parse.quote(
+            destination.relative_to(args.directory).as_posix()),
+        'size': size,
+    }
+    if hasher:
+        description[args.hash] = hasher.hexdigest()
+    
+    return description
+
+def add_timing(handler: http.server.BaseHTTPRequestHandler, name: str,
+seconds: float):
+    """
+    Add to the time spent on a phase of handling an upload, which is reported
+    in the Server-Timing header of the response.
+    """
+    if not hasattr(handler, 'timings'):
+        handler.timings = {}
+    handler.timings[name] = handler.timings.get(name, 0) + seconds
+
+def fsync_path(path: str):
+    # Windows can only flush files opened for writing. Elsewhere reading is
+    # enough, which also works for the read-only files --dedup makes
+    fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_files(paths: list):
+    """
+    fsync() files, their sidecars, and then each directory they are in once,
+    so that new names survive a power loss as well as the data.
+    """
+    directories = set()
+    for path in paths:
+        fsync_path(path)
+        if args.hash_sidecar and os.path.exists(get_sidecar_path(path)):
+            fsync_path(get_sidecar_path(path))
+        directories.add(os.path.dirname(path))
+    
+    # Windows can't open directories, and doesn't need them flushed
+    if os.name != 'nt':
+        for directory in directories:
+            fsync_path(directory)
+
+class GroupCommitBatch:
+    def __init__(self):
+        self.paths = set()
+        self.done = threading.Event()
+        self.error = None
+        self.started = None
+        self.duration = None
+
+class GroupCommit:
+    """
+    For --durability group. Uploads that call sync() within window seconds of
+    the first share one round of fsync() calls, in which each directory is
+    flushed only once. Many small uploads to one directory then cost little
+    more to make durable than one.
+    """
+    def __init__(self, window: float):
+        self.window = window
+        self.lock = threading.Lock()
+        self.batch = None
+    
+    def sync(self, handler: http.server.BaseHTTPRequestHandler, paths: list):
+        submitted = time.monotonic()
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = GroupCommitBatch()
+            batch.paths.update(paths)
+        
+        if leader:
+            time.sleep(self.window)
+            with self.lock:
+                self.batch = None
+            
+            batch.started = time.monotonic()
+            try:
+                sync_files(batch.paths)
+            except BaseException as e:
+                batch.error = e
+            batch.duration = time.monotonic() - batch.started
+            batch.done.set()
+        else:
+            batch.done.wait()
+        
+        add_timing(handler, 'group-wait', batch.started - submitted)
+        add_timing(handler, 'fsync', batch.duration)
+        if batch.error:
+            raise batch.error
+
+# Created by serve_forever()
+group_commit = None
+
+def make_durable(handler: http.server.BaseHTTPRequestHandler, paths: list):
+    """Flush committed uploads to disk, as set by --durability."""
+    if args.durability == 'file':
+        started = time.monotonic()
+        sync_files(paths)
+        add_timing(handler, 'fsync', time.monotonic() - started)
+    elif args.durability == 'group' and paths:
+        group_commit.sync(handler, paths)
+
+# True argument type of filename is str | pathlib.Path, and of hasher and
+# content_hasher is hash object | None, but Python 3.9 doesn't support |
+def commit_upload(handler: http.server.BaseHTTPRequestHandler, file: object,
+filename: str, hasher: object = None, sync: bool = True,
+content_hasher: object = None) -> pathlib.Path:
+    """
+    Move a finished temp file to its final name in the upload directory.
+    filename may be a bare name or a relative path from
+    sanitize_upload_path(). Returns the final path, which differs from the
+    requested one if the file had to be renamed due to a name conflict. With
+    --hash-sidecar, the digest from hasher is saved next to the file. Unless
+    sync is False, in which case the caller must call make_durable() itself,
+    the file is flushed to disk as set by --durability. With --dedup, the
+    file is stored by the digest from content_hasher, if given.
+    """
+    started = time.monotonic()
+    destination = pathlib.Path(args.directory) / filename
+    if args.dedup:
+        link = functools.partial(os.link,
+            store_upload_object(file, content_hasher))
+    else:
+        link = functools.partial(link_upload_file, file)
+    
+    if not args.allow_replace or os.path.isdir(destination):
+        destination = link_renamed(link, destination)
+    elif args.dedup or is_anonymous(file):
+        replace_with_link(link, destination)
+    else:
+        file.close()
+        os.replace(file.name, destination)
+    handler.log_message('[Uploaded] "%s" --> %s', filename, destination)
+    
+    if hasher and args.hash_sidecar:
+        write_sidecar(handler, destination, hasher.hexdigest())
+    add_timing(handler, 'commit', time.monotonic() - started)
+    
+    if sync:
+        make_durable(handler, [str(destination)])
+    
+    return destination
+
+def write_request_body(handler: http.server.BaseHTTPRequestHandler,
+file: object, body: UploadBody, hashers: list = ()) -> int:
+    """
+    Write the request body to file, and return how many bytes were written
+    (fewer than body.length if the client disconnected). On Linux over plain
+    HTTP, bodies of known length go from socket to file through a pipe with
+    os.splice() and never enter userspace, unless they have to be hashed;
+    everywhere else they are copied in chunks.
+    """
+    if body.length is not None and not hashers and \
+    zerocopy.can_splice(handler.connection):
+        handler.body_read = True
+        try:
+            return zerocopy.splice_to_file(handler.rfile, handler.connection,
+                file, body.length)
+        except OSError as e:
+            if e.errno in NO_SPACE_ERRNOS:
+                raise UploadRejected(*NO_SPACE_RESULT[:2])
+            raise
+    
+    received = 0
+    for chunk in iter_request_body(handler):
+        body.count(len(chunk))
+        write_upload_chunk(file, hashers, chunk)
+        received += len(chunk)
+    
+    return received
+
+class MultipartUpload:
+    """
+    Receives a multipart/form-data body fed to it in chunks. Each file is
+    committed as soon as its closing boundary arrives, so only the part
+    currently being received has an open temp file. feed() and close() raise
+    multipart.MultipartError if the body is malformed, and feed() raises
+    UploadRejected if --max-file-size or --max-files-per-request is exceeded.
+    discard() must be called afterwards whatever happened.
+    
+    A file's digest may be sent in Content-Digest or Content-MD5 headers of its
+    part, or in a digest field just before it. A file that doesn't match is
+    rejected with 422. If the client sent digests of the whole body (check),
+    files are only committed once that has been verified at the end.
+    
+    length is the length of the request body, or None if it is chunked.
+    """
+    # True types of check and length are DigestCheck | None and int | None, but
+    # Python 3.9 doesn't support |
+    def __init__(self, handler: http.server.BaseHTTPRequestHandler,
+    boundary: bytes, check: object = None, length: int = None):
+        self.handler = handler
+        self.parser = multipart.MultipartParser(boundary)
+        self.check = check
+        self.length = length
+        self.received = 0
+        self.file = None
+        self.filename = None
+        self.file_size = 0
+        self.file_length = None
+        self.hasher = None
+        self.content_hasher = None
+        self.file_check = None
+        self.hashers = []
+        self.digest_field = None
+        self.field_check = None
+        self.files_started = 0
+        self.files_received = []
+        self.name_conflict = False
+        self.files_field_found = False
+        self.files_committed = []
+        self.destinations = []
+    
+    def feed(self, chunk: bytes):
+        if self.check:
+            self.check.update(chunk)
+        
+        for event in self.parser.feed(chunk):
+            if isinstance(event, multipart.PartData):
+                if self.file:
+                    self.file_size += len(event.data)
+                    if args.max_file_size and \
+                    self.file_size > args.max_file_size:
+                        raise UploadRejected(
+                            http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            'File too large')
+                    
+                    write_upload_chunk(self.file, self.hashers, event.data)
+                elif self.digest_field is not None:
+                    self.digest_field += event.data
+                    if len(self.digest_field) > MAX_DIGEST_FIELD_SIZE:
+                        raise UploadRejected(http.HTTPStatus.BAD_REQUEST,
+                            'Field "digest" too long')
+            elif isinstance(event, multipart.PartStart):
+                if event.name == 'files':
+                    self.files_field_found = True
+                    # Parts without a usable filename are skipped
+                    self.filename = pathlib.Path(event.filename or '').name
+                    if is_state_name(self.filename):
+                        self.filename = ''
+                    if self.filename:
+                        self.start_file(event)
+                elif event.name == 'digest':
+                    self.digest_field = b''
+            elif self.file:
+                self.finish_file()
+            elif self.digest_field is not None:
+                # Applies to the next file
+                try:
+                    self.field_check = new_digest_check(
+                        self.digest_field.decode('ascii'), None, True)
+                except ValueError:
+                    raise UploadRejected(http.HTTPStatus.BAD_REQUEST,
+                        'Malformed field "digest"')
+                self.digest_field = None
+        
+        # Counted afterwards, as parts started in this chunk have their data in
+        # it
+        self.received += len(chunk)
+    
+    def start_file(self, event: multipart.PartStart):
+        self.files_started += 1
+        if args.max_files_per_request and \
+        self.files_started > args.max_files_per_request:
+            raise UploadRejected(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'Too many files')
+        
+        try:
+            self.file_check = new_digest_check(
+                event.headers.get('content-digest'),
+                event.headers.get('content-md5')) or self.field_check
+        except ValueError:
+            raise UploadRejected(http.HTTPStatus.BAD_REQUEST,
+                f'Malformed digest for "{self.filename}"')
+        self.field_check = None
+        
+        # Parts rarely give their length, but can be preallocated if they do
+        try:
+            self.file_length = int(event.headers.get('content-length', ''))
+        except ValueError:
+            self.file_length = None
+        if self.file_length and args.max_file_size and \
+        self.file_length > args.max_file_size:
+            raise UploadRejected(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'File too large')
+        # A length is only trusted as far as the request body can hold it, and
+        # not at all in a chunked body, which could be any length
+        if self.file_length and self.length is not None and \
+        self.file_length > self.length - self.received:
+            raise UploadRejected(http.HTTPStatus.BAD_REQUEST,
+                f'Part "{self.filename}" longer than the request body')
+        
+        self.file = make_upload_file()
+        self.file_size = 0
+        if self.file_length and self.length is not None:
+            preallocate(self.file, self.file_length)
+        self.hasher = new_hasher()
+        self.content_hasher = new_content_hasher()
+        self.hashers = [hasher for hasher in (self.hasher, self.content_hasher,
+            self.file_check) if hasher]
+    
+    def finish_file(self):
+        if self.file_check and not self.file_check.verify():
+            raise UploadRejected(http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                f'Digest mismatch for "{self.filename}"')
+        
+        # The part may not have been as long as it said
+        if self.file_length:
+            self.file.truncate(self.file_size)
+        
+        self.files_received.append((self.file, self.filename, self.file_size,
+            self.hasher, self.content_hasher))
+        self.file = None
+        
+        if not self.check:
+            self.commit_files()
+    
+    def commit_files(self):
+        while self.files_received:
+            file, filename, size, hasher, content_hasher = \
+                self.files_received.pop(0)
+            try:
+                destination = commit_upload(self.handler, file, filename,
+                    hasher, sync=False, content_hasher=content_hasher)
+            except BaseException:
+                discard_upload_file(file)
+                raise
+            
+            self.destinations.append(str(destination))
+            self.name_conflict |= destination.name != filename
+            self.files_committed.append(describe_upload(destination, size,
+                hasher))
+    
+    def close(self) -> tuple:
+        """
+        Call after the whole body has been fed. Returns the result for
+        send_upload_result().
+        """
+        self.parser.close()
+        
+        if self.check:
+            if not self.check.verify():
+                return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                    'Content-Digest mismatch')
+            self.commit_files()
+        
+        if not self.files_field_found:
+            return (http.HTTPStatus.BAD_REQUEST, 'Field "files" not found')
+        
+        if not self.files_committed:
+            return (http.HTTPStatus.BAD_REQUEST, 'No files selected')
+        
+        # All of the files are flushed at once, so --durability group can put
+        # them in one batch
+        make_durable(self.handler, self.destinations)
+        
+        return (http.HTTPStatus.NO_CONTENT, 'Some filename(s) changed due to '
+            'name conflict' if self.name_conflict else 'Files accepted', {},
+            self.files_committed)
+    
+    def discard(self):
+        # Removes the file being received if the body ended partway through it,
+        # and any waiting for the whole body to be verified
+        if self.file:
+            discard_upload_file(self.file)
+            self.file = None
+        
+        for file, *_ in self.files_received:
+            discard_upload_file(file)
+        self.files_received = []
+
+# True return type is DigestCheck | None, but Python 3.9 doesn't support |
+def get_body_digest_check(handler: http.server.BaseHTTPRequestHandler,
+) -> object:
+    return new_digest_check(handler.headers.get('Content-Digest'),
+        handler.headers.get('Content-MD5'))
+
+# True argument type of length is int | None, and true return type is
+# tuple | None, but Python 3.9 doesn't support |
+def check_upload_length(length: int, limit: int) -> tuple:
+    """
+    Check whether a request body of the given length (None if unknown) can be
+    accepted under limit (0 for none). Returns an error result for
+    send_upload_result() if not.
+    """
+    if length is None:
+        return None
+    
+    if limit and length > limit:
+        return (http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Upload too large',
+            {})
+    
+    if length > shutil.disk_usage(args.directory).free:
+        return (http.HTTPStatus.INSUFFICIENT_STORAGE,
+            'Not enough free disk space', {})
+    
+    return None
+
+# True return type is tuple[tuple | None, MultipartUpload | None,
+# UploadBody | None], but Python 3.9 doesn't support |
+def start_upload(handler: http.server.BaseHTTPRequestHandler) -> tuple:
+    """
+    Check the headers of a POST to /upload. Returns (error, upload, body),
+    where error is a result for send_upload_result() if the upload can't go
+    ahead, and otherwise upload is a MultipartUpload to feed the body to.
+    """
+    try:
+        boundary = multipart.get_boundary(
+            handler.headers.get('Content-Type', ''))
+    except multipart.MultipartError as e:
+        return ((http.HTTPStatus.BAD_REQUEST, str(e)), None, None)
+    
+    length = None
+    if not is_chunked(handler):
+        try:
+            length = int(handler.headers.get('Content-Length', 0))
+        except ValueError:
+            return ((http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Length'),
+                None, None)
+    
+    error = check_upload_length(length, args.max_request_size)
+    if error:
+        return (error, None, None)
+    
+    try:
+        check = get_body_digest_check(handler)
+    except ValueError as e:
+        return ((http.HTTPStatus.BAD_REQUEST, str(e)), None, None)
+    
+    return (None, MultipartUpload(handler, boundary, check, length),
+        UploadBody(length, args.max_request_size, check))
+
+def receive_upload(handler: http.server.BaseHTTPRequestHandler) -> tuple:
+    error, upload, body = start_upload(handler)
+    if error:
+        return error
+    
+    if not body.reserve(INFLIGHT_WAIT_TIMEOUT):
+        return INFLIGHT_BUSY_RESULT
+    
+    try:
+        for chunk in iter_request_body(handler):
+            body.count(len(chunk))
+            upload.feed(chunk)
+        
+        return upload.close()
+    except multipart.MultipartError as e:
+        return (http.HTTPStatus.BAD_REQUEST, f'Malformed upload: {e}')
+    except UploadRejected as e:
+        return e.result
+    finally:
+        upload.discard()
+        body.close()
+
+# True return type is pathlib.PurePosixPath | None, but Python 3.9 doesn't
+# support |
+def sanitize_upload_path(path: str) -> pathlib.PurePosixPath:
+    """
+    Turn a client-supplied relative path into one that is safe to join onto the
+    upload directory. Empty and '.' components are dropped. Returns None if the
+    path is empty, tries to leave the upload directory, or is in
+    STATE_DIRECTORY.
+    """
+    parts = []
+    for part in path.split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..' or '\0' in part or os.sep in part or \
+        (os.altsep and os.altsep in part):
+            return None
+        parts.append(part)
+    
+    if not parts or is_state_name(parts[0]) or (os.name == 'nt' and
+    pathlib.PureWindowsPath(parts[0]).drive):
+        return None
+    
+    return pathlib.PurePosixPath(*parts)
+
+def is_state_name(name: str) -> bool:
+    """Whether name, in the upload directory, would be STATE_DIRECTORY."""
+    # Case-insensitive file systems take .UploadServer for it too, and Windows
+    # drops trailing dots and spaces
+    return name.rstrip('. ').casefold() == STATE_DIRECTORY
+
+def is_state_path(path: str) -> bool:
+    """
+    Whether path, from translate_path(), is in STATE_DIRECTORY, which holds
+    session IDs and files being uploaded, and so is never served.
+    """
+    try:
+        relative_path = pathlib.Path(path).resolve().relative_to(
+            pathlib.Path(args.directory).resolve())
+    except (OSError, ValueError, RuntimeError):
+        return False
+    
+    return bool(relative_path.parts) and is_state_name(relative_path.parts[0])
+
+def is_upload_request(handler: http.server.BaseHTTPRequestHandler) -> bool:
+    path = urllib.parse.urlsplit(handler.path).path
+    if path == '/upload' or get_session_id(handler) is not None:
+        return True
+    
+    # Raw uploads go to /upload/<name>. GETs there are ordinary downloads
+    return path.startswith('/upload/') and \
+        handler.command not in ('GET', 'HEAD')
+
+def get_file_body_limit() -> int:
+    # Request bodies that are a file on their own are under both limits
+    return min((limit for limit in (args.max_request_size,
+        args.max_file_size) if limit), default=0)
+
+# True return type is tuple | None, but Python 3.9 doesn't support |
+def make_upload_directories(relative_path: pathlib.PurePosixPath) -> tuple:
+    """
+    Create the directories a file uploaded to relative_path goes in. Returns an
+    error result for send_upload_result() if that can't be done.
+    """
+    try:
+        os.makedirs(pathlib.Path(args.directory) / relative_path.parent,
+            exist_ok=True)
+    except (FileExistsError, NotADirectoryError):
+        return (http.HTTPStatus.CONFLICT, 'Parent path is not a directory', {})
+    
+    return None
+
+# True return type is tuple[int, int, int] | None, but Python 3.9 doesn't
+# support |
+def parse_content_range(value: str) -> tuple:
+    """
+    Parse a Content-Range header of a request, e.g. 'bytes 0-99/1000'. Returns
+    the inclusive (first, last) byte positions and the total length, or None
+    if the header is malformed.
+    """
+    unit, _, spec = value.strip().partition(' ')
+    span, _, total = spec.partition('/')
+    first, _, last = span.partition('-')
+    if unit.lower() != 'bytes' or not all(position and
+    all(c in '0123456789' for c in position) for position in (first, last,
+    total)):
+        return None
+    
+    first, last, total = int(first), int(last), int(total)
+    if not first <= last < total:
+        return None
+    
+    return (first, last, total)
+
+# True return type is tuple[tuple | None, pathlib.PurePosixPath | None,
+# UploadBody | None, tuple | None], but Python 3.9 doesn't support |
+def start_raw_upload(handler: http.server.BaseHTTPRequestHandler) -> tuple:
+    """
+    Check the headers of PUT /upload/<path> and create the directories the
+    file goes in. Returns (error, relative_path, body, upload_range), where
+    error is a result for send_upload_result() if the upload can't go ahead,
+    and upload_range is the parsed Content-Range if the body is only part of
+    the file.
+    """
+    path = urllib.parse.urlsplit(handler.path).path[len('/upload/'):]
+    relative_path = sanitize_upload_path(urllib.parse.unquote(path))
+    if relative_path is None:
+        return ((http.HTTPStatus.BAD_REQUEST, 'Invalid upload path', {}),
+            None, None, None)
+    
+    length = None
+    if not is_chunked(handler):
+        try:
+            length = int(handler.headers['Content-Length'])
+        except (TypeError, ValueError):
+            return ((http.HTTPStatus.LENGTH_REQUIRED,
+                'Content-Length required', {}), None, None, None)
+    
+    limit = get_file_body_limit()
+    file_length = length
+    
+    upload_range = None
+    if 'Content-Range' in handler.headers:
+        upload_range = parse_content_range(handler.headers['Content-Range'])
+        if upload_range is None:
+            return ((http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Range',
+                {}), None, None, None)
+        
+        # Without a key, ranges of unrelated uploads of the same length to
+        # the same path would be put together into one file
+        if not handler.headers.get('Upload-Key'):
+            return ((http.HTTPStatus.BAD_REQUEST,
+                'Upload-Key required with Content-Range', {}), None, None,
+                None)
+        
+        first, last, file_length = upload_range
+        if length is not None and length != last - first + 1:
+            return ((http.HTTPStatus.BAD_REQUEST,
+                'Content-Length does not match Content-Range', {}), None,
+                None, None)
+    
+    error = check_upload_length(file_length, limit) or \
+        make_upload_directories(relative_path)
+    if error:
+        return (error, None, None, None)
+    
+    try:
+        check = get_body_digest_check(handler)
+    except ValueError as e:
+        return ((http.HTTPStatus.BAD_REQUEST, str(e), {}), None, None, None)
+    
+    if upload_range:
+        limit = last - first + 1
+    
+    return (None, relative_path, UploadBody(length, limit, check),
+        upload_range)
+
+# True argument type of hasher is hash object | None, but Python 3.9 doesn't
+# support |
+def raw_upload_result(destination: pathlib.Path,
+relative_path: pathlib.PurePosixPath, size: int, hasher: object) -> tuple:
+    description = describe_upload(destination, size, hasher)
+    return (http.HTTPStatus.CREATED, 'File renamed due to name conflict' if
+        destination != pathlib.Path(args.directory) / relative_path else
+        'File accepted', { 'Location': description['path'] }, [description])
+
+class RangedUpload:
+    """
+    A PUT of one range of a file, with Content-Range. Ranges may arrive in any
+    order, and several at once, and are written straight into a ranged upload
+    session's data at their own positions. Write the request body to file
+    with hashers, then call finish(). close() must be called afterwards
+    whatever happened.
+    """
+    def __init__(self, handler: http.server.BaseHTTPRequestHandler,
+    relative_path: pathlib.PurePosixPath, body: UploadBody,
+    upload_range: tuple):
+        self.handler = handler
+        self.relative_path = relative_path
+        self.body = body
+        self.first, self.last, length = upload_range
+        self.session = upload_sessions.get_ranged(relative_path.as_posix(),
+            length, handler.headers['Upload-Key'])
+        self.hashers = [body.check] if body.check else []
+        
+        # Each request has a file of its own, so positions don't clash
+        self.file = open(self.session.part_path, 'r+b')
+        try:
+            # Space for the whole file is reserved in one go, rather than
+            # range by range, so it isn't scattered
+            preallocate(self.file, length)
+        except BaseException:
+            self.file.close()
+            raise
+        self.file.seek(self.first)
+    
+    def finish(self, received: int) -> tuple:
+        """
+        Call once the request body has been written, with its length. Returns
+        the result for send_upload_result(). The range that completes the file
+        commits it like any other upload.
+        """
+        self.file.flush()
+        
+        if received != self.last - self.first + 1:
+            return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+        
+        # A corrupt range is not recorded, and is overwritten if sent again
+        if self.body.check and not self.body.check.verify():
+            return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                'Content-Digest mismatch', {})
+        
+        if not upload_sessions.add_range(self.session, self.first,
+        self.last):
+            return (http.HTTPStatus.ACCEPTED, 'Range received', {})
+        
+        # Ranges arrive out of order, so digests have to be taken afterwards
+        hasher = new_hasher()
+        content_hasher = new_content_hasher()
+        hashers = [h for h in (hasher, content_hasher) if h]
+        if hashers:
+            self.file.seek(0)
+            while chunk := self.file.read(UPLOAD_CHUNK_SIZE):
+                for h in hashers:
+                    h.update(chunk)
+        
+        destination = commit_upload(self.handler, self.file,
+            self.relative_path, hasher, content_hasher=content_hasher)
+        upload_sessions.remove(self.session.id)
+        
+        return raw_upload_result(destination, self.relative_path,
+            self.session.length, hasher)
+    
+    def close(self):
+        self.file.close()
+
+def receive_raw_upload(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    Handle PUT /upload/<path>, where the request body is the file itself, or
+    with Content-Range, part of it. Returns (status, message, headers).
+    """
+    error, relative_path, body, upload_range = start_raw_upload(handler)
+    if error:
+        return error
+    
+    if not body.reserve(INFLIGHT_WAIT_TIMEOUT):
+        return INFLIGHT_BUSY_RESULT
+    
+    if upload_range:
+        try:
+            upload = RangedUpload(handler, relative_path, body, upload_range)
+            try:
+                received = write_request_body(handler, upload.file, body,
+                    upload.hashers)
+                return upload.finish(received)
+            finally:
+                upload.close()
+        except UploadRejected as e:
+            return e.result
+        finally:
+            body.close()
+    
+    file = make_upload_file()
+    hasher = new_hasher()
+    content_hasher = new_content_hasher()
+    try:
+        if body.length:
+            preallocate(file, body.length)
+        
+        received = write_request_body(handler, file, body,
+            [h for h in (hasher, content_hasher, body.check) if h])
+        if body.length is not None and received != body.length:
+            discard_upload_file(file)
+            return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+        
+        if body.check and not body.check.verify():
+            discard_upload_file(file)
+            return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                'Content-Digest mismatch', {})
+        
+        destination = commit_upload(handler, file, relative_path, hasher,
+            content_hasher=content_hasher)
+    except UploadRejected as e:
+        discard_upload_file(file)
+        return e.result
+    except BaseException:
+        discard_upload_file(file)
+        raise
+    finally:
+        body.close()
+    
+    return raw_upload_result(destination, relative_path, received, hasher)
+
+# Formats POST /upload?extract=<format> takes
+ARCHIVE_FORMATS = ('tar', 'tar.gz', 'zip')
+
+# Largest archive kept in memory while it is received in full, as zip files
+# and archives sent with a digest are. Bigger ones go to a temp file
+MAX_SPOOLED_ARCHIVE_SIZE = 8 << 20
+
+# True return type is str | None, but Python 3.9 doesn't support |
+def get_extract_format(handler: http.server.BaseHTTPRequestHandler) -> str:
+    """For requests to /upload?extract=<format>, the format. None otherwise."""
+    url = urllib.parse.urlsplit(handler.path)
+    if url.path != '/upload':
+        return None
+    
+    return urllib.parse.parse_qs(url.query, keep_blank_values=True).get(
+        'extract', [None])[0]
+
+# True return type is tuple[tuple | None, str | None, UploadBody | None], but
+# Python 3.9 doesn't support |
+def start_archive_upload(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    Check the headers of a POST to /upload?extract=<format>. Returns (error,
+    format, body), where error is a result for send_upload_result() if the
+    upload can't go ahead.
+    """
+    archive_format = get_extract_format(handler)
+    if archive_format not in ARCHIVE_FORMATS:
+        return ((http.HTTPStatus.BAD_REQUEST, 'Unsupported archive format'),
+            None, None)
+    
+    length = None
+    if not is_chunked(handler):
+        try:
+            length = int(handler.headers.get('Content-Length', 0))
+        except ValueError:
+            return ((http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Length'),
+                None, None)
+    
+    error = check_upload_length(length, args.max_request_size)
+    if error:
+        return (error, None, None)
+    
+    try:
+        check = get_body_digest_check(handler)
+    except ValueError as e:
+        return ((http.HTTPStatus.BAD_REQUEST, str(e)), None, None)
+    
+    return (None, archive_format, UploadBody(length, args.max_request_size,
+        check))
+
+class RequestBodyReader(io.RawIOBase):
+    """
+    Read-only file object over an iterator of request body chunks, such as
+    iter_request_body(), for tarfile and zipfile. Chunks are counted against
+    body and fed to its digest check as they are read.
+    """
+    def __init__(self, chunks: object, body: UploadBody):
+        self.chunks = chunks
+        self.body = body
+        self.buffer = memoryview(b'')
+    
+    def readable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer: object) -> int:
+        if not self.buffer:
+            chunk = next(self.chunks, b'')
+            self.body.count(len(chunk))
+            if self.body.check:
+                self.body.check.update(chunk)
+            self.buffer = memoryview(chunk)
+        
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+class ArchiveUpload:
+    """
+    Extracts the files in an archive into the upload directory, each one
+    committed like a file of a form upload as soon as it has been read.
+    Member paths are sanitized like raw upload paths, and members that don't
+    have a safe one are skipped, as are links and special files. extract()
+    raises UploadRejected if --max-file-size or --max-files-per-request is
+    exceeded.
+    """
+    def __init__(self, handler: http.server.BaseHTTPRequestHandler):
+        self.handler = handler
+        self.files_started = 0
+        self.name_conflict = False
+        self.files_committed = []
+        self.destinations = []
+    
+    def extract(self, file: object, archive_format: str):
+        """
+        Extract the archive read from file. Tar archives are read in one pass,
+        but file has to be seekable for zip.
+        """
+        if archive_format == 'zip':
+            with zipfile.ZipFile(file) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        self.add_directory(info.filename)
+                    elif not stat.S_ISLNK(info.external_attr >> 16):
+                        with archive.open(info) as source:
+                            self.add_file(info.filename, info.file_size,
+                                source)
+            return
+        
+        with tarfile.open(fileobj=file, bufsize=UPLOAD_CHUNK_SIZE,
+        mode='r|gz' if archive_format == 'tar.gz' else 'r|') as archive:
+            for member in archive:
+                if member.isdir():
+                    self.add_directory(member.name)
+                elif member.isfile():
+                    self.add_file(member.name, member.size,
+                        archive.extractfile(member))
+    
+    # True return type is pathlib.PurePosixPath | None, but Python 3.9
+    # doesn't support |
+    def get_path(self, name: str) -> pathlib.PurePosixPath:
+        relative_path = sanitize_upload_path(name)
+        if relative_path is None:
+            self.handler.log_message('[Skipped] "%s": unsafe path', name)
+        
+        return relative_path
+    
+    def add_directory(self, name: str):
+        relative_path = self.get_path(name)
+        if relative_path is None:
+            return
+        
+        try:
+            os.makedirs(pathlib.Path(args.directory) / relative_path,
+                exist_ok=True)
+        except (FileExistsError, NotADirectoryError):
+            raise UploadRejected(http.HTTPStatus.CONFLICT,
+                f'Path "{relative_path}" is not a directory')
+    
+    def add_file(self, name: str, size: int, source: object):
+        relative_path = self.get_path(name)
+        if relative_path is None:
+            return
+        
+        self.files_started += 1
+        if args.max_files_per_request and \
+        self.files_started > args.max_files_per_request:
+            raise UploadRejected(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'Too many files')
+        
+        if args.max_file_size and size > args.max_file_size:
+            raise UploadRejected(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'File too large')
+        
+        error = make_upload_directories(relative_path)
+        if error:
+            raise UploadRejected(*error[:2])
+        
+        file = make_upload_file()
+        hasher = new_hasher()
+        content_hasher = new_content_hasher()
+        hashers = [h for h in (hasher, content_hasher) if h]
+        try:
+            if size:
+                preallocate(file, size)
+            
+            # Sizes in zip headers aren't checked until the data has been read
+            received = 0
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if args.max_file_size and received > args.max_file_size:
+                    raise UploadRejected(
+                        http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                        'File too large')
+                write_upload_chunk(file, hashers, chunk)
+            if received != size:
+                file.truncate(received)
+            
+            destination = commit_upload(self.handler, file, relative_path,
+                hasher, sync=False, content_hasher=content_hasher)
+        except BaseException:
+            discard_upload_file(file)
+            raise
+        
+        self.destinations.append(str(destination))
+        self.name_conflict |= destination != \
+            pathlib.Path(args.directory) / relative_path
+        self.files_committed.append(describe_upload(destination, received,
+            hasher))
+    
+    def close(self) -> tuple:
+        """Returns the result for send_upload_result()."""
+        if not self.files_committed:
+            return (http.HTTPStatus.BAD_REQUEST, 'No files in archive')
+        
+        make_durable(self.handler, self.destinations)
+        
+        return (http.HTTPStatus.NO_CONTENT, 'Some filename(s) changed due to '
+            'name conflict' if self.name_conflict else 'Files accepted', {},
+            self.files_committed)
+
+def extract_archive_upload(handler: http.server.BaseHTTPRequestHandler,
+archive_format: str, body: UploadBody, chunks: object) -> tuple:
+    """
+    Extract the archive that is the request body, from chunks, an iterator
+    of the body's chunks. Tar archives are extracted as they arrive. Zip
+    archives, which have their index at the end, and archives the client
+    sent a digest of, which has to be checked before anything is extracted,
+    are received in full first. Returns the result for send_upload_result().
+    """
+    upload = ArchiveUpload(handler)
+    reader = RequestBodyReader(chunks, body)
+    try:
+        if archive_format != 'zip' and not body.check:
+            upload.extract(reader, archive_format)
+            # Anything after the end of the archive is ignored
+            while reader.read(UPLOAD_CHUNK_SIZE):
+                pass
+            if body.length is not None and body.received != body.length:
+                return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete')
+            return upload.close()
+        
+        staging_directory = pathlib.Path(args.directory, STATE_DIRECTORY,
+            STAGING_DIRECTORY)
+        staging_directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.SpooledTemporaryFile(MAX_SPOOLED_ARCHIVE_SIZE,
+        dir=staging_directory) as spool:
+            while chunk := reader.read(UPLOAD_CHUNK_SIZE):
+                write_upload_chunk(spool, [], chunk)
+            
+            if body.length is not None and body.received != body.length:
+                return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete')
+            if body.check and not body.check.verify():
+                return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                    'Content-Digest mismatch')
+            
+            spool.seek(0)
+            upload.extract(spool, archive_format)
+            return upload.close()
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error) as e:
+        return (http.HTTPStatus.BAD_REQUEST, f'Malformed archive: {e}')
+    except UploadRejected as e:
+        return e.result
+
+def receive_archive_upload(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    Handle POST /upload?extract=<format>, where the request body is an
+    archive of files to upload.
+    """
+    error, archive_format, body = start_archive_upload(handler)
+    if error:
+        return error
+    
+    if not body.reserve(INFLIGHT_WAIT_TIMEOUT):
+        return INFLIGHT_BUSY_RESULT
+    
+    try:
+        return extract_archive_upload(handler, archive_format, body,
+            iter_request_body(handler))
+    finally:
+        body.close()
+
+UPLOAD_SESSION_PATH = '/upload/session'
+
+SESSION_NOT_FOUND_RESULT = (http.HTTPStatus.NOT_FOUND,
+    'Upload session not found', {})
+
+# Created by serve_forever()
+upload_sessions = None
+
+# True return type is str | None, but Python 3.9 doesn't support |
+def get_session_id(handler: http.server.BaseHTTPRequestHandler) -> str:
+    """
+    For requests to UPLOAD_SESSION_PATH itself, ''. For ones to a session under
+    it, the session ID. None for anything else.
+    """
+    path = urllib.parse.urlsplit(handler.path).path
+    if path == UPLOAD_SESSION_PATH:
+        return ''
+    
+    if path.startswith(UPLOAD_SESSION_PATH + '/'):
+        return path[len(UPLOAD_SESSION_PATH) + 1:]
+    
+    return None
+
+# True return type is sessions.Session | None, but Python 3.9 doesn't
+# support |
+def get_upload_session(handler: http.server.BaseHTTPRequestHandler) -> object:
+    return upload_sessions.get(get_session_id(handler))
+
+def get_session_headers(handler: http.server.BaseHTTPRequestHandler,
+session: sessions.Session) -> dict:
+    return {
+        'Upload-Offset': str(session.offset),
+        'Upload-Length': str(session.length),
+        'Upload-Expires': handler.date_time_string(session.expires),
+        'Cache-Control': 'no-store',
+    }
+
+def create_upload_session(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    Handle POST /upload/session?path=<path>, which starts a resumable upload of
+    Upload-Length bytes to path. The session's URL is sent back in Location,
+    for the data to be sent to with PATCH.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)
+    relative_path = sanitize_upload_path(query.get('path', [''])[0])
+    if relative_path is None:
+        return (http.HTTPStatus.BAD_REQUEST, 'Invalid upload path', {})
+    
+    try:
+        length = int(handler.headers['Upload-Length'])
+        if length < 0:
+            raise ValueError(length)
+    except (TypeError, ValueError):
+        return (http.HTTPStatus.BAD_REQUEST, 'Upload-Length required', {})
+    
+    error = check_upload_length(length, get_file_body_limit())
+    if error:
+        return error
+    
+    session = upload_sessions.create(relative_path.as_posix(), length)
+    return (http.HTTPStatus.CREATED, 'Upload session created', {
+        'Location': f'{UPLOAD_SESSION_PATH}/{session.id}',
+        **get_session_headers(handler, session),
+    })
+
+def get_upload_session_status(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    # Answers HEAD, which is how clients find out where to resume from
+    session = get_upload_session(handler)
+    if session is None:
+        return SESSION_NOT_FOUND_RESULT
+    
+    return (http.HTTPStatus.NO_CONTENT, 'Upload session found',
+        get_session_headers(handler, session))
+
+def delete_upload_session(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    session = get_upload_session(handler)
+    if session is None:
+        return SESSION_NOT_FOUND_RESULT
+    
+    try:
+        file = upload_sessions.open(session)
+    except sessions.SessionBusy:
+        return (http.HTTPStatus.CONFLICT, 'Upload session busy', {})
+    except FileNotFoundError:
+        return SESSION_NOT_FOUND_RESULT
+    
+    # Windows can't remove open files
+    file.close()
+    try:
+        upload_sessions.remove(session.id)
+    finally:
+        upload_sessions.release(session, None)
+    
+    return (http.HTTPStatus.NO_CONTENT, 'Upload session removed', {})
+
+# True return type is tuple[tuple | None, sessions.Session | None,
+# UploadBody | None], but Python 3.9 doesn't support |
+def start_session_upload(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    Check the headers of a PATCH to an upload session. Returns (error, session,
+    body), where error is a result for send_upload_result() if the upload
+    can't go ahead.
+    """
+    # Ranged sessions are only written to by PUT with Content-Range
+    session = get_upload_session(handler)
+    if session is None or session.ranged:
+        return (SESSION_NOT_FOUND_RESULT, None, None)
+    
+    try:
+        offset = int(handler.headers['Upload-Offset'])
+    except (TypeError, ValueError):
+        return ((http.HTTPStatus.BAD_REQUEST, 'Upload-Offset required', {}),
+            None, None)
+    
+    if offset != session.offset:
+        return ((http.HTTPStatus.CONFLICT, 'Upload-Offset does not match',
+            {}), None, None)
+    
+    length = None
+    if not is_chunked(handler):
+        try:
+            length = int(handler.headers.get('Content-Length', 0))
+        except ValueError:
+            return ((http.HTTPStatus.BAD_REQUEST, 'Invalid Content-Length',
+                {}), None, None)
+    
+    # UploadBody cuts chunked bodies off at the remaining length, except when
+    # that is 0, which means no limit
+    remaining = session.length - offset
+    if (length or 0) > remaining or (length is None and not remaining):
+        return ((http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+            'Upload exceeds Upload-Length', {}), None, None)
+    
+    try:
+        check = get_body_digest_check(handler)
+    except ValueError as e:
+        return ((http.HTTPStatus.BAD_REQUEST, str(e), {}), None, None)
+    
+    return (None, session, UploadBody(length, remaining, check))
+
+class SessionUpload:
+    """
+    A PATCH to an upload session, which holds the session so no other request
+    can write to it at the same time. Write the request body to file with
+    hashers, then call finish(). close() must be called afterwards whatever
+    happened. Raises UploadRejected if the session can't be written to.
+    """
+    def __init__(self, handler: http.server.BaseHTTPRequestHandler,
+    session: sessions.Session, body: UploadBody):
+        self.handler = handler
+        self.session = session
+        self.body = body
+        
+        try:
+            self.file = upload_sessions.open(session)
+        except sessions.SessionBusy:
+            raise UploadRejected(http.HTTPStatus.CONFLICT,
+                'Upload session busy')
+        except FileNotFoundError:
+            raise UploadRejected(*SESSION_NOT_FOUND_RESULT[:2])
+        
+        try:
+            # Another request may have written to the session since the
+            # headers were checked
+            self.offset = self.file.tell()
+            if self.offset != int(handler.headers['Upload-Offset']):
+                raise UploadRejected(http.HTTPStatus.CONFLICT,
+                    'Upload-Offset does not match')
+            
+            self.hasher = self.resume_hasher() if args.hash else None
+        except BaseException:
+            self.close()
+            raise
+        
+        self.hashers = [hasher for hasher in (self.hasher, body.check)
+            if hasher]
+    
+    def resume_hasher(self) -> object:
+        # Carries on from the earlier PATCHes' running hash if this process
+        # still has it, and otherwise hashes the data received so far
+        offset, hasher = upload_sessions.hashers.pop(self.session.id,
+            (None, None))
+        if offset == self.offset:
+            return hasher
+        
+        hasher = new_hasher()
+        with open(self.session.part_path, 'rb') as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+        
+        return hasher
+    
+    def finish(self, received: int) -> tuple:
+        """
+        Call once the request body has been written, with its length. Returns
+        the result for send_upload_result(). Once the whole upload has arrived,
+        it is committed like any other.
+        """
+        self.file.flush()
+        
+        if self.body.check and not self.body.check.verify():
+            # None of a corrupt body is kept
+            self.file.truncate(self.offset)
+            return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                'Content-Digest mismatch', {})
+        
+        offset = self.offset + received
+        if offset < self.session.length:
+            if self.hasher:
+                upload_sessions.hashers[self.session.id] = (offset,
+                    self.hasher)
+            
+            # What did arrive is kept, for the client to resume after
+            if self.body.length is not None and received != self.body.length:
+                return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+            
+            return (http.HTTPStatus.NO_CONTENT, 'Upload offset updated',
+                get_session_headers(self.handler, self.session))
+        
+        relative_path = pathlib.PurePosixPath(self.session.path)
+        error = make_upload_directories(relative_path)
+        if error:
+            return error
+        
+        destination = commit_upload(self.handler, self.file, relative_path,
+            self.hasher)
+        upload_sessions.remove(self.session.id)
+        
+        status, message, headers, files = raw_upload_result(destination,
+            relative_path, offset, self.hasher)
+        return (status, message, { **headers, 'Upload-Offset': str(offset) },
+            files)
+    
+    def close(self):
+        upload_sessions.release(self.session, self.file)
+
+def receive_session_upload(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    Handle PATCH /upload/session/<id>, which adds the request body to the
+    session's data at Upload-Offset.
+    """
+    error, session, body = start_session_upload(handler)
+    if error:
+        return error
+    
+    if not body.reserve(INFLIGHT_WAIT_TIMEOUT):
+        return INFLIGHT_BUSY_RESULT
+    
+    try:
+        upload = SessionUpload(handler, session, body)
+        try:
+            received = write_request_body(handler, upload.file, body,
+                upload.hashers)
+            return upload.finish(received)
+        finally:
+            upload.close()
+    except UploadRejected as e:
+        return e.result
+    finally:
+        body.close()
 
-DIRECTORY_BODY_INJECTION = b'''<!-- Injected by uploadserver -->
-<a href="/upload">File upload</a>
-(provided by uploadserver, all files go to server root)
-<hr>
-<!-- End injection by uploadserver -->
-'''
+# Request headers a client can give an upload's idempotency key in
+IDEMPOTENCY_KEY_HEADERS = ('Idempotency-Key', 'Upload-Id')
 
-def send_upload_page(handler: http.server.BaseHTTPRequestHandler):
-    handler.send_response(http.HTTPStatus.OK)
-    handler.send_header('Content-Type', 'text/html; charset=utf-8')
-    handler.send_header('Content-Length', len(get_upload_page(args.theme)))
-    handler.end_headers()
-    handler.wfile.write(get_upload_page(args.theme))
+# Most upload results kept for retries, oldest dropped first
+MAX_IDEMPOTENCY_KEYS = 100000
 
-class PersistentFieldStorage(cgi.FieldStorage):
-    # Override cgi.FieldStorage.make_file() method. Valid for Python 3.1 ~ 3.10.
-    # Modified version of the original .make_file() method (base copied from
-    # Python 3.10)
-    def make_file(self) -> object:
-        if self._binary_file:
-            return tempfile.NamedTemporaryFile(mode = 'wb+',
-                dir = args.directory, delete = False)
-        else:
-            return tempfile.NamedTemporaryFile("w+", dir = args.directory,
-                delete = False, encoding = self.encoding, newline = '\n')
+# Set in serve_forever()
+idempotency_keys = None
 
-# True argument/return type is str | pathlib.Path, but Python 3.9 doesn't
-# support |
-def auto_rename(path: pathlib.Path) -> pathlib.Path:
-    if not os.path.exists(path):
-        return path
-    (base, ext) = os.path.splitext(path)
-    for i in range(1, sys.maxsize):
-        renamed_path = f'{base} ({i}){ext}'
-        if not os.path.exists(renamed_path):
-            return renamed_path
-    raise FileExistsError(f'File {path} already exists.')
-
-def receive_upload(handler: http.server.BaseHTTPRequestHandler,
-) -> tuple[http.HTTPStatus, str]:
-    result = (http.HTTPStatus.INTERNAL_SERVER_ERROR, 'Server error')
-    name_conflict = False
-    
-    form = PersistentFieldStorage(fp=handler.rfile, headers=handler.headers,
-        environ={'REQUEST_METHOD': 'POST'})
-    if 'files' not in form:
-        return (http.HTTPStatus.BAD_REQUEST, 'Field "files" not found')
-    
-    fields = form['files']
-    if not isinstance(fields, list):
-        fields = [fields]
-    
-    if not all(field.file and field.filename for field in fields):
-        return (http.HTTPStatus.BAD_REQUEST, 'No files selected')
-    
-    for field in fields:
-        if field.file and field.filename:
-            filename = pathlib.Path(field.filename).name
-        else:
-            filename = None
-        
-        if filename:
-            destination = pathlib.Path(args.directory) / filename
-            if os.path.exists(destination):
-                if args.allow_replace and os.path.isfile(destination):
-                    os.remove(destination)
-                else:
-                    destination = auto_rename(destination)
-                    name_conflict = True
-            if hasattr(field.file, 'name'):
-                source = field.file.name
-                field.file.close()
-                os.rename(source, destination)
-            # class '_io.BytesIO', small file (< 1000B, in cgi.py), in-memory
-            # buffer
-            else:
-                with open(destination, 'wb') as f:
-                    f.write(field.file.read())
-            handler.log_message('[Uploaded] "%s" --> %s', filename, destination)
-            result = (http.HTTPStatus.NO_CONTENT, 'Some filename(s) changed '
-                'due to name conflict' if name_conflict else 'Files accepted')
+def get_idempotency_key(handler: http.server.BaseHTTPRequestHandler) -> str:
+    """The request's idempotency key, or '' if it has none."""
+    for header in IDEMPOTENCY_KEY_HEADERS:
+        key = handler.headers.get(header, '').strip()
+        if key:
+            return key
+    
+    return ''
+
+def get_idempotent_request(handler: http.server.BaseHTTPRequestHandler,
+) -> list:
+    # What a retry has to repeat to count as the same request
+    return [handler.command, handler.path,
+        handler.headers.get('Content-Range')]
+
+# True return type is tuple | None, but Python 3.9 doesn't support |
+def find_idempotent_result(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple:
+    """
+    For an upload whose idempotency key has been used before, the result to
+    send instead of receiving it: the original result if it is a retry, or an
+    error if not. None if the upload should go ahead.
+    """
+    key = get_idempotency_key(handler)
+    if not key:
+        return None
+    
+    try:
+        result = idempotency_keys.get(key, get_idempotent_request(handler))
+    except idempotency.KeyReused:
+        return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+            'Idempotency-Key already used for a different request')
+    
+    if result is None:
+        return None
+    
+    status, message, headers, files = result
+    return (status, message, { **headers, 'Idempotent-Replayed': 'true' },
+        files)
+
+def store_idempotent_result(handler: http.server.BaseHTTPRequestHandler,
+claim: idempotency.Claim, result: tuple):
+    # Failures aren't kept, so retrying them tries again
+    status, message = result[:2]
+    if status < http.HTTPStatus.BAD_REQUEST:
+        idempotency_keys.put(claim, get_idempotent_request(handler),
+            [int(status), message, result[2] if len(result) > 2 else {},
+            result[3] if len(result) > 3 else []])
+
+def receive_idempotent_upload(handler: http.server.BaseHTTPRequestHandler,
+receive: object) -> tuple:
+    """
+    Receive an upload with receive(handler), unless it has an Idempotency-Key
+    (or Upload-Id) header with a key used before, in which case it gets the
+    result find_idempotent_result() gives. Uploads with the same key are
+    received one at a time, so a retry of one still in progress waits for it
+    to finish.
+    """
+    key = get_idempotency_key(handler)
+    if not key:
+        return receive(handler)
+    
+    claim = idempotency_keys.acquire(key)
+    try:
+        result = find_idempotent_result(handler)
+        if not result:
+            result = receive(handler)
+            store_idempotent_result(handler, claim, result)
+            return result
+    finally:
+        idempotency_keys.release(claim)
+    
+    # The retry's body isn't needed, but is read anyway rather than leaving
+    # the client to find the connection reset before it reads the response
+    if result[0] < http.HTTPStatus.BAD_REQUEST:
+        try:
+            for _ in iter_request_body(handler):
+                pass
+        except ConnectionError:
+            handler.close_connection = True
     
     return result
 
+def send_upload_result(handler: http.server.BaseHTTPRequestHandler,
+result: tuple):
+    """
+    Send the response for a (status, message), (status, message, headers) or
+    (status, message, headers, files) tuple from one of the receive_*()
+    functions, where files lists describe_upload() results. Clients that
+    accept application/json get those in a JSON body.
+    """
+    status, message = result[:2]
+    headers = result[2] if len(result) > 2 else {}
+    files = result[3] if len(result) > 3 else []
+    # Timings belong to this request only, and the handler may serve more
+    timings = handler.__dict__.pop('timings', {})
+    
+    if status >= http.HTTPStatus.BAD_REQUEST:
+        handler.send_error(status, message)
+        return
+    
+    body = b''
+    if 'application/json' in handler.headers.get('Accept', ''):
+        if status == http.HTTPStatus.NO_CONTENT:
+            status = http.HTTPStatus.OK
+        body = json.dumps({ 'message': message, 'files': files }).encode()
+    
+    handler.send_response(status, message)
+    for keyword, value in headers.items():
+        handler.send_header(keyword, value)
+    if args.hash:
+        for description in files:
+            handler.send_header('Upload-Digest', f'{args.hash}='
+                f'{description[args.hash]}; path="{description["path"]}"')
+    if timings:
+        handler.send_header('Server-Timing', ', '.join(f'{name};dur='
+            f'{seconds*1000:.3f}' for name, seconds in timings.items()))
+    if body:
+        handler.send_header('Content-Type', 'application/json')
+    # 204 can't have a body, anything else needs its body framed for
+    # persistent connections
+    if status != http.HTTPStatus.NO_CONTENT:
+        handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+def send_bodiless_result(handler: http.server.BaseHTTPRequestHandler,
+discarded: bool, result: tuple):
+    """
+    send_upload_result() for requests that have no use for a body, once
+    discard_request_body() has been called. If it returned False, the
+    connection is closed after the response.
+    """
+    if not discarded:
+        handler.close_connection = True
+        result = (*result[:2], { **(result[2] if len(result) > 2 else {}),
+            'Connection': 'close' }, *result[3:])
+    
+    send_upload_result(handler, result)
+
 # True return type is tuple[bool, str | None], but Python 3.9 doesn't support |
 def check_http_authentication_header(
 handler: http.server.BaseHTTPRequestHandler, auth: tuple[bytes, bytes],
@@ -195,30 +2273,30 @@ handler: http.server.BaseHTTPRequestHandler, auth: tuple[bytes, bytes],
     
     return (True, None)
 
-def check_http_authentication(handler: http.server.BaseHTTPRequestHandler
-) -> bool:
+# True return type is tuple[bool, str | None], but Python 3.9 doesn't support |
+def authenticate_request(handler: http.server.BaseHTTPRequestHandler,
+) -> tuple[bool, str]:
     """
-    This function should be called in at the beginning of HTTP method handler.
-    It validates Authorization header and sends back 401 response on failure.
-    It returns False if this happens.
+    Apply the --basic-auth / --basic-auth-upload settings to a request. Returns
+    (valid, message) like check_http_authentication_header().
     """
     if not args.basic_auth_upload:
         # If no auth settings apply, check always passes
         if not args.basic_auth:
-            return True
+            return (True, None)
         
         # If only --basic-auth is supplied, it's used for all requests
         valid, message = check_http_authentication_header(handler, basic_auth)
     else:
         # If --basic-auth-upload is supplied, it's always required for /upload
-        if handler.path == '/upload':
+        if is_upload_request(handler):
             valid, message = check_http_authentication_header(handler,
                 basic_auth_upload)
         else:
             # For paths outside /upload, no auth is required when --basic-auth
             # is not supplied
             if not args.basic_auth:
-                return True
+                return (True, None)
             
             # For paths outise /upload, if both auths are supplied both are
             # accepted
@@ -230,11 +2308,28 @@ def check_http_authentication(handler: http.server.BaseHTTPRequestHandler
                     valid, message = check_http_authentication_header(handler,
                         basic_auth_upload)
     
+    return (valid, message)
+
+def send_unauthorized(handler: http.server.BaseHTTPRequestHandler,
+message: str, keep_alive: bool):
+    handler.log_message('Request rejected (%s)', message)
+    handler.send_response(http.HTTPStatus.UNAUTHORIZED, message)
+    handler.send_header('WWW-Authenticate', 'Basic realm="uploadserver"')
+    handler.send_header('Content-Length', '0')
+    if not keep_alive:
+        handler.send_header('Connection', 'close')
+    handler.end_headers()
+
+def check_http_authentication(handler: http.server.BaseHTTPRequestHandler
+) -> bool:
+    """
+    This function should be called in at the beginning of HTTP method handler.
+    It validates Authorization header and sends back 401 response on failure.
+    It returns False if this happens.
+    """
+    valid, message = authenticate_request(handler)
     if not valid:
-        handler.log_message('Request rejected (%s)', message)
-        handler.send_response(http.HTTPStatus.UNAUTHORIZED, message)
-        handler.send_header('WWW-Authenticate', 'Basic realm="uploadserver"')
-        handler.end_headers()
+        send_unauthorized(handler, message, discard_request_body(handler))
     
     return valid
 
@@ -246,7 +2341,8 @@ class ListDirectoryInterception:
         for i, header in enumerate(self._headers_buffer):
             if header[:15] == b'Content-Length:':
                 length = int(header[15:]) + len(DIRECTORY_BODY_INJECTION) + \
-                    len(get_directory_head_injection(args.theme))
+                    len(get_directory_head_injection(args.theme)) - \
+                    len(self.hidden_listing_entry)
                 
                 # Use same encoding that self.send_header() uses
                 self._headers_buffer[i] = f'Content-Length: {length}\r\n' \
@@ -261,6 +2357,8 @@ class ListDirectoryInterception:
         content = content.replace(b'</head>',
             get_directory_head_injection(args.theme) + b'</head>')
         content = content.replace(b'<ul>', DIRECTORY_BODY_INJECTION + b'<ul>')
+        if self.hidden_listing_entry:
+            content = content.replace(self.hidden_listing_entry, b'', 1)
         outputfile.write(content)
     
     # True argument type is str | pathlib.Path, but Python 3.9 doesn't support |
@@ -268,10 +2366,468 @@ class ListDirectoryInterception:
         setattr(self, 'flush_headers', self.flush_headers_interceptor)
         setattr(self, 'copyfile', self.copyfile_interceptor)
         
+        # STATE_DIRECTORY's line in the listing of the upload directory, as
+        # the stdlib writes it
+        self.hidden_listing_entry = b''
+        state_path = os.path.join(path, STATE_DIRECTORY)
+        if os.path.isdir(state_path) and not os.path.islink(state_path) and \
+        pathlib.Path(path).resolve() == pathlib.Path(args.directory).resolve():
+            self.hidden_listing_entry = (f'<li><a href="{STATE_DIRECTORY}/">'
+                f'{STATE_DIRECTORY}/</a></li>\n').encode()
+        
         # Can't use super() - avoiding diamond-pattern inheritance'
         return http.server.SimpleHTTPRequestHandler.list_directory(self, path)
 
-class SimpleHTTPRequestHandler(ListDirectoryInterception,
+# Let's not inherit http.server.SimpleHTTPRequestHandler - that would cause
+# diamond-pattern inheritance
+class ExpectContinue:
+    """
+    Clients that send Expect: 100-continue wait for an answer before sending
+    the body. Uploads that are bound to fail (bad credentials, wrong path,
+    unusable headers, not enough disk space) get their final error status
+    straight away instead, so the body is never sent.
+    """
+    def handle_expect_100(self):
+        if not self.check_expectation():
+            return False
+        
+        # Can't use super() - avoiding diamond-pattern inheritance'
+        return http.server.SimpleHTTPRequestHandler.handle_expect_100(self)
+    
+    def parse_request(self):
+        # Can't use super() - avoiding diamond-pattern inheritance'
+        if not http.server.SimpleHTTPRequestHandler.parse_request(self):
+            return False
+        
+        # The stdlib only calls handle_expect_100() when both sides speak
+        # HTTP/1.1. Otherwise there is no 100 Continue to send, but clients
+        # like curl still wait a moment for one, so errors can be sent early
+        if self.headers.get('Expect', '').lower() == '100-continue' and (
+        self.protocol_version < 'HTTP/1.1' or
+        self.request_version < 'HTTP/1.1'):
+            return self.check_expectation()
+        
+        return True
+    
+    def check_expectation(self) -> bool:
+        # Errors are sent with Connection: close, as the body is not read
+        valid, message = authenticate_request(self)
+        if not valid:
+            send_unauthorized(self, message, False)
+            return False
+        
+        if self.command not in ('POST', 'PUT', 'PATCH'):
+            return True
+        
+        # Retries of uploads already received get their result now too
+        if get_extract_format(self) is not None:
+            result = start_archive_upload(self)[0] or \
+                find_idempotent_result(self)
+        elif self.path == '/upload':
+            result = start_upload(self)[0] or find_idempotent_result(self)
+        elif self.command == 'PUT' and self.path.startswith('/upload/'):
+            result = start_raw_upload(self)[0] or \
+                find_idempotent_result(self)
+        elif self.command == 'PATCH' and get_session_id(self):
+            result = start_session_upload(self)[0]
+        elif self.command == 'POST' and get_session_id(self) == '':
+            result = None
+        elif isinstance(self, http.server.CGIHTTPRequestHandler):
+            # Everything else is up to the CGI script
+            return True
+        else:
+            result = (http.HTTPStatus.NOT_FOUND,
+                'Can only POST/PUT to /upload')
+        
+        if not result:
+            return True
+        
+        if result[0] < http.HTTPStatus.BAD_REQUEST:
+            result = (*result[:2], { **result[2], 'Connection': 'close' },
+                *result[3:])
+        send_upload_result(self, result)
+        return False
+
+# Seconds a connection may sit idle before its first request or between
+# requests before it is closed, so idle clients don't hold on to worker threads
+KEEP_ALIVE_TIMEOUT = 15
+
+# Let's not inherit http.server.SimpleHTTPRequestHandler - that would cause
+# diamond-pattern inheritance
+class PersistentConnections:
+    def handle_one_request(self):
+        # The listing interceptors are installed on the instance for one
+        # listing, and must not outlive it on a persistent connection (e.g.
+        # after a HEAD, which never calls copyfile)
+        self.__dict__.pop('flush_headers', None)
+        self.__dict__.pop('copyfile', None)
+        
+        # CGI handlers read unbuffered, so scripts get the rest of the body,
+        # and can't peek. TLS connections may already hold decrypted data
+        if not hasattr(self.rfile, 'peek'):
+            if not getattr(self.connection, 'pending', int)() and not \
+            select.select([self.connection], [], [], KEEP_ALIVE_TIMEOUT)[0]:
+                self.close_connection = True
+                return
+        else:
+            try:
+                self.connection.settimeout(KEEP_ALIVE_TIMEOUT)
+                self.rfile.peek(1)
+            # Same as TimeoutError on Python 3.10+
+            except socket.timeout:
+                self.close_connection = True
+                return
+            finally:
+                self.connection.settimeout(self.timeout)
+        
+        self.body_read = False
+        # Can't use super() - avoiding diamond-pattern inheritance'
+        http.server.SimpleHTTPRequestHandler.handle_one_request(self)
+        
+        # A body the request's handler didn't read would be taken for the next
+        # request, so small ones are thrown away and anything else closes
+        if self.close_connection or self.body_read or \
+        self.headers.get('Content-Length', '0') == '0' and \
+        not is_chunked(self):
+            return
+        try:
+            self.close_connection = not discard_request_body(self)
+        except OSError:
+            self.close_connection = True
+
+# Let's not inherit http.server.SimpleHTTPRequestHandler - that would cause
+# diamond-pattern inheritance
+class ZeroCopyDownloads:
+    # Regular files served over plain HTTP are handed to the kernel with
+    # sendfile(). Directory listings replace this method on the instance (see
+    # ListDirectoryInterception), and TLS connections keep the ordinary copy
+    def copyfile(self, source, outputfile):
+        if outputfile is self.wfile and \
+        zerocopy.can_sendfile(self.connection, source):
+            self.wfile.flush()
+            zerocopy.sendfile(self.connection, source)
+        else:
+            # Can't use super() - avoiding diamond-pattern inheritance'
+            http.server.SimpleHTTPRequestHandler.copyfile(self, source,
+                outputfile)
+    
+    def copyfile_range(self, source, outputfile, offset: int, count: int):
+        if outputfile is self.wfile and \
+        zerocopy.can_sendfile(self.connection, source):
+            self.wfile.flush()
+            zerocopy.sendfile(self.connection, source, offset, count)
+        else:
+            source.seek(offset)
+            while count > 0:
+                chunk = source.read(min(count, UPLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                outputfile.write(chunk)
+                count -= len(chunk)
+
+# Ranges beyond this many in one request are answered with the whole file
+# instead, since tiny ranges cost far more in part headers than they save
+MAX_RANGES = 100
+
+# True return type is list[tuple[int, int]] | None, but Python 3.9 doesn't
+# support |
+def parse_range_header(value: str, size: int) -> list:
+    """
+    Parse a Range header against a file of the given size. Returns a sorted list
+    of non-overlapping, inclusive (first, last) byte positions, an empty list if
+    no range is satisfiable, or None if the header is malformed or otherwise
+    should be ignored.
+    """
+    unit, sep, range_set = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    
+    ranges = []
+    for spec in range_set.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        
+        first, dash, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last) or \
+        not all(c in '0123456789' for c in first + last):
+            return None
+        
+        if not first:
+            # Suffix range, i.e. the last N bytes. An empty file has none
+            if int(last) == 0 or size == 0:
+                continue
+            ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < size:
+            ranges.append((first, min(int(last or size - 1), size - 1)))
+    
+    # Coalesce overlapping and adjacent ranges
+    ranges.sort()
+    coalesced = []
+    for first, last in ranges:
+        if coalesced and first <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], last))
+        else:
+            coalesced.append((first, last))
+    
+    if len(coalesced) > MAX_RANGES:
+        return None
+    
+    return coalesced
+
+# True return type is str | None, but Python 3.9 doesn't support |
+def get_archive_format(handler: http.server.BaseHTTPRequestHandler) -> str:
+    """For GET /<directory>/?archive=<format>, the format. None otherwise."""
+    url = urllib.parse.urlsplit(handler.path)
+    return urllib.parse.parse_qs(url.query, keep_blank_values=True).get(
+        'archive', [None])[0]
+
+class ArchiveDownload:
+    """
+    What send_head() returns for an archive of a directory: the archive's
+    pieces from archives.iter_archive(), and whether they are sent with
+    chunked transfer encoding or just end when the connection closes.
+    """
+    def __init__(self, pieces, chunked: bool):
+        self.pieces = pieces
+        self.chunked = chunked
+    
+    def close(self):
+        self.pieces.close()
+
+# True return type is ArchiveDownload | None, but Python 3.9 doesn't support |
+def send_archive_head(handler: http.server.BaseHTTPRequestHandler, path: str,
+archive_format: str) -> ArchiveDownload:
+    """
+    Send the headers for an archive of the directory at path. Nothing is
+    read from the directory until the archive itself is sent.
+    """
+    if archive_format not in archives.FORMATS:
+        handler.send_error(http.HTTPStatus.BAD_REQUEST,
+            'Unsupported archive format')
+        return None
+    
+    # The upload server's own files are left out
+    exclude = set()
+    with contextlib.suppress(OSError):
+        st = os.stat(pathlib.Path(args.directory, STATE_DIRECTORY))
+        exclude.add((st.st_dev, st.st_ino))
+    
+    name = urllib.parse.unquote(urllib.parse.urlsplit(handler.path).path
+        ).rstrip('/').rpartition('/')[2] or \
+        pathlib.Path(args.directory).resolve().name or 'archive'
+    
+    handler.send_response(http.HTTPStatus.OK)
+    handler.send_header('Content-Type', archives.FORMATS[archive_format])
+    handler.send_header('Content-Disposition', 'attachment; '
+        f"filename*=UTF-8''{urllib.parse.quote(f'{name}.{archive_format}')}")
+    
+    # The length isn't known until the archive has been made, so HTTP/1.0
+    # responses end by closing the connection
+    chunked = handler.request_version >= 'HTTP/1.1' and \
+        handler.protocol_version >= 'HTTP/1.1'
+    if chunked:
+        handler.send_header('Transfer-Encoding', 'chunked')
+    else:
+        handler.send_header('Connection', 'close')
+    handler.end_headers()
+    
+    return ArchiveDownload(archives.iter_archive(archive_format, path,
+        exclude), chunked)
+
+def send_archive(handler: http.server.BaseHTTPRequestHandler,
+download: ArchiveDownload):
+    """
+    Send the archive from send_archive_head(). File contents go out with
+    sendfile() where possible, and are read and written otherwise.
+    """
+    for piece in download.pieces:
+        if not isinstance(piece, archives.FileData):
+            handler.wfile.write(encode_chunk(piece) if download.chunked
+                else piece)
+        elif zerocopy.can_sendfile(handler.connection, piece.file):
+            if download.chunked:
+                handler.wfile.write(b'%x\r\n' % piece.size)
+            handler.wfile.flush()
+            sent = zerocopy.sendfile(handler.connection, piece.file, 0,
+                piece.size)
+            # Zeros in place of anything cut from the file since it was opened
+            for data in archives.iter_file_data(piece, sent):
+                handler.wfile.write(data)
+            if download.chunked:
+                handler.wfile.write(b'\r\n')
+        else:
+            for data in archives.iter_file_data(piece):
+                handler.wfile.write(encode_chunk(data) if download.chunked
+                    else data)
+    
+    if download.chunked:
+        handler.wfile.write(b'0\r\n\r\n')
+
+def encode_chunk(data: bytes) -> bytes:
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+# Let's not inherit http.server.SimpleHTTPRequestHandler - that would cause
+# diamond-pattern inheritance
+class RangeRequests:
+    # Only regular files are served in ranges. Everything else (directories,
+    # missing files, CGI scripts, requests without a usable Range header) goes
+    # to the stdlib's send_head()
+    def send_head(self):
+        self.ranges = None
+        
+        # CGI scripts send their own headers
+        if isinstance(self, http.server.CGIHTTPRequestHandler) and \
+        self.is_cgi():
+            return http.server.CGIHTTPRequestHandler.send_head(self)
+        
+        path = self.translate_path(self.path)
+        if is_state_path(path):
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+        
+        self.accept_ranges = not path.endswith('/') and os.path.isfile(path)
+        self.repr_digest = get_repr_digest(path) if self.accept_ranges and \
+            args.hash_sidecar else None
+        archive_format = get_archive_format(self)
+        if archive_format is not None and path.endswith('/') and \
+        os.path.isdir(path):
+            return send_archive_head(self, path, archive_format)
+        
+        if not self.accept_ranges or 'Range' not in self.headers:
+            return http.server.SimpleHTTPRequestHandler.send_head(self)
+        
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return http.server.SimpleHTTPRequestHandler.send_head(self)
+        
+        try:
+            fs = os.fstat(f.fileno())
+            last_modified = self.date_time_string(fs.st_mtime)
+            ranges = parse_range_header(self.headers['Range'], fs.st_size)
+            
+            # If-Range asks for the whole file if it has changed. No ETags are
+            # sent, so only a date can match
+            if_range = self.headers.get('If-Range')
+            if ranges is None or (if_range is not None and
+            if_range.strip() != last_modified):
+                f.close()
+                return http.server.SimpleHTTPRequestHandler.send_head(self)
+            
+            if not ranges:
+                f.close()
+                self.send_response(
+                    http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{fs.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            
+            ctype = self.guess_type(path)
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', last_modified)
+            
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                self.ranges = [(b'', first, last)]
+                self.ranges_trailer = b''
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Range',
+                    f'bytes {first}-{last}/{fs.st_size}')
+                self.send_header('Content-Length', str(last - first + 1))
+            else:
+                boundary = binascii.hexlify(os.urandom(16)).decode()
+                self.ranges = [(bytes(f'\r\n--{boundary}\r\n'
+                    f'Content-Type: {ctype}\r\n'
+                    f'Content-Range: bytes {first}-{last}/{fs.st_size}\r\n'
+                    '\r\n', 'latin-1'), first, last) for first, last in ranges]
+                self.ranges_trailer = bytes(f'\r\n--{boundary}--\r\n',
+                    'latin-1')
+                self.send_header('Content-Type',
+                    f'multipart/byteranges; boundary={boundary}')
+                self.send_header('Content-Length', str(sum(
+                    len(part_header) + last - first + 1
+                    for part_header, first, last in self.ranges
+                ) + len(self.ranges_trailer)))
+            
+            self.end_headers()
+            return f
+        except:
+            f.close()
+            raise
+    
+    # Advertise range support on full responses for files, and send the digest
+    # of the whole file with both full and partial responses
+    def send_response(self, code, message=None):
+        http.server.BaseHTTPRequestHandler.send_response(self, code, message)
+        
+        if code == http.HTTPStatus.OK and getattr(self, 'accept_ranges', False):
+            self.send_header('Accept-Ranges', 'bytes')
+        if code in (http.HTTPStatus.OK, http.HTTPStatus.PARTIAL_CONTENT) and \
+        getattr(self, 'repr_digest', None):
+            self.send_header('Repr-Digest', self.repr_digest)
+        self.accept_ranges = False
+        self.repr_digest = None
+    
+    def copyfile(self, source, outputfile):
+        if isinstance(source, ArchiveDownload):
+            return send_archive(self, source)
+        
+        if not getattr(self, 'ranges', None):
+            # Can't use super() - avoiding diamond-pattern inheritance'
+            return ZeroCopyDownloads.copyfile(self, source, outputfile)
+        
+        for part_header, first, last in self.ranges:
+            outputfile.write(part_header)
+            self.copyfile_range(source, outputfile, first, last - first + 1)
+        outputfile.write(self.ranges_trailer)
+
+class UploadSessions:
+    """
+    HEAD, PATCH and DELETE of upload sessions. Sessions are created by POST,
+    in do_POST().
+    """
+    def do_HEAD(self):
+        if not get_session_id(self):
+            # Can't use super() - avoiding diamond-pattern inheritance'
+            return http.server.SimpleHTTPRequestHandler.do_HEAD(self)
+        
+        if not check_http_authentication(self): return
+        
+        send_bodiless_result(self, discard_request_body(self),
+            get_upload_session_status(self))
+    
+    def do_PATCH(self):
+        if not get_session_id(self):
+            self.send_error(http.HTTPStatus.NOT_IMPLEMENTED,
+                f'Unsupported method ({self.command!r})')
+            return
+        
+        if not check_http_authentication(self): return
+        
+        send_upload_result(self, receive_session_upload(self))
+    
+    def do_DELETE(self):
+        if not get_session_id(self):
+            self.send_error(http.HTTPStatus.NOT_IMPLEMENTED,
+                f'Unsupported method ({self.command!r})')
+            return
+        
+        if not check_http_authentication(self): return
+        
+        send_bodiless_result(self, discard_request_body(self),
+            delete_upload_session(self))
+
+class SimpleHTTPRequestHandler(ListDirectoryInterception, PersistentConnections,
+    ExpectContinue, RangeRequests, ZeroCopyDownloads, UploadSessions,
     http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         if not check_http_authentication(self): return
@@ -284,22 +2840,30 @@ class SimpleHTTPRequestHandler(ListDirectoryInterception,
     def do_POST(self):
         if not check_http_authentication(self): return
         
-        if self.path == '/upload':
-            result = receive_upload(self)
-            
-            if result[0] < http.HTTPStatus.BAD_REQUEST:
-                self.send_response(result[0], result[1])
-                self.end_headers()
-            else:
-                self.send_error(result[0], result[1])
+        if get_extract_format(self) is not None:
+            send_upload_result(self, receive_idempotent_upload(self,
+                receive_archive_upload))
+        elif self.path == '/upload':
+            send_upload_result(self, receive_idempotent_upload(self,
+                receive_upload))
+        elif get_session_id(self) == '':
+            send_bodiless_result(self, discard_request_body(self),
+                create_upload_session(self))
         else:
             self.send_error(http.HTTPStatus.NOT_FOUND,
                 'Can only POST/PUT to /upload')
     
     def do_PUT(self):
-        self.do_POST()
+        if self.path.startswith('/upload/'):
+            if not check_http_authentication(self): return
+            
+            send_upload_result(self, receive_idempotent_upload(self,
+                receive_raw_upload))
+        else:
+            self.do_POST()
 
-class CGIHTTPRequestHandler(ListDirectoryInterception,
+class CGIHTTPRequestHandler(ListDirectoryInterception, PersistentConnections,
+    ExpectContinue, RangeRequests, ZeroCopyDownloads, UploadSessions,
     http.server.CGIHTTPRequestHandler):
     def do_GET(self):
         if not check_http_authentication(self): return
@@ -312,19 +2876,32 @@ class CGIHTTPRequestHandler(ListDirectoryInterception,
     def do_POST(self):
         if not check_http_authentication(self): return
         
-        if self.path == '/upload':
-            result = receive_upload(self)
-            
-            if result[0] < http.HTTPStatus.BAD_REQUEST:
-                self.send_response(result[0], result[1])
-                self.end_headers()
-            else:
-                self.send_error(result[0], result[1])
+        if get_extract_format(self) is not None:
+            send_upload_result(self, receive_idempotent_upload(self,
+                receive_archive_upload))
+        elif self.path == '/upload':
+            send_upload_result(self, receive_idempotent_upload(self,
+                receive_upload))
+        elif get_session_id(self) == '':
+            send_bodiless_result(self, discard_request_body(self),
+                create_upload_session(self))
         else:
             super().do_POST()
     
+    # Script output has no length to frame it with, so it ends when the
+    # connection closes
+    def run_cgi(self):
+        self.close_connection = True
+        super().run_cgi()
+    
     def do_PUT(self):
-        self.do_POST()
+        if self.path.startswith('/upload/'):
+            if not check_http_authentication(self): return
+            
+            send_upload_result(self, receive_idempotent_upload(self,
+                receive_raw_upload))
+        else:
+            self.do_POST()
 
 def intercept_first_print():
     if args.server_certificate:
@@ -336,7 +2913,7 @@ def intercept_first_print():
             builtins.print = old_print
         builtins.print = new_print
 
-def ssl_wrap(socket: socket.socket) -> ssl.SSLSocket:
+def create_ssl_context() -> ssl.SSLContext:
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     server_root = pathlib.Path(args.directory).resolve()
     
@@ -375,14 +2952,212 @@ def ssl_wrap(socket: socket.socket) -> ssl.SSLSocket:
                 f'server root "{server_root}", exiting')
             sys.exit(3)
     
-        context.load_verify_locations(cafile=client_certificate)
+        try:
+            context.load_verify_locations(cafile=client_certificate)
+        except ssl.SSLError as e:
+            print('SSL error: "{}", exiting'.format(e))
+            sys.exit(5)
         context.verify_mode = ssl.CERT_REQUIRED
     
+    return context
+
+# Seconds a client gets to complete the TLS handshake
+TLS_HANDSHAKE_TIMEOUT = 10
+
+def tls_accept(context: ssl.SSLContext, request: socket.socket,
+) -> ssl.SSLSocket:
+    """
+    Wrap an accepted connection and complete the TLS handshake. This runs on
+    the thread that will serve the connection, so a slow or stalled handshake
+    only holds up that one client. Raises OSError (including ssl.SSLError) if
+    the handshake fails or times out, after closing the connection.
+    """
+    request = context.wrap_socket(request, server_side=True,
+        do_handshake_on_connect=False)
+    
     try:
-        return context.wrap_socket(socket, server_side=True)
-    except ssl.SSLError as e:
-        print('SSL error: "{}", exiting'.format(e))
-        sys.exit(5)
+        timeout = request.gettimeout()
+        request.settimeout(TLS_HANDSHAKE_TIMEOUT)
+        request.do_handshake()
+        request.settimeout(timeout)
+    except OSError:
+        request.close()
+        raise
+    
+    return request
+
+# Sent to connections refused because the server is at --max-connections
+SERVICE_UNAVAILABLE_RESPONSE = (b'HTTP/1.0 503 Service Unavailable\r\n'
+    b'Retry-After: 1\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n'
+    b'\r\n')
+
+class BoundedThreadingMixIn:
+    """
+    Replaces socketserver.ThreadingMixIn's thread per connection with a fixed
+    pool of worker_threads threads fed from a queue of accepted connections.
+    With worker_threads = 0 there is still a thread per connection. Either way,
+    connections beyond max_connections (being served or queued) are refused
+    with a 503. With a pool, max_connections defaults to worker_threads plus
+    the listen backlog.
+    """
+    worker_threads = 0
+    max_connections = 0
+    
+    # Threads are started here rather than when the socket is bound, since a
+    # pre-forked worker process (see PreForkMixIn) does not inherit them
+    def serve_forever(self, poll_interval=0.5):
+        self.connection_count = 0
+        self.connection_count_lock = threading.Lock()
+        self.connection_queue = queue.SimpleQueue()
+        # Otherwise a burst of clients would wait in the queue unanswered for
+        # as long as it takes the pool to get to them
+        if self.worker_threads and not self.max_connections:
+            self.max_connections = self.worker_threads + \
+                self.request_queue_size
+        for _ in range(self.worker_threads):
+            threading.Thread(target=self.process_request_worker,
+                daemon=True).start()
+        
+        super().serve_forever(poll_interval)
+    
+    def process_request(self, request, client_address):
+        with self.connection_count_lock:
+            refuse = self.max_connections and \
+                self.connection_count >= self.max_connections
+            if not refuse:
+                self.connection_count += 1
+        
+        if refuse:
+            self.refuse_request(request, client_address)
+        elif self.worker_threads:
+            self.connection_queue.put((request, client_address))
+        else:
+            super().process_request(request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connection_count_lock:
+                self.connection_count -= 1
+    
+    def process_request_worker(self):
+        while True:
+            self.process_request_thread(*self.connection_queue.get())
+    
+    def refuse_request(self, request, client_address):
+        sys.stderr.write(f'{client_address[0]} - - Connection refused (server '
+            f'at --max-connections {self.max_connections})\n')
+        
+        # This runs on the accepting thread, so it must not block. A new
+        # socket's send buffer always has room for the response. HTTPS
+        # connections can't be answered without a TLS handshake, which is too
+        # slow to do here, so they are just closed
+        if getattr(self, 'ssl_context', None) is None:
+            with contextlib.suppress(OSError):
+                request.setblocking(False)
+                request.send(SERVICE_UNAVAILABLE_RESPONSE)
+        
+        self.shutdown_request(request)
+
+# A worker process that exits sooner than this many seconds after it was
+# started is restarted only after a pause, so a worker that crashes on startup
+# can't make the supervisor spin
+MIN_WORKER_PROCESS_LIFETIME = 1
+
+class PreForkMixIn:
+    """
+    With processes > 1, serve_forever() forks that many worker processes which
+    all accept connections from the one inherited listening socket, and the
+    original process becomes their supervisor. It restarts workers that die,
+    and forwards SIGINT, SIGTERM and SIGHUP to them. POSIX only.
+    """
+    processes = 1
+    
+    def serve_forever(self, poll_interval=0.5):
+        if self.processes <= 1:
+            return super().serve_forever(poll_interval)
+        
+        workers = {}
+        stopping = False
+        
+        def start_worker():
+            # Otherwise anything still buffered would be written once by each
+            # process
+            sys.stdout.flush()
+            sys.stderr.flush()
+            
+            pid = os.fork()
+            if pid == 0:
+                for signum in FORWARDED_SIGNALS:
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                
+                # Workers must never return into the supervisor's code
+                try:
+                    super(PreForkMixIn, self).serve_forever(poll_interval)
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    traceback.print_exc()
+                    sys.stderr.flush()
+                    os._exit(1)
+                os._exit(0)
+            
+            workers[pid] = time.monotonic()
+        
+        def forward_signal(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(pid, signum)
+        
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, forward_signal)
+        
+        for _ in range(self.processes):
+            start_worker()
+        
+        while workers:
+            pid, status = os.wait()
+            started = workers.pop(pid)
+            if stopping:
+                continue
+            
+            sys.stderr.write(f'Worker process {pid} exited with status '
+                f'{os.waitstatus_to_exitcode(status)}, restarting\n')
+            if time.monotonic() - started < MIN_WORKER_PROCESS_LIFETIME:
+                time.sleep(MIN_WORKER_PROCESS_LIFETIME)
+            start_worker()
+
+FORWARDED_SIGNALS = [getattr(signal, name) for name in
+    ('SIGINT', 'SIGTERM', 'SIGHUP') if hasattr(signal, name)]
+
+# Options added since serve_forever() was first used directly by extensions.
+# They are filled in with these defaults if missing, so such callers keep
+# working
+OPTIONAL_ARGUMENTS = {
+    'protocol': 'HTTP/1.0',
+    'worker_threads': 0,
+    'backlog': 128,
+    'max_connections': 0,
+    'processes': 1,
+    'engine': 'threading',
+    'max_request_size': 0,
+    'max_file_size': 0,
+    'max_files_per_request': 0,
+    'max_inflight_bytes': 0,
+    'hash': None,
+    'hash_sidecar': False,
+    'session_lifetime': 86400,
+    'dedup': False,
+    'idempotency_lifetime': 86400,
+    'durability': 'none',
+    'group_commit_window': 0.005,
+}
 
 def serve_forever():
     # Verify arguments in case the method was called directly
@@ -396,35 +3171,116 @@ def serve_forever():
     assert hasattr(args, 'basic_auth')
     assert hasattr(args, 'basic_auth_upload')
     assert hasattr(args, 'directory') and type(args.directory) is str
+    for name, default in OPTIONAL_ARGUMENTS.items():
+        if not hasattr(args, name): setattr(args, name, default)
+    
+    global upload_sessions
+    upload_sessions = sessions.SessionStore(
+        pathlib.Path(args.directory) / STATE_DIRECTORY, args.session_lifetime)
+    upload_sessions.collect()
+    collect_staging_files()
+    collect_upload_objects()
+    if args.dedup:
+        check_hard_links()
+    
+    global idempotency_keys
+    idempotency_keys = idempotency.IdempotencyStore(
+        pathlib.Path(args.directory) / STATE_DIRECTORY / 'idempotency',
+        args.idempotency_lifetime, MAX_IDEMPOTENCY_KEYS)
+    idempotency_keys.collect()
+    
+    global group_commit
+    group_commit = GroupCommit(args.group_commit_window)
     
     if args.cgi:
         handler_class = CGIHTTPRequestHandler
     else:
         handler_class = functools.partial(SimpleHTTPRequestHandler,
             directory=args.directory)
+        # http.server.test() sets the protocol on HandlerClass, which has no
+        # effect through a partial
+        SimpleHTTPRequestHandler.protocol_version = args.protocol
     
     print('File upload available at /upload')
     
-    class DualStackServer(http.server.ThreadingHTTPServer):
+    if args.engine == 'asyncio':
+        # Imported here so the threading engine doesn't pay for asyncio
+        from uploadserver import asyncserver
+        
+        intercept_first_print()
+        asyncserver.serve_forever(args)
+        return
+    
+    class DualStackServer(PreForkMixIn, BoundedThreadingMixIn,
+        http.server.ThreadingHTTPServer):
+        processes = args.processes
+        request_queue_size = args.backlog
+        worker_threads = args.worker_threads
+        max_connections = args.max_connections
+        
         def server_bind(self):
             # suppress exception when protocol is IPv4
             with contextlib.suppress(Exception):
                 self.socket.setsockopt(
                     socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
             bind = super().server_bind()
+            # The listening socket stays plain. Each connection is wrapped in
+            # finish_request(), on its own thread
+            self.ssl_context = None
             if args.server_certificate:
-                self.socket = ssl_wrap(self.socket)
+                self.ssl_context = create_ssl_context()
             return bind
+        
+        def finish_request(self, request, client_address):
+            if self.ssl_context is None:
+                return super().finish_request(request, client_address)
+            
+            # Failed handshakes are dropped silently, as they were when the
+            # handshake happened inside accept()
+            try:
+                request = tls_accept(self.ssl_context, request)
+            except OSError:
+                return
+            
+            try:
+                super().finish_request(request, client_address)
+            finally:
+                # The plain socket shut down by the caller no longer owns the
+                # connection
+                self.shutdown_request(request)
     server_class = DualStackServer
     
     intercept_first_print()
     http.server.test(
         HandlerClass=handler_class,
         ServerClass=server_class,
+        protocol=args.protocol,
         port=args.port,
         bind=args.bind,
     )
 
+SIZE_SUFFIXES = { 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40 }
+
+def parse_size(value: str) -> int:
+    """
+    argparse type for byte counts, which may have a K, M, G or T suffix
+    (powers of 1024), e.g. 512, 100K, 1.5G or 2GiB.
+    """
+    number = value.strip().lower().removesuffix('b').removesuffix('i')
+    multiplier = SIZE_SUFFIXES.get(number[-1:], 1)
+    if number[-1:] in SIZE_SUFFIXES:
+        number = number[:-1]
+    
+    try:
+        size = int(float(number) * multiplier)
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError(f'invalid size: {value!r}')
+    
+    if size < 0:
+        raise argparse.ArgumentTypeError(f'invalid size: {value!r}')
+    
+    return size
+
 def main():
     global args, basic_auth, basic_auth_upload
     
@@ -440,6 +3296,71 @@ def main():
         help='Specify alternate bind address [default: all interfaces]')
     parser.add_argument('--directory', '-d', default=os.getcwd(),
         help='Specify alternative directory [default:current directory]')
+    parser.add_argument('--protocol', default='HTTP/1.0',
+        choices=['HTTP/1.0', 'HTTP/1.1'],
+        help='HTTP version to use. HTTP/1.1 keeps connections open between '
+        'requests [default: HTTP/1.0]')
+    parser.add_argument('--worker-threads', '--workers-threads', type=int,
+        default=0, metavar='N',
+        help='Serve connections from a fixed pool of N threads instead of a '
+        'new thread per connection [default: 0, new thread per connection]')
+    parser.add_argument('--backlog', type=int, default=128, metavar='N',
+        help='Length of the queue of connections waiting to be accepted '
+        '[default: 128]')
+    parser.add_argument('--max-connections', type=int, default=0, metavar='N',
+        help='Refuse connections with 503 Service Unavailable while N are '
+        'being served or waiting for a worker thread [default: 0, no limit, '
+        'or with --worker-threads, worker threads plus backlog]')
+    parser.add_argument('--processes', type=int, default=1, metavar='N',
+        help='Serve from N worker processes sharing the listening socket, '
+        'restarted if they die (not available on Windows) [default: 1]')
+    parser.add_argument('--max-request-size', type=parse_size, default=0,
+        metavar='SIZE',
+        help='Refuse upload requests with bodies larger than SIZE, e.g. 500M '
+        'or 2G [default: 0, no limit]')
+    parser.add_argument('--max-file-size', type=parse_size, default=0,
+        metavar='SIZE',
+        help='Refuse uploads of files larger than SIZE [default: 0, no limit]')
+    parser.add_argument('--max-files-per-request', type=int, default=0,
+        metavar='N',
+        help='Refuse multipart uploads of more than N files '
+        '[default: 0, no limit]')
+    parser.add_argument('--max-inflight-bytes', type=parse_size, default=0,
+        metavar='SIZE',
+        help='Limit the total size of uploads being received at once. Others '
+        'wait, and get 503 Service Unavailable if they wait too long '
+        '[default: 0, no limit]')
+    parser.add_argument('--hash', choices=list(HASH_ALGORITHMS),
+        help='Compute a digest of each uploaded file while it is received, '
+        'and return it in the response [default: none]')
+    parser.add_argument('--hash-sidecar', action='store_true',
+        help='Save the --hash digest of each uploaded file next to it, e.g. '
+        'file.txt.sha256, and send it as Repr-Digest on download')
+    parser.add_argument('--dedup', action='store_true',
+        help='Store each distinct uploaded content once, and make uploads of '
+        'the same content hard links to it')
+    parser.add_argument('--durability', default='none',
+        choices=['none', 'file', 'group'],
+        help='Flush uploads to disk before answering: not at all, each file '
+        'on its own, or in batches shared by concurrent uploads (see '
+        '--group-commit-window) [default: none]')
+    parser.add_argument('--group-commit-window', type=float, default=0.005,
+        metavar='SECONDS',
+        help='How long --durability group waits for other uploads to join a '
+        'batch [default: 0.005]')
+    parser.add_argument('--session-lifetime', type=float, default=86400,
+        metavar='SECONDS',
+        help='Remove resumable upload sessions not written to for SECONDS '
+        '[default: 86400]')
+    parser.add_argument('--idempotency-lifetime', type=float, default=86400,
+        metavar='SECONDS',
+        help='Answer retries of uploads with an Idempotency-Key header with '
+        'the original result for SECONDS [default: 86400]')
+    parser.add_argument('--engine', default='threading',
+        choices=['threading', 'asyncio'],
+        help='Serve connections with a thread each, or with asyncio, which '
+        'copes better with many slow or idle clients. The asyncio engine does '
+        'not support --cgi or --processes [default: threading]')
     parser.add_argument('--theme', type=str, default='auto',
         choices=['light', 'auto', 'dark'],
         help='Specify a light or dark theme for the upload page '
@@ -457,6 +3378,13 @@ def main():
     
     args = parser.parse_args()
     if not hasattr(args, 'directory'): args.directory = os.getcwd()
+    if args.processes > 1 and not hasattr(os, 'fork'):
+        parser.error('--processes is not available on this platform')
+    if args.hash_sidecar and not args.hash:
+        parser.error('--hash-sidecar requires --hash')
+    if args.engine == 'asyncio' and (args.cgi or args.processes > 1):
+        parser.error('--cgi and --processes are not supported by the asyncio '
+            'engine')
     if args.bind:
         try:
             ipaddress.ip_address(args.bind)
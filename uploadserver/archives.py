@@ -0,0 +1,312 @@
+"""
+Archives of directory trees, made on the fly as they are sent. The tree is
+walked with os.scandir() one directory at a time and each file is read as its
+member is sent, so nothing like the whole archive or the whole file list is
+ever held in memory. The only exception is a zip file's central directory,
+which lists every member and has to come last; it is kept in a spooled temp
+file.
+
+iter_archive() yields the archive as pieces, which are either bytes or
+FileData. FileData is a span of a file whose bytes go into the archive as they
+are, which a sender can pass to sendfile() instead of reading it (tar members
+only, since gzip and zip need to see every byte).
+"""
+
+import os, stat, time, zlib, struct, tarfile, tempfile, contextlib
+
+# Content types of the formats iter_archive() makes
+FORMATS = {
+    'tar': 'application/x-tar',
+    'tar.gz': 'application/gzip',
+    'zip': 'application/zip',
+}
+
+# Size of reads from files, and of the pieces small ones are joined into
+CHUNK_SIZE = 1 << 16
+
+# Files smaller than this are read into the pieces around them instead of
+# being FileData, as sendfile() is slower than copying for small files
+MIN_FILE_DATA_SIZE = 1 << 16
+
+# Largest zip central directory kept in memory. Bigger ones go to a temp file
+MAX_SPOOLED_DIRECTORY_SIZE = 1 << 20
+
+# Sizes and offsets from this on need ZIP64 fields
+ZIP64_LIMIT = 0xFFFFFFFF
+
+# Member counts from this on need a ZIP64 end of central directory
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+# Version made by (Unix, 4.5), and versions needed to extract
+ZIP_CREATOR = (3 << 8) | 45
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+
+# General purpose flags: sizes and CRC follow in a data descriptor, and names
+# are UTF-8
+ZIP_DATA_DESCRIPTOR = 1 << 3
+ZIP_UTF8 = 1 << 11
+
+class FileData:
+    """
+    The first size bytes of file. If the file has shrunk since it was
+    opened, the rest are zeros.
+    """
+    def __init__(self, file: object, size: int):
+        self.file = file
+        self.size = size
+
+def iter_file_data(piece: FileData, offset: int = 0):
+    """Yield the bytes of piece from offset on, in chunks."""
+    remaining = piece.size - offset
+    piece.file.seek(offset)
+    while remaining > 0:
+        chunk = piece.file.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+    
+    while remaining > 0:
+        yield bytes(min(remaining, CHUNK_SIZE))
+        remaining -= CHUNK_SIZE
+
+# True type of exclude is set[tuple[int, int]], but Python 3.9 doesn't support
+# subscripting set
+def walk(root: str, exclude: set = frozenset()):
+    """
+    Yield (path, name, stat_result) for each directory and regular file under
+    root, depth first with each directory before its contents. Names are
+    relative to root, with / as separator and directories ending in one.
+    Symlinks to files are followed, but not symlinks to directories, so the
+    walk can't loop. Directories whose (st_dev, st_ino) is in exclude are left
+    out, as is anything that can't be read.
+    """
+    stack = [(os.scandir(root), '')]
+    try:
+        while stack:
+            entries, prefix = stack[-1]
+            try:
+                entry = next(entries, None)
+            except OSError:
+                entry = None
+            if entry is None:
+                stack.pop()[0].close()
+                continue
+            
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if (st.st_dev, st.st_ino) in exclude:
+                        continue
+                    name = f'{prefix}{entry.name}/'
+                    stack.append((os.scandir(entry.path), name))
+                elif entry.is_file():
+                    st = entry.stat()
+                    name = prefix + entry.name
+                else:
+                    continue
+            except OSError:
+                continue
+            
+            yield entry.path, name, st
+    finally:
+        for entries, _ in stack:
+            entries.close()
+
+# True return type is file object | None, but Python 3.9 doesn't support |
+def open_regular_file(path: str) -> object:
+    """
+    Open path for reading if it is still a regular file, or return None.
+    Something swapped in since the walk, like a FIFO, can't block the open.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0))
+    except OSError:
+        return None
+    
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return open(fd, 'rb')
+
+def iter_archive(archive_format: str, root: str, exclude: set = frozenset()):
+    """
+    Yield an archive of the tree under root in archive_format, one of
+    FORMATS, as bytes and FileData pieces. Members are named relative to
+    root, and exclude is as for walk().
+    """
+    if archive_format == 'zip':
+        pieces = iter_zip(root, exclude)
+    elif archive_format == 'tar.gz':
+        pieces = iter_gzip(iter_tar(root, exclude))
+    else:
+        pieces = iter_tar(root, exclude)
+    
+    # Headers and padding would otherwise be sent a few hundred bytes at a time
+    buffer = bytearray()
+    with contextlib.closing(pieces):
+        for piece in pieces:
+            if isinstance(piece, FileData):
+                if buffer:
+                    yield bytes(buffer)
+                    buffer.clear()
+                yield piece
+                continue
+            
+            buffer += piece
+            if len(buffer) >= CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+    
+    if buffer:
+        yield bytes(buffer)
+
+def iter_tar(root: str, exclude: set = frozenset()):
+    size = 0
+    for path, name, st in walk(root, exclude):
+        info = tarfile.TarInfo(name)
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            size += len(header)
+            yield header
+            continue
+        
+        file = open_regular_file(path)
+        if file is None:
+            continue
+        
+        with file:
+            # The size the member is given is the one the file has now
+            info.size = os.fstat(file.fileno()).st_size
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            size += len(header) + info.size
+            yield header
+            if info.size >= MIN_FILE_DATA_SIZE:
+                yield FileData(file, info.size)
+            else:
+                yield from iter_file_data(FileData(file, info.size))
+        
+        padding = -info.size % tarfile.BLOCKSIZE
+        size += padding
+        yield bytes(padding)
+    
+    # End of archive marker, then padding to a whole record
+    trailer = 2*tarfile.BLOCKSIZE
+    yield bytes(trailer + -(size + trailer) % tarfile.RECORDSIZE)
+
+def iter_gzip(pieces):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+        16 + zlib.MAX_WBITS)
+    with contextlib.closing(pieces):
+        for piece in pieces:
+            for data in iter_file_data(piece) \
+            if isinstance(piece, FileData) else (piece,):
+                compressed = compressor.compress(data)
+                if compressed:
+                    yield compressed
+    
+    yield compressor.flush()
+
+def get_dos_time(mtime: float) -> tuple:
+    # Zip files can only hold local times from 1980 to 2107
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    if t.tm_year > 2107:
+        return (23 << 11) | (59 << 5) | 29, (127 << 9) | (12 << 5) | 31
+    
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def iter_zip(root: str, exclude: set = frozenset()):
+    # Members are stored, not compressed. Each file's CRC is only known once
+    # it has been read, so it follows the file in a data descriptor
+    offset = 0
+    count = 0
+    with tempfile.SpooledTemporaryFile(MAX_SPOOLED_DIRECTORY_SIZE) as directory:
+        for path, name, st in walk(root, exclude):
+            encoded_name = name.encode('utf-8', 'surrogateescape')
+            dos_time, dos_date = get_dos_time(st.st_mtime)
+            header_offset = offset
+            
+            if stat.S_ISDIR(st.st_mode):
+                crc, size, flags = 0, 0, ZIP_UTF8
+                external_attributes = (st.st_mode << 16) | 0x10
+                header = struct.pack('<4s5H3L2H', b'PK\x03\x04', ZIP_VERSION,
+                    flags, 0, dos_time, dos_date, 0, 0, 0, len(encoded_name),
+                    0) + encoded_name
+                offset += len(header)
+                yield header
+            else:
+                file = open_regular_file(path)
+                if file is None:
+                    continue
+                
+                with file:
+                    size = os.fstat(file.fileno()).st_size
+                    flags = ZIP_UTF8 | ZIP_DATA_DESCRIPTOR
+                    external_attributes = (stat.S_IFREG |
+                        stat.S_IMODE(st.st_mode)) << 16
+                    
+                    # A local ZIP64 field has the sizes, which are zero here
+                    # as they follow in the data descriptor
+                    zip64 = size >= ZIP64_LIMIT
+                    extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+                    header = struct.pack('<4s5H3L2H', b'PK\x03\x04',
+                        ZIP64_VERSION if zip64 else ZIP_VERSION, flags, 0,
+                        dos_time, dos_date, 0,
+                        ZIP64_LIMIT if zip64 else 0,
+                        ZIP64_LIMIT if zip64 else 0,
+                        len(encoded_name), len(extra)) + encoded_name + extra
+                    yield header
+                    
+                    crc = 0
+                    for data in iter_file_data(FileData(file, size)):
+                        crc = zlib.crc32(data, crc)
+                        yield data
+                    
+                    descriptor = struct.pack('<4sL2Q' if zip64 else '<4s3L',
+                        b'PK\x07\x08', crc, size, size)
+                    yield descriptor
+                    offset += len(header) + size + len(descriptor)
+            
+            # Sizes and offset that don't fit go in a ZIP64 field instead
+            zip64_fields = []
+            if size >= ZIP64_LIMIT:
+                zip64_fields += [size, size]
+            if header_offset >= ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+            extra = struct.pack(f'<2H{len(zip64_fields)}Q', 1,
+                8*len(zip64_fields), *zip64_fields) if zip64_fields else b''
+            
+            directory.write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02',
+                ZIP_CREATOR, ZIP64_VERSION if zip64_fields else ZIP_VERSION,
+                flags, 0, dos_time, dos_date, crc, min(size, ZIP64_LIMIT),
+                min(size, ZIP64_LIMIT), len(encoded_name), len(extra), 0, 0,
+                0, external_attributes, min(header_offset, ZIP64_LIMIT)) +
+                encoded_name + extra)
+            count += 1
+        
+        directory_offset = offset
+        directory_size = directory.tell()
+        directory.seek(0)
+        while chunk := directory.read(CHUNK_SIZE):
+            yield chunk
+    
+    end = directory_offset + directory_size
+    if count >= ZIP64_COUNT_LIMIT or directory_offset >= ZIP64_LIMIT or \
+    end >= ZIP64_LIMIT:
+        yield struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, ZIP_CREATOR,
+            ZIP64_VERSION, 0, 0, count, count, directory_size,
+            directory_offset)
+        yield struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1)
+    
+    yield struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0,
+        min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+        min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT),
+        0)
@@ -0,0 +1,552 @@
+"""
+asyncio server engine, selected with --engine asyncio.
+
+Every connection is a coroutine instead of a thread, so thousands of slow or
+idle clients cost little more than their socket buffers. Requests are parsed
+and answered by the same handler code as the threading engine: AsyncHandler is
+an uploadserver.SimpleHTTPRequestHandler whose wfile is an in-memory buffer
+that is written to the connection between steps. Anything that touches the
+filesystem runs in the event loop's default executor, except archive
+extraction, which has a pool of its own.
+"""
+
+import asyncio, concurrent.futures, functools, http, io, sys
+
+import uploadserver
+
+# Longest request line plus headers accepted, as for http.server
+MAX_HEADER_SIZE = 1 << 16
+
+# Seconds between checks for room under --max-inflight-bytes, or for an
+# idempotency key to be free
+INFLIGHT_POLL_INTERVAL = 0.05
+
+# Archive uploads extracted at once. Each holds a thread of its own for as
+# long as its client takes to send the archive, so they get a pool of their
+# own rather than tying up the one everything else uses, and any more are
+# turned away
+MAX_ARCHIVE_EXTRACTIONS = 8
+
+ARCHIVE_BUSY_RESULT = (http.HTTPStatus.SERVICE_UNAVAILABLE,
+    'Too many archive uploads in progress, try again later')
+
+# Set by serve(). The pool archive uploads are extracted in, and how many are
+archive_executor = None
+archive_extractions = 0
+
+class AsyncHandler(uploadserver.SimpleHTTPRequestHandler):
+    # BaseHTTPRequestHandler.__init__() would serve the connection itself with
+    # blocking reads, so it is not called
+    def __init__(self, reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter, directory: str):
+        self.reader = reader
+        self.writer = writer
+        self.directory = directory
+        self.client_address = writer.get_extra_info('peername')
+        # Nothing here may use the socket directly
+        self.connection = None
+        self.server = None
+        self.rfile = None
+        self.wfile = io.BytesIO()
+        self.close_connection = True
+    
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function,
+            *args)
+    
+    async def flush(self):
+        """Send everything the handler code has written to wfile so far."""
+        data = self.wfile.getvalue()
+        if data:
+            self.wfile.seek(0)
+            self.wfile.truncate()
+            self.writer.write(data)
+        await self.writer.drain()
+    
+    async def handle(self):
+        try:
+            await self.handle_one_request(first=True)
+            while not self.close_connection:
+                await self.handle_one_request()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.close()
+    
+    async def handle_one_request(self, first: bool = False):
+        # The listing interceptors are installed on the instance for one
+        # listing, and must not outlive it (see PersistentConnections)
+        self.__dict__.pop('flush_headers', None)
+        self.__dict__.pop('copyfile', None)
+        self.close_connection = True
+        self.body_read = False
+        
+        try:
+            # Same idle timeout as the threading engine between requests
+            block = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'),
+                None if first else uploadserver.KEEP_ALIVE_TIMEOUT)
+        except asyncio.LimitOverrunError:
+            self.raw_requestline = b''
+            self.request_version = 'HTTP/0.9'
+            self.send_error(http.HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            await self.flush()
+            return
+        except asyncio.TimeoutError:
+            return
+        
+        # parse_request() reads the headers from rfile
+        self.raw_requestline, _, headers = block.partition(b'\n')
+        self.raw_requestline += b'\n'
+        self.rfile = io.BytesIO(headers)
+        
+        # Runs in the executor, since answering Expect: 100-continue may check
+        # the upload directory
+        if not await self.run(self.parse_request):
+            await self.flush()
+            return
+        
+        # parse_request() may have answered Expect: 100-continue
+        await self.flush()
+        
+        await self.dispatch()
+        await self.flush()
+        
+        # An unread body would be taken for the next request
+        if not self.body_read and (uploadserver.is_chunked(self) or
+        self.headers.get('Content-Length', '0') != '0'):
+            self.close_connection = True
+    
+    async def dispatch(self):
+        valid, message = uploadserver.authenticate_request(self)
+        if not valid:
+            uploadserver.send_unauthorized(self, message,
+                await self.discard_request_body())
+            return
+        
+        if self.command in ('GET', 'HEAD'):
+            if self.command == 'GET' and self.path == '/upload':
+                uploadserver.send_upload_page(self)
+            elif self.command == 'HEAD' and uploadserver.get_session_id(self):
+                uploadserver.send_bodiless_result(self,
+                    await self.discard_request_body(),
+                    await self.run(uploadserver.get_upload_session_status,
+                    self))
+            else:
+                await self.send_file()
+        elif self.command == 'POST' and \
+        uploadserver.get_extract_format(self) is not None:
+            uploadserver.send_upload_result(self,
+                await self.receive_idempotent_upload(
+                self.receive_archive_upload))
+        elif self.command == 'POST' and self.path == '/upload':
+            uploadserver.send_upload_result(self,
+                await self.receive_idempotent_upload(self.receive_upload))
+        elif self.command == 'POST' and uploadserver.get_session_id(self) == '':
+            uploadserver.send_bodiless_result(self,
+                await self.discard_request_body(),
+                await self.run(uploadserver.create_upload_session, self))
+        elif self.command == 'PUT' and self.path.startswith('/upload/'):
+            uploadserver.send_upload_result(self,
+                await self.receive_idempotent_upload(self.receive_raw_upload))
+        elif self.command == 'PATCH' and uploadserver.get_session_id(self):
+            uploadserver.send_upload_result(self,
+                await self.receive_session_upload())
+        elif self.command == 'DELETE' and uploadserver.get_session_id(self):
+            uploadserver.send_bodiless_result(self,
+                await self.discard_request_body(),
+                await self.run(uploadserver.delete_upload_session, self))
+        elif self.command in ('POST', 'PUT'):
+            self.send_error(http.HTTPStatus.NOT_FOUND,
+                'Can only POST/PUT to /upload')
+        else:
+            self.send_error(http.HTTPStatus.NOT_IMPLEMENTED,
+                f'Unsupported method ({self.command!r})')
+    
+    async def send_file(self):
+        f = await self.run(self.send_head)
+        if f is None:
+            return
+        
+        try:
+            if self.command == 'HEAD':
+                return
+            
+            if isinstance(f, uploadserver.ArchiveDownload):
+                await self.send_archive(f)
+                return
+            
+            # Directory listings are built in memory, and go through the
+            # listing injection in copyfile()
+            if isinstance(f, io.BytesIO):
+                self.copyfile(f, self.wfile)
+                return
+            
+            await self.flush()
+            loop = asyncio.get_running_loop()
+            # loop.sendfile() uses os.sendfile() where it can, and otherwise
+            # reads the file in the default executor
+            if self.ranges:
+                for part_header, first, last in self.ranges:
+                    self.writer.write(part_header)
+                    await loop.sendfile(self.writer.transport, f, first,
+                        last - first + 1)
+                self.writer.write(self.ranges_trailer)
+            else:
+                await loop.sendfile(self.writer.transport, f)
+        finally:
+            await self.run(f.close)
+    
+    async def send_archive(self, download: uploadserver.ArchiveDownload):
+        """
+        Async version of uploadserver.send_archive(). The archive is made in
+        the executor, a piece at a time.
+        """
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        while (piece := await self.run(next, download.pieces, None)) \
+        is not None:
+            if not isinstance(piece, uploadserver.archives.FileData):
+                self.writer.write(uploadserver.encode_chunk(piece)
+                    if download.chunked else piece)
+                await self.writer.drain()
+                continue
+            
+            if download.chunked:
+                self.writer.write(b'%x\r\n' % piece.size)
+            sent = await loop.sendfile(self.writer.transport, piece.file, 0,
+                piece.size)
+            # Zeros in place of anything cut from the file since it was opened
+            fill = uploadserver.archives.iter_file_data(piece, sent)
+            while data := await self.run(next, fill, None):
+                self.writer.write(data)
+                await self.writer.drain()
+            if download.chunked:
+                self.writer.write(b'\r\n')
+        
+        if download.chunked:
+            self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+    
+    async def iter_request_body(self):
+        """
+        Async version of uploadserver.iter_request_body(). Raises
+        ConnectionError if a chunked body is malformed.
+        """
+        self.body_read = True
+        
+        if uploadserver.is_chunked(self):
+            async for chunk in self.iter_chunked_body():
+                yield chunk
+            return
+        
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = await self.reader.read(min(remaining,
+                uploadserver.UPLOAD_CHUNK_SIZE))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+    
+    async def iter_chunked_body(self):
+        while True:
+            line = await self.read_chunk_line()
+            size = line.split(b';', 1)[0].strip()
+            if not size or size.strip(b'0123456789abcdefABCDEF'):
+                raise ConnectionError('Malformed chunked request body')
+            
+            size = int(size, 16)
+            if size == 0:
+                break
+            
+            while size > 0:
+                chunk = await self.reader.read(min(size,
+                    uploadserver.UPLOAD_CHUNK_SIZE))
+                if not chunk:
+                    raise ConnectionError('Chunked request body ended early')
+                size -= len(chunk)
+                yield chunk
+            
+            if await self.read_chunk_line() not in (b'\r\n', b'\n'):
+                raise ConnectionError('Malformed chunked request body')
+        
+        # Trailer fields are ignored
+        while await self.read_chunk_line() not in (b'\r\n', b'\n'):
+            pass
+    
+    async def read_chunk_line(self) -> bytes:
+        try:
+            line = await self.reader.readuntil(b'\n')
+        except asyncio.LimitOverrunError:
+            line = b''
+        
+        if len(line) > uploadserver.MAX_CHUNK_LINE or not line:
+            raise ConnectionError('Malformed chunked request body')
+        return line
+    
+    async def discard_request_body(self) -> bool:
+        # Same rules as uploadserver.discard_request_body()
+        if uploadserver.is_chunked(self):
+            return False
+        
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return False
+        
+        if length > uploadserver.MAX_DISCARD_SIZE:
+            return False
+        
+        async for _ in self.iter_request_body():
+            pass
+        
+        return True
+    
+    async def write_request_body(self, file: object,
+    body: uploadserver.UploadBody, hashers: list) -> int:
+        # Async version of uploadserver.write_request_body(), without splice()
+        received = 0
+        async for chunk in self.iter_request_body():
+            body.count(len(chunk))
+            await self.run(uploadserver.write_upload_chunk, file, hashers,
+                chunk)
+            received += len(chunk)
+        
+        return received
+    
+    async def reserve(self, body: uploadserver.UploadBody) -> bool:
+        # UploadBody.reserve() would block the event loop while it waits, so
+        # poll instead
+        deadline = asyncio.get_running_loop().time() + \
+            uploadserver.INFLIGHT_WAIT_TIMEOUT
+        while not body.reserve(0):
+            if asyncio.get_running_loop().time() >= deadline:
+                return False
+            await asyncio.sleep(INFLIGHT_POLL_INTERVAL)
+        
+        return True
+    
+    async def receive_idempotent_upload(self, receive: object) -> tuple:
+        # Async version of uploadserver.receive_idempotent_upload(), where
+        # receive is a coroutine function
+        key = uploadserver.get_idempotency_key(self)
+        if not key:
+            return await receive()
+        
+        # Waiting for the key in the executor could tie up the threads the
+        # request holding it needs to finish, so poll instead
+        while not (claim := await self.run(
+        uploadserver.idempotency_keys.acquire, key, False)):
+            await asyncio.sleep(INFLIGHT_POLL_INTERVAL)
+        
+        try:
+            result = await self.run(uploadserver.find_idempotent_result, self)
+            if not result:
+                result = await receive()
+                await self.run(uploadserver.store_idempotent_result, self,
+                    claim, result)
+                return result
+        finally:
+            await self.run(uploadserver.idempotency_keys.release, claim)
+        
+        if result[0] < http.HTTPStatus.BAD_REQUEST:
+            async for _ in self.iter_request_body():
+                pass
+        
+        return result
+    
+    async def receive_upload(self) -> tuple:
+        error, upload, body = await self.run(uploadserver.start_upload, self)
+        if error:
+            return error
+        
+        if not await self.reserve(body):
+            return uploadserver.INFLIGHT_BUSY_RESULT
+        
+        try:
+            async for chunk in self.iter_request_body():
+                body.count(len(chunk))
+                await self.run(upload.feed, chunk)
+            
+            return await self.run(upload.close)
+        except uploadserver.multipart.MultipartError as e:
+            return (http.HTTPStatus.BAD_REQUEST, f'Malformed upload: {e}')
+        except uploadserver.UploadRejected as e:
+            return e.result
+        finally:
+            await self.run(upload.discard)
+            body.close()
+    
+    async def receive_raw_upload(self) -> tuple:
+        error, relative_path, body, upload_range = await self.run(
+            uploadserver.start_raw_upload, self)
+        if error:
+            return error
+        
+        if not await self.reserve(body):
+            return uploadserver.INFLIGHT_BUSY_RESULT
+        
+        if upload_range:
+            try:
+                upload = await self.run(uploadserver.RangedUpload, self,
+                    relative_path, body, upload_range)
+                try:
+                    received = await self.write_request_body(upload.file, body,
+                        upload.hashers)
+                    return await self.run(upload.finish, received)
+                finally:
+                    await self.run(upload.close)
+            except uploadserver.UploadRejected as e:
+                return e.result
+            finally:
+                body.close()
+        
+        file = await self.run(uploadserver.make_upload_file)
+        hasher = uploadserver.new_hasher()
+        content_hasher = uploadserver.new_content_hasher()
+        try:
+            if body.length:
+                await self.run(uploadserver.preallocate, file, body.length)
+            
+            received = await self.write_request_body(file, body,
+                [h for h in (hasher, content_hasher, body.check) if h])
+            
+            if body.length is not None and received != body.length:
+                await self.run(uploadserver.discard_upload_file, file)
+                return (http.HTTPStatus.BAD_REQUEST, 'Upload incomplete', {})
+            
+            if body.check and not body.check.verify():
+                await self.run(uploadserver.discard_upload_file, file)
+                return (http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                    'Content-Digest mismatch', {})
+            
+            destination = await self.run(functools.partial(
+                uploadserver.commit_upload, self, file, relative_path, hasher,
+                content_hasher=content_hasher))
+        except uploadserver.UploadRejected as e:
+            await self.run(uploadserver.discard_upload_file, file)
+            return e.result
+        except BaseException:
+            await self.run(uploadserver.discard_upload_file, file)
+            raise
+        finally:
+            body.close()
+        
+        return uploadserver.raw_upload_result(destination, relative_path,
+            received, hasher)
+    
+    def iter_request_body_from_thread(self, loop: asyncio.AbstractEventLoop):
+        """
+        iter_request_body() for blocking code running in another thread, such
+        as tarfile, which waits on the event loop for each chunk.
+        """
+        chunks = self.iter_request_body()
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(chunks.__anext__(),
+                    loop).result()
+            except StopAsyncIteration:
+                return
+    
+    async def receive_archive_upload(self) -> tuple:
+        global archive_extractions
+        
+        error, archive_format, body = await self.run(
+            uploadserver.start_archive_upload, self)
+        if error:
+            return error
+        
+        if archive_extractions >= MAX_ARCHIVE_EXTRACTIONS:
+            body.close()
+            return ARCHIVE_BUSY_RESULT
+        
+        archive_extractions += 1
+        try:
+            if not await self.reserve(body):
+                return uploadserver.INFLIGHT_BUSY_RESULT
+            
+            # Archives are read by blocking code, so the whole extraction runs
+            # in a thread, which waits on the event loop for each chunk
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(archive_executor,
+                uploadserver.extract_archive_upload, self, archive_format,
+                body, self.iter_request_body_from_thread(loop))
+        finally:
+            archive_extractions -= 1
+            body.close()
+    
+    async def receive_session_upload(self) -> tuple:
+        error, session, body = await self.run(
+            uploadserver.start_session_upload, self)
+        if error:
+            return error
+        
+        if not await self.reserve(body):
+            return uploadserver.INFLIGHT_BUSY_RESULT
+        
+        try:
+            upload = await self.run(uploadserver.SessionUpload, self, session,
+                body)
+            try:
+                received = await self.write_request_body(upload.file, body,
+                    upload.hashers)
+                return await self.run(upload.finish, received)
+            finally:
+                await self.run(upload.close)
+        except uploadserver.UploadRejected as e:
+            return e.result
+        finally:
+            body.close()
+
+async def serve(args):
+    ssl_context = None
+    if args.server_certificate:
+        ssl_context = uploadserver.create_ssl_context()
+    
+    # --worker-threads sizes the pool that does the file I/O
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(args.worker_threads or None))
+    global archive_executor
+    archive_executor = concurrent.futures.ThreadPoolExecutor(
+        MAX_ARCHIVE_EXTRACTIONS)
+    
+    connection_count = 0
+    
+    async def handle_connection(reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter):
+        nonlocal connection_count
+        
+        if args.max_connections and connection_count >= args.max_connections:
+            sys.stderr.write(f'{writer.get_extra_info("peername")[0]} - - '
+                'Connection refused (server at --max-connections '
+                f'{args.max_connections})\n')
+            writer.write(uploadserver.SERVICE_UNAVAILABLE_RESPONSE)
+            writer.close()
+            return
+        
+        connection_count += 1
+        try:
+            await AsyncHandler(reader, writer, args.directory).handle()
+        finally:
+            connection_count -= 1
+    
+    server = await asyncio.start_server(handle_connection, args.bind,
+        args.port, ssl=ssl_context,
+        ssl_handshake_timeout=uploadserver.TLS_HANDSHAKE_TIMEOUT if ssl_context
+        else None, backlog=args.backlog, limit=MAX_HEADER_SIZE)
+    
+    # Same message as http.server.test()
+    host, port = server.sockets[0].getsockname()[:2]
+    url_host = f'[{host}]' if ':' in host else host
+    print(f'Serving HTTP on {host} port {port} '
+        f'(http://{url_host}:{port}/) ...')
+    
+    async with server:
+        await server.serve_forever()
+
+def serve_forever(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print('\nKeyboard interrupt received, exiting.')
+        sys.exit(0)
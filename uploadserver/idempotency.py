@@ -0,0 +1,220 @@
+"""
+On-disk table of upload results by Idempotency-Key, so a client that retries
+an upload it never got the answer to gets the original answer back instead of
+storing the file a second time.
+
+Each key is an <id>.json file in the table's directory, holding the request
+the key was first used for and the result it got. Only successful results are
+kept, so a failed upload can be retried for real. Entries expire a fixed time
+after they were stored, and the oldest are removed once there are more than
+the table holds.
+
+Requests with the same key are run one at a time: each holds <id>.lock while
+it runs, so a retry that arrives while the original is still being received
+waits for it, and then gets its result.
+"""
+
+import os, json, threading, time, contextlib, pathlib, hashlib, tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Entry IDs are this many hex digits of the SHA-256 of the key
+ID_LENGTH = 32
+
+# Seconds between sweeps for expired entries
+COLLECT_INTERVAL = 60
+
+class KeyReused(Exception):
+    """The key was first used for a different request."""
+
+class Claim:
+    """Holds a key, so other requests with it wait. See IdempotencyStore."""
+    def __init__(self, entry_id: str, thread_lock: threading.Lock,
+    file: object):
+        self.id = entry_id
+        self.thread_lock = thread_lock
+        self.file = file
+
+class IdempotencyStore:
+    """
+    Results in directory, which is created when the first one is stored. They
+    last lifetime seconds, and there are at most about max_entries of them.
+    """
+    def __init__(self, directory: pathlib.Path, lifetime: float,
+    max_entries: int):
+        self.directory = pathlib.Path(directory)
+        self.lifetime = lifetime
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Keyed by ID, the lock each key's requests in this process take
+        # turns with, and how many of them there are
+        self.thread_locks = {}
+        # Number of entries, or None if not known since the last sweep
+        self.count = None
+        self.next_collect = 0
+    
+    def get_id(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()[:ID_LENGTH]
+    
+    # True return type is tuple | None, but Python 3.9 doesn't support |
+    def get(self, key: str, request: list) -> tuple:
+        """
+        The result stored for key, or None if there isn't one. Raises
+        KeyReused if key was stored for a request other than request.
+        """
+        path = self.directory / f'{self.get_id(key)}.json'
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if os.path.getmtime(path) + self.lifetime <= time.time():
+                return None
+            stored_request, result = entry['request'], entry['result']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        
+        if stored_request != request:
+            raise KeyReused(key)
+        
+        return tuple(result)
+    
+    def put(self, claim: Claim, request: list, result: tuple):
+        """Store the result of the request claim was taken for."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        
+        # Readers never see a partly written entry
+        with tempfile.NamedTemporaryFile('w', dir=self.directory,
+        suffix='.tmp', delete=False) as f:
+            json.dump({ 'request': request, 'result': result }, f)
+        os.replace(f.name, self.directory / f'{claim.id}.json')
+        
+        with self.lock:
+            if self.count is not None:
+                self.count += 1
+            due = self.count is None or self.count > self.max_entries or \
+                time.monotonic() >= self.next_collect
+        
+        if due:
+            self.collect()
+    
+    # True return type is Claim | None, but Python 3.9 doesn't support |
+    def acquire(self, key: str, blocking: bool = True) -> Claim:
+        """
+        Claim key, waiting until no other request holds it, or if not
+        blocking, returning None if one does. The claim must be passed to
+        release() after.
+        """
+        entry_id = self.get_id(key)
+        with self.lock:
+            thread_lock, users = self.thread_locks.get(entry_id,
+                (threading.Lock(), 0))
+            self.thread_locks[entry_id] = (thread_lock, users + 1)
+        
+        if not thread_lock.acquire(blocking):
+            self.forget(entry_id)
+            return None
+        claim = Claim(entry_id, thread_lock, None)
+        
+        # Other worker processes have locks of their own in self.thread_locks
+        if fcntl:
+            try:
+                claim.file = self.lock_file(entry_id, blocking)
+            except BaseException:
+                self.release(claim)
+                raise
+            
+            if not claim.file:
+                self.release(claim)
+                return None
+        
+        return claim
+    
+    # True return type is file object | None, but Python 3.9 doesn't support |
+    def lock_file(self, entry_id: str, blocking: bool) -> object:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{entry_id}.lock'
+        while True:
+            file = open(path, 'a')
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX |
+                    (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                file.close()
+                return None
+            
+            # collect() may have removed the file while this waited for it, in
+            # which case the next request would lock a new one
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                    return file
+            file.close()
+    
+    def release(self, claim: Claim):
+        if claim.file:
+            claim.file.close()
+        claim.thread_lock.release()
+        self.forget(claim.id)
+    
+    def forget(self, entry_id: str):
+        with self.lock:
+            thread_lock, users = self.thread_locks[entry_id]
+            if users > 1:
+                self.thread_locks[entry_id] = (thread_lock, users - 1)
+            else:
+                del self.thread_locks[entry_id]
+    
+    def collect(self):
+        """
+        Remove expired entries, then the oldest ones past max_entries, and
+        any files left over from them.
+        """
+        now = time.time()
+        with self.lock:
+            self.next_collect = time.monotonic() + COLLECT_INTERVAL
+        
+        try:
+            paths = list(self.directory.iterdir())
+        except FileNotFoundError:
+            with self.lock:
+                self.count = 0
+            return
+        
+        entries = []
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                modified = os.path.getmtime(path)
+                if path.suffix == '.json' and modified + self.lifetime > now:
+                    entries.append((modified, path))
+                elif path.suffix in ('.json', '.tmp') and \
+                modified + self.lifetime <= now:
+                    os.remove(path)
+        
+        entries.sort()
+        surplus = max(len(entries) - self.max_entries, 0)
+        for _, path in entries[:surplus]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        
+        kept = { path.stem for _, path in entries[surplus:] }
+        for path in paths:
+            if path.suffix == '.lock' and path.stem not in kept:
+                self.remove_lock_file(path)
+        
+        with self.lock:
+            self.count = len(entries) - surplus
+    
+    def remove_lock_file(self, path: pathlib.Path):
+        # Only if no request holds or waits for it in this process, or holds
+        # it in another
+        with self.lock:
+            if path.stem in self.thread_locks:
+                return
+        
+        try:
+            with open(path, 'a') as file:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+        except (BlockingIOError, FileNotFoundError):
+            pass
@@ -0,0 +1,268 @@
+"""
+Incremental multipart/form-data parser.
+
+The parser does no I/O of its own. Bytes are pushed in with
+MultipartParser.feed() as they arrive from the socket, and each call returns
+the PartStart / PartData / PartEnd events found so far. Boundaries are located
+with bytes.find() over whole chunks rather than line by line, so binary bodies
+are scanned at memory speed no matter how few or how many newlines they have.
+"""
+
+import urllib.parse
+
+class MultipartError(ValueError):
+    pass
+
+class PartStart:
+    def __init__(self, headers: dict):
+        self.headers = headers
+        
+        disposition, options = parse_options_header(
+            headers.get('content-disposition', ''))
+        self.disposition = disposition
+        self.name = options.get('name')
+        # True type is str | None, but Python 3.9 doesn't support |
+        self.filename = options.get('filename')
+        self.content_type = headers.get('content-type', 'text/plain')
+    
+    def __repr__(self) -> str:
+        return f'PartStart(name={self.name!r}, filename={self.filename!r})'
+
+class PartData:
+    def __init__(self, data: bytes):
+        self.data = data
+    
+    def __repr__(self) -> str:
+        return f'PartData({len(self.data)} bytes)'
+
+class PartEnd:
+    def __repr__(self) -> str:
+        return 'PartEnd()'
+
+# Parser states
+_PREAMBLE = 0
+_AFTER_DELIMITER = 1
+_HEADERS = 2
+_BODY = 3
+_EPILOGUE = 4
+
+class MultipartParser:
+    def __init__(self, boundary: bytes, max_header_size: int = 1 << 16):
+        self.max_header_size = max_header_size
+        
+        self._delimiter = b'\r\n--' + boundary
+        self._state = _PREAMBLE
+        # Pretending the body is preceded by CRLF lets the first boundary be
+        # found by the same search as all the others
+        self._buffer = b'\r\n'
+    
+    @property
+    def complete(self) -> bool:
+        """True once the closing boundary has been seen."""
+        return self._state == _EPILOGUE
+    
+    def feed(self, data: bytes) -> list:
+        """
+        Push the next chunk of the body into the parser and return a list of
+        the events it completed. PartData events never hold bytes that might
+        turn out to be the start of a boundary, so a few bytes at the end of a
+        chunk may only be reported on the next call.
+        """
+        events = []
+        if self._state == _EPILOGUE or not data:
+            return events
+        
+        data = self._join_buffer(bytes(data), events)
+        delimiter = self._delimiter
+        pos = 0
+        
+        while True:
+            if self._state in (_PREAMBLE, _BODY):
+                i = data.find(delimiter, pos)
+                
+                if i == -1:
+                    # Hold back anything that could be a partial delimiter.
+                    # Delimiters start with CR, so only the last CR in the
+                    # final len(delimiter) - 1 bytes matters
+                    keep = data.rfind(b'\r',
+                        max(pos, len(data) - len(delimiter) + 1))
+                    if keep == -1:
+                        keep = len(data)
+                    
+                    if self._state == _BODY and keep > pos:
+                        events.append(PartData(data[pos:keep]))
+                    pos = keep
+                    break
+                
+                if self._state == _BODY:
+                    if i > pos:
+                        events.append(PartData(data[pos:i]))
+                    events.append(PartEnd())
+                
+                pos = i + len(delimiter)
+                self._state = _AFTER_DELIMITER
+            elif self._state == _AFTER_DELIMITER:
+                if len(data) - pos < 2:
+                    break
+                
+                if data.startswith(b'--', pos):
+                    self._state = _EPILOGUE
+                    pos = len(data)
+                    break
+                
+                eol = data.find(b'\r\n', pos)
+                if eol == -1:
+                    if len(data) - pos > self.max_header_size:
+                        raise MultipartError('Boundary line too long')
+                    break
+                
+                # Only linear whitespace (transport padding) may follow the
+                # boundary on its line
+                if data[pos:eol].strip(b' \t'):
+                    raise MultipartError('Malformed boundary line')
+                
+                pos = eol + 2
+                self._state = _HEADERS
+            elif self._state == _HEADERS:
+                if data.startswith(b'\r\n', pos):
+                    block = b''
+                    pos += 2
+                else:
+                    end = data.find(b'\r\n\r\n', pos)
+                    if end == -1:
+                        if len(data) - pos > self.max_header_size:
+                            raise MultipartError('Part headers too long')
+                        break
+                    
+                    block = data[pos:end]
+                    pos = end + 4
+                
+                if len(block) > self.max_header_size:
+                    raise MultipartError('Part headers too long')
+                
+                events.append(PartStart(parse_part_headers(block)))
+                self._state = _BODY
+        
+        self._buffer = data[pos:]
+        return events
+    
+    def close(self):
+        """
+        Call after the last chunk has been fed. Raises MultipartError if the
+        body ended before its closing boundary.
+        """
+        if self._state != _EPILOGUE:
+            raise MultipartError('Body ended before the closing boundary')
+    
+    def _join_buffer(self, data: bytes, events: list) -> bytes:
+        if not self._buffer:
+            return data
+        
+        # In the body, the held-back bytes are usually just a stray CR. If no
+        # delimiter starts in them, report them as data now instead of copying
+        # the whole new chunk onto the end of them
+        if self._state == _BODY and len(data) >= len(self._delimiter):
+            probe = self._buffer + data[:len(self._delimiter) - 1]
+            if probe.find(self._delimiter) == -1:
+                events.append(PartData(self._buffer))
+                self._buffer = b''
+                return data
+        
+        return self._buffer + data
+
+def parse_part_headers(block: bytes) -> dict:
+    """
+    Parse the header block of one part into a dict keyed by lowercase header
+    name.
+    """
+    headers = {}
+    name = None
+    
+    for line in block.decode('utf-8', 'replace').split('\r\n'):
+        # Obsolete line folding
+        if line[:1] in (' ', '\t') and name:
+            headers[name] += ' ' + line.strip()
+            continue
+        
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise MultipartError('Malformed part header')
+        
+        name = name.strip().lower()
+        headers[name] = value.strip()
+    
+    return headers
+
+def parse_options_header(value: str) -> tuple[str, dict]:
+    """
+    Split a header such as Content-Type or Content-Disposition into its main
+    value and a dict of its parameters, e.g.
+    'form-data; name="files"' -> ('form-data', {'name': 'files'})
+    """
+    parts = _split_params(value)
+    main_value = parts.pop(0).strip().lower()
+    options = {}
+    
+    for part in parts:
+        key, sep, option = part.partition('=')
+        key = key.strip().lower()
+        option = option.strip()
+        if not sep or not key:
+            continue
+        
+        if len(option) >= 2 and option[0] == option[-1] == '"':
+            option = option[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        
+        options[key] = option
+    
+    # RFC 5987 extended parameter, e.g. filename*=UTF-8''na%C3%AFve.txt
+    if 'filename*' in options:
+        charset, _, encoded = options['filename*'].partition("'")
+        _, _, encoded = encoded.partition("'")
+        
+        try:
+            options['filename'] = urllib.parse.unquote(encoded,
+                charset or 'utf-8', 'strict')
+        except (LookupError, UnicodeDecodeError):
+            pass
+    
+    return (main_value, options)
+
+def get_boundary(content_type: str) -> bytes:
+    """
+    Extract the boundary from a multipart/form-data Content-Type header.
+    Raises MultipartError if the header is not usable.
+    """
+    main_value, options = parse_options_header(content_type)
+    if main_value != 'multipart/form-data':
+        raise MultipartError('Expected multipart/form-data')
+    
+    boundary = options.get('boundary', '')
+    # RFC 2046 limits boundaries to 70 characters, but cgi.FieldStorage
+    # accepted up to 200 and some clients depend on that
+    if not 0 < len(boundary) <= 200 or not boundary.isascii() or \
+    not boundary.isprintable() or boundary.endswith(' '):
+        raise MultipartError('Invalid boundary in multipart form')
+    
+    return boundary.encode('ascii')
+
+def _split_params(value: str) -> list:
+    # Split on semicolons, except inside quoted strings
+    parts = []
+    start = 0
+    quoted = False
+    escaped = False
+    
+    for i, c in enumerate(value):
+        if escaped:
+            escaped = False
+        elif c == '\\' and quoted:
+            escaped = True
+        elif c == '"':
+            quoted = not quoted
+        elif c == ';' and not quoted:
+            parts.append(value[start:i])
+            start = i + 1
+    
+    parts.append(value[start:])
+    return parts
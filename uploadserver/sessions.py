@@ -0,0 +1,212 @@
+"""
+On-disk state for resumable upload sessions, so uploads interrupted partway can
+carry on from where they stopped, even after a server restart.
+
+Each session is a pair of files in the state directory: <id>.json with what
+the client asked for, and <id>.part with the bytes received so far. The offset
+is the size of the .part file, so it can't get out of step with the data if
+the server dies mid-write. Sessions expire a fixed time after their data was
+last written to, and are removed by collect() or when next looked up.
+
+Ranged sessions are for files sent as byte ranges in any order, by separate
+requests that may arrive at once. Each request extends the .part file to full
+size before writing its range, and <id>.ranges lists the ranges that have
+been written.
+"""
+
+import os, json, secrets, threading, time, contextlib, pathlib, hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Session IDs are this many hex digits
+ID_LENGTH = 32
+
+class SessionBusy(Exception):
+    """Another request is already writing to the session."""
+
+class Session:
+    def __init__(self, store: 'SessionStore', session_id: str, state: dict):
+        self.store = store
+        self.id = session_id
+        self.path = state['path']
+        self.length = state['length']
+        self.ranged = state.get('ranged', False)
+        self.part_path = store.directory / f'{session_id}.part'
+        self.ranges_path = store.directory / f'{session_id}.ranges'
+    
+    @property
+    def offset(self) -> int:
+        return os.path.getsize(self.part_path)
+    
+    @property
+    def expires(self) -> float:
+        return os.path.getmtime(self.part_path) + self.store.lifetime
+
+class SessionStore:
+    """
+    Upload sessions in directory, which is created when the first one is.
+    Sessions last lifetime seconds after their last write.
+    """
+    def __init__(self, directory: pathlib.Path, lifetime: float):
+        self.directory = pathlib.Path(directory)
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        self.active = set()
+        # Running hashes of sessions' data, so --hash doesn't have to read it
+        # back. Keyed by ID, with the offset they were taken at
+        self.hashers = {}
+    
+    def create(self, path: str, length: int) -> Session:
+        self.collect()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        
+        session_id = secrets.token_hex(ID_LENGTH // 2)
+        state = { 'path': path, 'length': length }
+        # The data file comes first, so every session with state has data
+        (self.directory / f'{session_id}.part').touch(exist_ok=False)
+        with open(self.directory / f'{session_id}.json', 'x') as f:
+            json.dump(state, f)
+        
+        return Session(self, session_id, state)
+    
+    # True return type is Session | None, but Python 3.9 doesn't support |
+    def get(self, session_id: str) -> Session:
+        """The session with session_id, or None if it is unknown or expired."""
+        if len(session_id) != ID_LENGTH or \
+        session_id.strip('0123456789abcdef'):
+            return None
+        
+        # State that can't be read may still be being written. If not,
+        # collect() removes it once it is old enough
+        try:
+            with open(self.directory / f'{session_id}.json') as f:
+                session = Session(self, session_id, json.load(f))
+            if session.expires > time.time():
+                return session
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        
+        self.remove(session_id)
+        return None
+    
+    def get_ranged(self, path: str, length: int, key: str) -> Session:
+        """
+        The ranged session for a file of length bytes going to path, created
+        if this is the first range of it to arrive. Ranges of the same file
+        are told apart from other uploads to path by key, which the client
+        chooses.
+        """
+        session_id = hashlib.sha256(json.dumps([path, length, key]).encode()
+            ).hexdigest()[:ID_LENGTH]
+        session = self.get(session_id)
+        if session:
+            return session
+        
+        self.collect()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        
+        state = { 'path': path, 'length': length, 'ranged': True }
+        session = Session(self, session_id, state)
+        # Any number of first ranges may get here at once, so nothing is
+        # created in a way that would disturb another's
+        session.part_path.touch()
+        with contextlib.suppress(FileExistsError):
+            with open(self.directory / f'{session_id}.json', 'x') as f:
+                json.dump(state, f)
+        
+        return session
+    
+    def add_range(self, session: Session, first: int, last: int) -> bool:
+        """
+        Record that bytes first to last of a ranged session's data have been
+        written. Returns True to the one call that completes the data.
+        """
+        with self.lock, open(session.ranges_path, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            
+            f.seek(0)
+            ranges = [tuple(int(position) for position in line.split('-'))
+                for line in f.read().split()]
+            complete = is_complete(ranges, session.length)
+            
+            f.write(f'{first}-{last}\n')
+            f.flush()
+            return not complete and \
+                is_complete(ranges + [(first, last)], session.length)
+    
+    def remove(self, session_id: str):
+        self.hashers.pop(session_id, None)
+        for suffix in ('.json', '.part', '.ranges'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.directory / f'{session_id}{suffix}')
+    
+    def open(self, session: Session) -> object:
+        """
+        Open the session's data for writing at the end, for one request at a
+        time. Raises SessionBusy if it is already open, and FileNotFoundError
+        if the session has gone. The file must be passed to release() after.
+        """
+        with self.lock:
+            if session.id in self.active:
+                raise SessionBusy(session.id)
+            self.active.add(session.id)
+        
+        try:
+            file = open(session.part_path, 'r+b')
+        except BaseException:
+            self.release(session, None)
+            raise
+        
+        # Other worker processes have sessions of their own in self.active
+        if fcntl:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.release(session, file)
+                raise SessionBusy(session.id)
+        
+        file.seek(0, os.SEEK_END)
+        return file
+    
+    # True argument type of file is file object | None, but Python 3.9 doesn't
+    # support |
+    def release(self, session: Session, file: object):
+        if file:
+            file.close()
+        
+        with self.lock:
+            self.active.discard(session.id)
+    
+    def collect(self):
+        """Remove expired sessions, and any files left over from them."""
+        now = time.time()
+        try:
+            paths = list(self.directory.iterdir())
+        except FileNotFoundError:
+            return
+        
+        for path in paths:
+            if path.suffix not in ('.json', '.part', '.ranges') or \
+            path.stem in self.active:
+                continue
+            
+            # A session's expiry goes by its data file
+            part_path = path.with_suffix('.part')
+            with contextlib.suppress(FileNotFoundError):
+                if os.path.getmtime(part_path if part_path.exists() else path
+                ) + self.lifetime <= now:
+                    self.remove(path.stem)
+
+def is_complete(ranges: list, length: int) -> bool:
+    """Whether inclusive (first, last) ranges cover all of 0 to length - 1."""
+    covered = 0
+    for first, last in sorted(ranges):
+        if first > covered:
+            return False
+        covered = max(covered, last + 1)
+    
+    return covered >= length
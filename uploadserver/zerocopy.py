@@ -0,0 +1,138 @@
+"""
+Helpers for moving request and response bodies between sockets and files
+without copying them through Python. They only work on plain TCP sockets,
+since TLS has to encrypt or decrypt every byte in userspace anyway. Check
+can_splice() / can_sendfile() before use; callers keep their normal copy loops
+for everything else.
+"""
+
+import os, socket, select, errno, contextlib, stat
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Size requested for the splice() pipe. Linux defaults to 64 KiB, and a bigger
+# pipe means fewer syscalls per byte
+PIPE_SIZE = 1 << 20
+
+# Errors meaning splice() is not supported for this pair of file descriptors,
+# rather than that something went wrong with the transfer itself
+_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV)
+
+def can_splice(sock: socket.socket) -> bool:
+    # ssl.SSLSocket is a subclass of socket.socket, so check the exact type
+    return hasattr(os, 'splice') and type(sock) is socket.socket
+
+def can_sendfile(sock: socket.socket, file: object) -> bool:
+    if not hasattr(os, 'sendfile') or type(sock) is not socket.socket:
+        return False
+    
+    try:
+        return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        # In-memory buffers such as the BytesIO used for directory listings
+        return False
+
+def sendfile(sock: socket.socket, file: object, offset: int = 0,
+count: int = None) -> int:
+    """
+    Send count bytes of file (all of it if count is None) starting at offset,
+    with os.sendfile() where possible. Returns the number of bytes sent.
+    """
+    return sock.sendfile(file, offset, count)
+
+def splice_to_file(rfile: object, sock: socket.socket, file: object,
+length: int) -> int:
+    """
+    Move up to length bytes of request body into file, starting at the
+    file's current position. rfile is the buffered reader wrapping sock; any
+    bytes it has already pulled off the socket are written first. Returns the
+    number of bytes moved, which is less than length only if the client closed
+    the connection early.
+    """
+    # The request line and headers were read through rfile, which will usually
+    # have buffered the start of the body too
+    buffered = b''
+    if length > 0:
+        buffered = rfile.read(min(len(rfile.peek(1)), length))
+        file.write(buffered)
+    file.flush()
+    received = len(buffered)
+    
+    # Nothing at all to peek at means the client has already gone away
+    if buffered and received < length:
+        received += _splice_loop(rfile, sock, file, length - received)
+    
+    # The file's own idea of its position is out of date after writing to its
+    # file descriptor directly
+    file.seek(0, os.SEEK_END)
+    return received
+
+def _splice_loop(rfile: object, sock: socket.socket, file: object,
+length: int) -> int:
+    received = 0
+    read_end, write_end = os.pipe()
+    
+    try:
+        pipe_size = 1 << 16
+        if fcntl and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            with contextlib.suppress(OSError):
+                pipe_size = fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ,
+                    PIPE_SIZE)
+        
+        while received < length:
+            try:
+                in_pipe = os.splice(sock.fileno(), write_end,
+                    min(length - received, pipe_size), flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                # Sockets with a timeout are non-blocking underneath
+                if not select.select([sock], [], [], sock.gettimeout())[0]:
+                    raise TimeoutError('Timed out reading request body')
+                continue
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                return received + _copy_loop(rfile, file, length - received)
+            
+            # End of stream
+            if in_pipe == 0:
+                break
+            
+            while in_pipe:
+                try:
+                    moved = os.splice(read_end, file.fileno(), in_pipe,
+                        flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED:
+                        raise
+                    # Filesystem can't take spliced data. Empty the pipe by
+                    # hand and finish with an ordinary copy
+                    while in_pipe:
+                        data = os.read(read_end, in_pipe)
+                        file.write(data)
+                        in_pipe -= len(data)
+                        received += len(data)
+                    file.flush()
+                    return received + _copy_loop(rfile, file,
+                        length - received)
+                
+                in_pipe -= moved
+                received += moved
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+    
+    return received
+
+def _copy_loop(rfile: object, file: object, length: int) -> int:
+    received = 0
+    while received < length:
+        chunk = rfile.read1(min(length - received, PIPE_SIZE))
+        if not chunk:
+            break
+        file.write(chunk)
+        received += len(chunk)
+    file.flush()
+    return received